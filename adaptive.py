@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+#
+# Adaptive bulk size and concurrency control for the movielens / hetrec
+#  indexing tools, driven by Elasticsearch's responses.
+#
+# This file is licensed to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import sys
+import time
+
+from threading import Condition
+
+# Bounds and additive step of the bulk body size; up to 'qlen' bodies are
+#  queued per index, so the upper bound also bounds memory
+MIN_BYTES  = 256 * 1024
+MAX_BYTES  = 20 * 1024 * 1024
+STEP_BYTES = 1024 * 1024
+
+# Bulk latency to stay below, in seconds
+TARGET_LATENCY = 2.0
+
+
+class controller(object):
+    """AIMD (additive increase, multiplicative decrease) control of the bulk
+        body size and the number of concurrent bulk requests of an index.
+
+       Bulk responses are evaluated in rounds of as many responses as
+       requests may be in flight. After each round:
+
+        - if any documents were rejected w/ 429 (i.e. the bulk queue is
+          full), or Elasticsearch took longer than 'target' on average, the
+          number of concurrent requests is halved
+        - else, if requests took longer than 'target' on average, as seen by
+          the client, the body size is halved: sending took the time
+        - else, one more concurrent request is allowed, up to 'max_window',
+          and the body size grows by STEP_BYTES if requests took less than
+          half the target, up to MAX_BYTES
+
+       Responses to requests started before the last change do not count,
+       so a single overload is not punished twice. Each change is printed
+       w/ its reason, and recorded as "bulk_bytes"
+       and "bulk_window" gauges if a metrics.stage_metrics instance is
+       given. Writers call acquire() / release() around each request, and
+       bulk bodies are cut at 'bytes', see bulk.bulk_buffer.
+    """
+    def __init__(self, name, bytes, max_window, target=TARGET_LATENCY,
+                                                metrics=None, out=sys.stdout):
+        """Arguments:
+           name       -- name of the index, for messages
+           bytes      -- initial bulk body size
+           max_window -- max number of concurrent bulk requests, i.e. the
+                          number of writers; the initial window
+
+           Keyword arguments:
+           target     -- bulk latency to stay below, in seconds
+           metrics    -- metrics.stage_metrics instance to record gauges in
+           out        -- stream to print changes to, None for no output
+        """
+        self.name       = name
+        self.bytes      = min(max(bytes, MIN_BYTES), MAX_BYTES)
+        self.window     = max_window
+        self.max_window = max_window
+        self.target     = target
+        self.metrics    = metrics
+        self.out        = out
+        self.changes    = []
+        self.__since    = 0
+        self.__active   = 0
+        self.__cond     = Condition()
+        self.__reset()
+        self.__gauges()
+
+    def __reset(self):
+        self.__n        = 0
+        self.__latency  = 0.0
+        self.__took     = 0.0
+        self.__rejected = 0
+
+    def __gauges(self):
+        if self.metrics:
+            self.metrics.gauge("bulk_bytes", self.bytes)
+            self.metrics.gauge("bulk_window", self.window)
+
+    def acquire(self):
+        """Wait until fewer than 'window' requests are in flight."""
+        with self.__cond:
+            while self.__active >= self.window:
+                self.__cond.wait()
+            self.__active += 1
+
+    def release(self):
+        """Record the end of a request started w/ acquire()."""
+        with self.__cond:
+            self.__active -= 1
+            self.__cond.notify()
+
+    def observe(self, latency, took=None, rejected=0):
+        """Record a bulk response (or failed request).
+
+           Arguments:
+           latency  -- duration of the request as seen by the client, in
+                        seconds
+
+           Keyword arguments:
+           took     -- duration reported by Elasticsearch, in seconds; None
+                        if unknown, e.g. for failed requests
+           rejected -- number of documents rejected w/ 429, see
+                        bulk.rejections()
+        """
+        with self.__cond:
+            if time.time() - latency < self.__since:
+                return
+            self.__n        += 1
+            self.__latency  += latency
+            self.__took     += latency if took is None else took
+            self.__rejected += rejected
+            if self.__n >= self.window:
+                self.__adjust()
+
+    def __adjust(self):
+        latency = self.__latency / self.__n
+        took    = self.__took / self.__n
+        window  = self.window
+        size    = self.bytes
+        if self.__rejected:
+            window = max(1, window / 2)
+            reason = "%s documents rejected" % self.__rejected
+        elif took > self.target:
+            window = max(1, window / 2)
+            reason = "took %.2f s > %.2f s" % (took, self.target)
+        elif latency > self.target:
+            size   = max(MIN_BYTES, size / 2)
+            reason = "latency %.2f s > %.2f s" % (latency, self.target)
+        else:
+            window = min(self.max_window, window + 1)
+            if latency < self.target / 2:
+                size = min(MAX_BYTES, size + STEP_BYTES)
+            reason = "latency %.2f s, took %.2f s" % (latency, took)
+        self.__reset()
+        if (window, size) == (self.window, self.bytes):
+            return
+        self.__since = time.time()
+        self.changes.append((self.__since, window, size, reason))
+        if self.out:
+            self.out.write("\n   %s: %s requests of %.1f MiB -> %s of %.1f"
+                           " MiB (%s)\n" % (self.name, self.window,
+                                self.bytes / 1048576.0, window,
+                                size / 1048576.0, reason))
+            self.out.flush()
+        self.window = window
+        self.bytes  = size
+        self.__gauges()
+        self.__cond.notify_all()
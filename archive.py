@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+#
+# Data file helpers of the movielens / hetrec indexing tools: newline-aligned
+#  byte ranges for parallel parsing, and transparent reading of data files
+#  from zip archives and gzip / bzip2 compressed files.
+#
+# This file is licensed to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import os
+import bz2
+import zlib
+import errno
+import struct
+import zipfile
+
+from cStringIO import StringIO
+
+# Compressed bytes per read
+CHUNK_BYTES = 1024 * 1024
+
+# Decompressor factories per file name extension
+DECOMPRESSORS = { ".gz":  lambda: zlib.decompressobj(16 + zlib.MAX_WBITS),
+                  ".bz2": bz2.BZ2Decompressor }
+
+# Decompressor factories per zip compression method
+ZIP_DECOMPRESSORS = { zipfile.ZIP_STORED:   None,
+                      zipfile.ZIP_DEFLATED: lambda: zlib.decompressobj(
+                                                        -zlib.MAX_WBITS) }
+
+
+def split_zip(path):
+    """Split a path into the zip archive it points into and the path inside
+        the archive, e.g. "ml-10m.zip/ml-10M100K/ratings.dat" into
+        ("ml-10m.zip", "ml-10M100K/ratings.dat").
+
+       Returns:
+       tuple (archive path, member path), or (None, None) if 'path' does not
+       point into a zip archive
+    """
+    parts = path.split("/")
+    for i in range(1, len(parts) + 1):
+        p = "/".join(parts[:i])
+        if p.lower().endswith(".zip") and os.path.isfile(p):
+            return p, "/".join(parts[i:])
+    return None, None
+
+
+def path(base, name):
+    """Return the path of data file 'name' in data directory 'base'.
+
+       'base' may be a directory, a zip archive, or a directory inside a zip
+       archive. In archives, 'name' is looked up in the directory given, or
+       else anywhere in the archive, e.g. "ratings.dat" is found as
+       "ml-10M100K/ratings.dat" in "ml-10m.zip". In directories, 'name' w/
+       a ".gz" or ".bz2" extension is used if 'name' itself does not exist.
+
+       Arguments:
+       base -- data directory, zip archive, or directory inside a zip archive
+       name -- data file name, e.g. "ratings.dat"
+    """
+    zpath, inner = split_zip(base)
+    if not zpath:
+        ret = os.path.join(base, name)
+        for ext in [ "" ] + sorted(DECOMPRESSORS):
+            if os.path.exists(ret + ext):
+                return ret + ext
+        return ret
+
+    with zipfile.ZipFile(zpath) as zf:
+        names = zf.namelist()
+    inner = inner.strip("/")
+    member = inner + "/" + name if inner else name
+    if member not in names:
+        found = sorted([ n for n in names if n.split("/")[-1] == name
+                                and n.startswith(inner)
+                                and not n.startswith("__MACOSX/") ], key=len)
+        if not found:
+            raise IOError(errno.ENOENT, "No such file in archive",
+                                                    zpath + "/" + member)
+        member = found[0]
+    return zpath + "/" + member
+
+
+def compressed(path):
+    """Return True if 'path' is a zip archive member or a gzip / bzip2
+        compressed file."""
+    return bool(split_zip(path)[0]) or \
+                        os.path.splitext(path)[1].lower() in DECOMPRESSORS
+
+
+def basename(path):
+    """Return the data file name of 'path' w/o directories and compression
+        extension, e.g. "ratings.dat" for "data/ratings.dat.gz"."""
+    name, ext = os.path.splitext(os.path.basename(path))
+    return name if ext.lower() in DECOMPRESSORS else name + ext
+
+
+def stat(path):
+    """Return the os.stat() result of the file holding 'path', i.e. of the
+        zip archive for archive members, e.g. to detect changes by size and
+        mtime."""
+    return os.stat(split_zip(path)[0] or path)
+
+
+def size(path):
+    """Return the size of 'path' as stored, i.e. compressed."""
+    zpath, inner = split_zip(path)
+    if not zpath:
+        return os.stat(path).st_size
+    with zipfile.ZipFile(zpath) as zf:
+        return zf.getinfo(inner).compress_size
+
+
+def chunk_ranges(fname, chunk_bytes, start=0):
+    """Split a file into byte ranges which start and end on line boundaries.
+
+       Arguments:
+       fname       -- file name of a plain data file, i.e. not compressed
+                      or in an archive, see compressed()
+       chunk_bytes -- approximate size of each range, in bytes
+
+       Keyword arguments:
+       start       -- byte offset of the first range; must be a line boundary
+
+       Returns:
+       array of (start, end) byte offset tuples covering the file from 'start'
+    """
+    sz = os.stat(fname).st_size
+    ret = []
+    with open(fname, 'rb') as f:
+        while start < sz:
+            f.seek(min(start + chunk_bytes, sz))
+            f.readline()
+            end = min(f.tell(), sz)
+            ret.append((start, end))
+            start = end
+    return ret
+
+
+def zip_member(f, info):
+    """Seek zip archive file 'f' to the data of member 'info'.
+
+       Returns:
+       decompressor factory of the member, see ZIP_DECOMPRESSORS
+    """
+    if info.flag_bits & 0x1:
+        raise IOError(errno.EINVAL, "Encrypted zip member", info.filename)
+    if info.compress_type not in ZIP_DECOMPRESSORS:
+        raise IOError(errno.EINVAL, "Unsupported zip compression method %s"
+                                    % info.compress_type, info.filename)
+    f.seek(info.header_offset)
+    # Local file header (see the zip APPNOTE): signature, ..., file name
+    #  length and extra field length at offset 26, 30 bytes in all
+    head = f.read(30)
+    if head[:4] != "PK\x03\x04":
+        raise zipfile.BadZipfile("Bad local file header of %s"
+                                                        % info.filename)
+    name_len, extra_len = struct.unpack("<HH", head[26:30])
+    f.seek(name_len + extra_len, os.SEEK_CUR)
+    return ZIP_DECOMPRESSORS[info.compress_type]
+
+
+class reader(object):
+    """Line iterator over a plain data file, a zip archive member, or a gzip
+        or bzip2 compressed file.
+
+       Compressed data is decompressed in CHUNK_BYTES reads and split into
+       lines in bulk; zip members are read as raw deflate streams, like
+       gzip data, so the compressed bytes consumed are known exactly. Byte
+       offsets (see seek()) refer to the uncompressed data, so they are
+       compatible w/ those of the plain file.
+
+       'size' is the stored (i.e. compressed) size of the data. 'total' is
+       the uncompressed size, estimated from the compression ratio so far
+       while reading compressed data, which makes 'offset * 100 / total' the
+       percentage of compressed bytes read. It is exact at the end of the
+       data, and for plain files.
+    """
+    def __init__(self, path):
+        """Arguments:
+           path -- data file path, see split_zip() for archive members
+        """
+        self.path     = path
+        self.__skip   = 0
+        self.__in     = 0
+        self.__out    = 0
+        self.__member = False
+        zpath, inner = split_zip(path)
+        self.__f = open(zpath or path, 'rb')
+        if zpath:
+            try:
+                info = zipfile.ZipFile(self.__f).getinfo(inner)
+                self.__decomp = zip_member(self.__f, info)
+            except:
+                self.__f.close()
+                raise
+            self.__member = True
+            self.size     = info.compress_size
+        else:
+            self.size     = os.fstat(self.__f.fileno()).st_size
+            self.__decomp = DECOMPRESSORS.get(
+                                        os.path.splitext(path)[1].lower())
+        self.total = self.size
+
+    def seek(self, offset):
+        """Start reading at uncompressed byte offset 'offset', which must be a
+            line boundary. Compressed data up to 'offset' is decompressed
+            and skipped."""
+        if self.__member or self.__decomp:
+            self.__skip = offset
+        else:
+            self.__f.seek(offset)
+
+    def __chunks(self):
+        """Generator for decompressed chunks of data."""
+        # No decompressor for stored zip members
+        d = self.__decomp and self.__decomp()
+        while True:
+            n = CHUNK_BYTES
+            if self.__member:
+                n = min(n, self.size - self.__in)
+            data = self.__f.read(n) if n else ""
+            if not data:
+                return
+            self.__in += len(data)
+            if not d:
+                yield data
+                continue
+            while data:
+                try:
+                    out = d.decompress(data)
+                except EOFError:
+                    # bzip2 stream ended w/ the previous read
+                    d = self.__decomp()
+                    continue
+                # Concatenated streams, e.g. from 'pigz' or 'pbzip2'
+                data = d.unused_data
+                if data:
+                    d = self.__decomp()
+                if out:
+                    yield out
+
+    def __lines(self):
+        rest = ""
+        skip = self.__skip
+        for data in self.__chunks():
+            self.__out += len(data)
+            self.total = self.__out * self.size / max(self.__in, 1)
+            if skip:
+                if len(data) <= skip:
+                    skip -= len(data)
+                    continue
+                data = data[skip:]
+                skip = 0
+            end = data.rfind("\n")
+            if end < 0:
+                rest += data
+                continue
+            for line in StringIO(rest + data[:end + 1]):
+                yield line
+            rest = data[end + 1:]
+        self.total = self.__out
+        if rest:
+            yield rest
+
+    def __iter__(self):
+        if self.__member or self.__decomp:
+            return self.__lines()
+        return iter(self.__f)
+
+    def close(self):
+        self.__f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
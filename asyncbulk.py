@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+#
+# Asynchronous bulk writer for the movielens / hetrec indexing tools: a
+#  window of concurrent bulk requests driven by a single event loop thread.
+#
+# This file is licensed to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import os
+import time
+import json
+import errno
+import heapq
+import socket
+import select
+import traceback
+import bulk
+
+from collections import deque
+from threading import Thread, RLock, Semaphore
+
+# Bytes per socket send() / recv() call
+IO_BYTES = 1024 * 1024
+
+
+def hosts(es):
+    """Return an array of (host, port) tuples of an elasticsearch client's
+        nodes; only plain HTTP is supported.
+
+       Host names are returned as byte strings: the client parses the hosts
+       it is given into unicode ones, which would turn the requests built
+       from them into unicode as well.
+    """
+    ret = []
+    for h in es.transport.hosts:
+        ret.append((str(h.get('host', 'localhost')),
+                                                int(h.get('port', 9200))))
+    return ret
+
+
+class connection(object):
+    """Non-blocking HTTP/1.1 keep-alive connection to an Elasticsearch node,
+        w/ at most one request in flight."""
+    def __init__(self, host, port):
+        self.host  = host
+        self.port  = port
+        self.sock  = None
+        self.batch = None
+
+    def request(self, batch, path="/_bulk"):
+        """Start sending a bulk request for 'batch', (re-)connecting if
+            needed."""
+        if not self.sock:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.sock.setblocking(0)
+            err = self.sock.connect_ex((self.host, self.port))
+            if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                self.close()
+                raise socket.error(err, os.strerror(err))
+        self.batch   = batch
+        self.out     = ("POST %s HTTP/1.1\r\nHost: %s:%s\r\n"
+                        "Content-Type: application/json\r\n"
+                        "Content-Length: %s\r\n\r\n" % (path, self.host,
+                                self.port, len(batch.body))) + batch.body
+        self.sent    = 0
+        self.head    = ""
+        self.status  = None
+        self.length  = None
+        self.chunks  = []
+        self.got     = 0
+        self.started = time.time()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def writing(self):
+        return self.sent < len(self.out)
+
+    def write(self):
+        """Send the next part of the request."""
+        try:
+            self.sent += self.sock.send(buffer(self.out, self.sent, IO_BYTES))
+        except socket.error, e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+        if not self.writing():
+            self.out = ""
+
+    def read(self):
+        """Receive the next part of the response.
+
+           Returns:
+           tuple (HTTP status, response body) once the response is complete,
+           None before
+        """
+        try:
+            data = self.sock.recv(IO_BYTES)
+        except socket.error, e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return None
+            raise
+        if not data:
+            raise socket.error(errno.ECONNRESET, "Connection closed by node")
+        if self.status is None:
+            self.head += data
+            end = self.head.find("\r\n\r\n")
+            if end < 0:
+                return None
+            lines = self.head[:end].split("\r\n")
+            self.status = int(lines[0].split()[1])
+            self.close_after = False
+            for l in lines[1:]:
+                k, v = l.split(":", 1)
+                k = k.strip().lower()
+                if k == "content-length":
+                    self.length = int(v)
+                elif k == "connection" and v.strip().lower() == "close":
+                    self.close_after = True
+            if self.length is None:
+                raise socket.error(errno.EPROTO,
+                                   "Response w/o Content-Length")
+            data = self.head[end + 4:]
+            self.head = ""
+        self.chunks.append(data)
+        self.got += len(data)
+        if self.got < self.length:
+            return None
+        ret = (self.status, "".join(self.chunks))
+        self.chunks = []
+        if self.close_after:
+            self.close()
+        return ret
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+
+class batch(object):
+    """A bulk batch in flight, w/ its progress.done() arguments."""
+    def __init__(self, item):
+        self.start, self.end, self.body, self.read, self.total = item
+        self.attempt = 0
+        self.indexed = 0
+        self.failed  = 0
+
+
+class bulk_window(object):
+    """Asynchronous bulk writer w/ a bounded window of requests in flight.
+
+       A single event loop thread multiplexes 'in_flight' keep-alive HTTP
+       connections w/ select(): it sends queued bulk bodies on idle
+       connections, evaluates responses w/ a bulk.bulk_sender, and schedules
+       re-tries after the sender's backoff delay w/o blocking other
+       requests. put() only blocks while 'in_flight' batches are in flight
+       (including their re-tries), which is what keeps the parser from
+       running ahead of Elasticsearch.
+
+       Compared to a bulk.writer_pool, high Elasticsearch latencies are
+       covered by a larger window instead of more threads. The interface is
+       the same: put() batches, stop() once done, or cancel(). If the
+       sender caps the bulk requests in flight of several indices (see
+       bulk.bulk_sender), each batch holds one of its request slots until
+       it completed. W/ an adaptive.controller, at most its 'window' of
+       the connections are used at once.
+    """
+    def __init__(self, es, prog, sender, in_flight=8, metrics=None,
+                                                                control=None):
+        """Arguments:
+           es        -- elasticsearch client instance; its nodes are
+                         connected to round-robin
+           prog      -- bulk.progress instance to report completed batches to
+           sender    -- bulk.bulk_sender instance evaluating responses
+
+           Keyword arguments:
+           in_flight -- max number of bulk requests in flight
+           metrics   -- metrics.stage_metrics instance to record waits and
+                         bulk requests in
+           control   -- adaptive.controller instance to report responses to
+        """
+        nodes = hosts(es)
+        self.prog      = prog
+        self.sender    = sender
+        self.metrics   = metrics
+        self.control   = control
+        self.in_flight = in_flight
+        self.__conns   = [ connection(*nodes[i % len(nodes)])
+                                            for i in range(in_flight) ]
+        self.__slots   = Semaphore(in_flight)
+        self.__busy    = 0
+        self.__queued  = deque()
+        self.__retries = []
+        self.__lock    = RLock()
+        self.__stop    = False
+        self.__wake_r, self.__wake_w = os.pipe()
+        self.__thread  = Thread(target=self.__loop)
+        self.__thread.start()
+
+    def __wake(self):
+        os.write(self.__wake_w, "x")
+
+    def put(self, item):
+        """Queue a batch tuple (start-num, end-num, body, bytes-read,
+            bytes-total), waiting while the window is full."""
+        t = time.time()
+        self.__slots.acquire()
+        self.sender.acquire()
+        with self.__lock:
+            self.__queued.append(batch(item))
+            self.__busy += 1
+            busy = self.__busy
+        if self.metrics:
+            self.metrics.observe("queue_put_wait", time.time() - t)
+            self.metrics.gauge("queue_depth", busy)
+        self.__wake()
+
+    def cancel(self):
+        """Drop the batches not sent yet (including re-tries), wait for
+            those in flight, and stop the event loop, see
+            bulk.writer_pool.cancel()."""
+        with self.__lock:
+            dropped = len(self.__queued) + len(self.__retries)
+            self.__queued.clear()
+            self.__retries = []
+            self.__busy -= dropped
+        for i in range(dropped):
+            self.sender.release()
+            self.__slots.release()
+        self.stop()
+
+    def stop(self):
+        """Wait for all batches to complete, and stop the event loop."""
+        with self.__lock:
+            self.__stop = True
+        self.__wake()
+        self.__thread.join()
+        for c in self.__conns:
+            c.close()
+        os.close(self.__wake_r)
+        os.close(self.__wake_w)
+
+    def __finish(self, b):
+        self.prog.done(b.start, b.end, b.read, b.total, b.indexed, b.failed)
+        if self.metrics:
+            self.metrics.count("docs_indexed", b.indexed)
+            self.metrics.count("docs_failed", b.failed)
+        with self.__lock:
+            self.__busy -= 1
+        self.sender.release()
+        self.__slots.release()
+
+    def __completed(self, conn, status=None, data=None, error=None):
+        """Evaluate the response (or error) of a connection's batch."""
+        b = conn.batch
+        conn.batch = None
+        latency = time.time() - conn.started
+        if self.metrics:
+            self.metrics.observe("bulk_latency", latency)
+            if b.attempt:
+                self.metrics.count("bulk_retries")
+        try:
+            if error is None and status < 300:
+                res = json.loads(data)
+                if self.control:
+                    self.control.observe(latency, res.get('took', 0) / 1000.0,
+                                                        bulk.rejections(res))
+                i, f, retry = self.sender.evaluate(b.body, res, b.attempt,
+                                                                self.metrics)
+                b.indexed += i
+            else:
+                if self.control:
+                    self.control.observe(latency, rejected=len(
+                            bulk.actions(b.body)) if status == 429 else 0)
+                f, retry = self.sender.request_failed(b.body, status,
+                                    error or data, b.attempt, self.metrics)
+            b.failed += f
+        except Exception:
+            print "Indexing error: skipping lines %s-%s." % (b.start, b.end)
+            traceback.print_exc()
+            b.failed = b.end - b.start - b.indexed
+            retry = None
+        if retry is None:
+            return self.__finish(b)
+        b.body = retry
+        heapq.heappush(self.__retries, (time.time()
+                            + self.sender.delay(b.attempt), id(b), b))
+        b.attempt += 1
+
+    def __schedule(self):
+        """Start queued batches and due re-tries on idle connections.
+
+           Returns:
+           True once stopped and all batches completed
+        """
+        now = time.time()
+        while self.__retries and self.__retries[0][0] <= now:
+            self.__queued.appendleft(heapq.heappop(self.__retries)[2])
+        window = self.control.window if self.control else self.in_flight
+        active = len([ c for c in self.__conns if c.batch is not None ])
+        for c in self.__conns:
+            if active >= window:
+                break
+            if c.batch is None and self.__queued:
+                active += 1
+                b = self.__queued.popleft()
+                try:
+                    c.request(b)
+                except socket.error, e:
+                    c.batch = b
+                    c.started = now
+                    self.__completed(c, error=e)
+        return self.__stop and self.__busy == 0
+
+    def __loop(self):
+        while True:
+            with self.__lock:
+                if self.__schedule():
+                    return
+            busy = [ c for c in self.__conns if c.batch is not None ]
+            rd = [ self.__wake_r ] + [ c for c in busy if not c.writing() ]
+            wr = [ c for c in busy if c.writing() ]
+            timeout = None
+            if self.__retries:
+                timeout = max(0, self.__retries[0][0] - time.time())
+            rd, wr, x = select.select(rd, wr, [], timeout)
+            if self.__wake_r in rd:
+                os.read(self.__wake_r, 4096)
+                rd.remove(self.__wake_r)
+            for c in wr + rd:
+                try:
+                    if c in wr:
+                        c.write()
+                        continue
+                    res = c.read()
+                except socket.error, e:
+                    c.close()
+                    self.__completed(c, error=e)
+                    continue
+                if res:
+                    self.__completed(c, *res)
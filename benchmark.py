@@ -0,0 +1,354 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+#
+# Ingestion benchmarks for the movielens / hetrec indexing tools.
+#
+# This file is licensed to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import argparse
+import subprocess
+import resource
+import time
+import json
+import sys
+import os
+import bulk
+import adaptive
+import gen_data
+import post_movies
+import post_movie_details
+
+from itertools import islice
+
+STAGES = ("parse", "assemble", "writer", "details")
+
+RATINGS_FIELDS = ("UserID", "MovieID", "Rating", "Timestamp")
+
+# Number of parsed ratings the 'assemble' and 'writer' stages cycle through
+SAMPLE_DOCS = 100000
+
+
+def sample(data):
+    """Return an array of (JSON dict string, doc-ID) tuples of the first
+        SAMPLE_DOCS ratings."""
+    lines = post_movies.parse(os.path.join(data, "ratings.dat"),
+                            RATINGS_FIELDS, id_fields=("UserID", "MovieID"))
+    return [ (l, i) for l, rd, sz, i in islice(lines, SAMPLE_DOCS) ]
+
+
+def in_flight(args):
+    """Return the in_flight argument of the indexing functions."""
+    return args.in_flight if args.engine == 'async' else 0
+
+
+def control(args, index):
+    """Return the control argument of the indexing functions, see
+        --adaptive."""
+    if not args.adaptive:
+        return None
+    return adaptive.controller(index, args.bulk_mb * 1024 * 1024,
+                    in_flight(args) or args.writers, args.target_latency)
+
+
+def bench_parse(args):
+    """Parse all of 'ratings.dat' w/ post_movies.parse() (or parse_parallel()
+        w/ --parse-workers)."""
+    fname = os.path.join(args.data, "ratings.dat")
+    start = time.time()
+    if args.parse_workers > 1:
+        lines = post_movies.parse_parallel(fname, RATINGS_FIELDS,
+                        id_fields=("UserID", "MovieID"),
+                        workers=args.parse_workers)
+    else:
+        lines = post_movies.parse(fname, RATINGS_FIELDS,
+                        id_fields=("UserID", "MovieID"))
+    docs = 0
+    for l in lines:
+        docs += 1
+    return docs, time.time() - start
+
+
+def bench_assemble(args):
+    """Assemble bulk request bodies of --docs parsed ratings w/
+        bulk.bulk_buffer, the way post_movies.index_file() does."""
+    docs   = sample(args.data)
+    header = '{"%s": {"_index": "ratings", "_type": "rating", "_id": "%s"}}'
+    buf    = bulk.bulk_buffer(args.bulk_mb * 1024 * 1024)
+    start  = time.time()
+    for n in xrange(args.docs):
+        line, i = docs[n % len(docs)]
+        buf.add(header % ("index", i), line)
+        if buf.full():
+            buf.take()
+    buf.take()
+    return args.docs, time.time() - start
+
+
+def bench_writer(args):
+    """Send --docs ratings in pre-assembled bulk bodies through a pool of
+        post_movies.index_writer() threads, or the async engine."""
+    header = '{"index": {"_index": "ratings", "_type": "rating", "_id": "%s"}}'
+    buf    = bulk.bulk_buffer(args.bulk_mb * 1024 * 1024)
+    bodies = []
+    for line, i in sample(args.data):
+        buf.add(header % i, line)
+        if buf.full():
+            bodies.append((buf.docs, buf.take()))
+    if buf.docs:
+        bodies.append((buf.docs, buf.take()))
+
+    es   = bulk.client(args.writers, [args.es])
+    prog = bulk.progress(out=None)
+    pool = post_movies.start_writers(es, "ratings", "rating", prog,
+                        bulk.bulk_sender(args.retries), args.writers,
+                        args.qlen, in_flight(args),
+                        control=control(args, "ratings"))
+    start = time.time()
+    docs  = 0
+    b     = 0
+    while docs < args.docs:
+        n, body = bodies[b % len(bodies)]
+        pool.put((docs, docs + n, body, None, None))
+        docs += n
+        b    += 1
+    pool.stop()
+    return prog.indexed, time.time() - start
+
+
+def bench_details(args):
+    """Run post_movie_details.index() on the hetrec files."""
+    hdir = os.path.join(args.data, "hetrec")
+    es   = bulk.client(args.writers, [args.es])
+    tags, skipped = post_movie_details.parse_tags(hdir, "tags.dat")
+    with open(os.path.join(hdir, "movies.dat")) as f:
+        docs = sum([ 1 for l in f ]) - 1
+    start = time.time()
+    post_movie_details.index(es, hdir, tags, args.qlen,
+                                args.bulk_mb * 1024 * 1024,
+                                writers=args.writers,
+                                sender=bulk.bulk_sender(args.retries),
+                                in_flight=in_flight(args),
+                                parse_workers=args.parse_workers,
+                                control=control(args, "movie_details"))
+    return docs, time.time() - start
+
+
+def run_stage(args):
+    """Run a single stage in this process and print its result as the last
+        line of output, as JSON dict."""
+    docs, secs = globals()["bench_" + args.stage](args)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print ""
+    print json.dumps({"stage": args.stage, "docs": docs, "seconds": secs,
+                      "docs_per_sec": docs / secs if secs else 0,
+                      "peak_rss_mib": rss / 1024.0})
+
+
+def start_stub(args):
+    """Start stub_es.py in a separate process on a free port.
+
+       Returns:
+       tuple (Popen instance, URL)
+    """
+    cmd = [ sys.executable, os.path.join(os.path.dirname(
+                                    os.path.abspath(__file__)), "stub_es.py"),
+            "--port", "0", "--latency-ms", str(args.latency),
+            "--reject", str(args.reject), "--seed", "1",
+            "--capacity", str(args.capacity),
+            "--latency-per-mb", str(args.latency_per_mb) ]
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    port = p.stdout.readline().strip().rstrip(".").split()[-1]
+    return p, "http://127.0.0.1:%s" % port
+
+
+def run_all(args):
+    """Run each stage in a separate process, so peak RSS is per stage, and
+        print a table of the results.
+
+       Returns:
+       array of result dicts, see run_stage()
+    """
+    stub = None
+    if not args.es and set(args.stages) & set(("writer", "details")):
+        stub, args.es = start_stub(args)
+    results = []
+    try:
+        for stage in args.stages:
+            cmd = [ sys.executable, os.path.abspath(__file__),
+                    "--stage", stage ] + [ a for a in sys.argv[1:]
+                                                if a not in args.stages ]
+            if args.es and "--es" not in cmd:
+                cmd += [ "--es", args.es ]
+            sys.stdout.write("Running %s... " % stage)
+            sys.stdout.flush()
+            out = subprocess.check_output(cmd)
+            results.append(json.loads(out.strip().split("\n")[-1]))
+            print "%.0f docs/s" % results[-1]["docs_per_sec"]
+    finally:
+        if stub:
+            stub.terminate()
+            stub.wait()
+
+    print ""
+    print "%-10s %12s %10s %12s %14s" % ("stage", "docs", "seconds",
+                                            "docs/s", "peak RSS MiB")
+    for r in results:
+        print "%-10s %12d %10.2f %12.0f %14.1f" % (r["stage"], r["docs"],
+                        r["seconds"], r["docs_per_sec"], r["peak_rss_mib"])
+    return results
+
+
+def compare(results, fname, tolerance):
+    """Compare results to a saved baseline.
+
+       Returns:
+       number of stages which got slower, or use more memory, by more than
+       'tolerance' percent
+    """
+    with open(fname) as f:
+        base = dict( (r["stage"], r) for r in json.load(f) )
+    regressions = 0
+    for r in results:
+        b = base.get(r["stage"])
+        if not b:
+            continue
+        for key, worse in (("docs_per_sec", -1), ("peak_rss_mib", 1)):
+            change = (r[key] - b[key]) * 100.0 / b[key] if b[key] else 0
+            if change * worse > tolerance:
+                regressions += 1
+                print "REGRESSION: %s %s %.1f -> %.1f (%+.1f %%)" % (
+                                    r["stage"], key, b[key], r[key], change)
+    return regressions
+
+
+def cmdl_args():
+    """Parse command line arguments
+
+       Returns
+        argparse instance ready to use
+    """
+    parser = argparse.ArgumentParser(
+                description='Benchmark parsing, bulk body assembly, bulk'
+                 + ' writers, and hetrec indexing, reporting documents per'
+                 + ' second and peak RSS per stage.')
+    parser.add_argument('stages', metavar='stage', nargs='*',
+        default=list(STAGES),
+        help='Stages to run: %s (default: all).' % ", ".join(STAGES))
+    parser.add_argument('--data', metavar='dir', dest='data',
+        default='bench-data',
+        help='Data set directory; a synthetic data set is generated if it'
+             + ' does not exist (default: bench-data).')
+    parser.add_argument('--ratings', metavar='ratings', dest='ratings',
+        default='1M', type=gen_data.scale,
+        help='Number of ratings of a generated data set (default: 1M).')
+    parser.add_argument('--docs', metavar='docs', type=gen_data.scale,
+        dest='docs', default='1M',
+        help='Number of documents of the assemble and writer stages'
+             + ' (default: 1M).')
+    parser.add_argument('--es', metavar='url', dest='es',
+        help='Elasticsearch (or stub) URL for the writer and details'
+             + ' stages; a stub_es.py is started if not given.')
+    parser.add_argument('--latency-ms', metavar='ms', type=float,
+        dest='latency', default=0,
+        help='Bulk latency of the stub started in ms (default: 0).')
+    parser.add_argument('--reject', metavar='fraction', type=float,
+        dest='reject', default=0,
+        help='Fraction of documents rejected by the stub started'
+             + ' (default: 0).')
+    parser.add_argument('--capacity', metavar='requests', type=int,
+        dest='capacity', default=0,
+        help='Bulk requests the stub started handles at once; documents of'
+             + ' further ones are rejected (default: 0, no limit).')
+    parser.add_argument('--latency-per-mb', metavar='ms', type=float,
+        dest='latency_per_mb', default=0,
+        help='Bulk latency per MiB of body of the stub started in ms'
+             + ' (default: 0).')
+    parser.add_argument('--parse-workers', metavar='workers', type=int,
+        dest='parse_workers', default=1,
+        help='Number of parser processes of the parse and details stages'
+             + ' (default: 1).')
+    parser.add_argument('--writers', metavar='writers', type=int,
+        dest='writers', default=4,
+        help='Number of concurrent bulk writers (default: 4).')
+    parser.add_argument('--qlen', metavar='qlen', type=int, dest='qlen',
+        default=50, help='Max number of bulk writes to queue (default: 50).')
+    parser.add_argument('--engine', dest='engine', default='threads',
+        choices=('threads', 'async'),
+        help='Bulk writer engine of the writer and details stages, see'
+             + ' post_movies.py (default: threads).')
+    parser.add_argument('--in-flight', metavar='requests', type=int,
+        dest='in_flight', default=16,
+        help='Max number of bulk requests in flight of the async engine'
+             + ' (default: 16).')
+    parser.add_argument('--adaptive', action='store_true', dest='adaptive',
+        help='Adjust bulk size and concurrency of the writer and details'
+             + ' stages, see adaptive.py.')
+    parser.add_argument('--target-latency', metavar='seconds', type=float,
+        dest='target_latency', default=adaptive.TARGET_LATENCY,
+        help='Bulk latency --adaptive keeps below (default: %s).'
+                                                % adaptive.TARGET_LATENCY)
+    parser.add_argument('--bulk-mb', metavar='MiB', type=int, dest='bulk_mb',
+        default=10, help='Size of a bulk write in MiB (default: 10).')
+    parser.add_argument('--retries', metavar='retries', type=int,
+        dest='retries', default=5,
+        help='Max number of re-tries of rejected documents (default: 5).')
+    parser.add_argument('--save', metavar='file', dest='save',
+        help='Save the results as JSON to file.')
+    parser.add_argument('--compare', metavar='file', dest='compare',
+        help='Compare the results to a file written by --save, and exit'
+             + ' w/ status 1 on regressions.')
+    parser.add_argument('--tolerance', metavar='percent', type=float,
+        dest='tolerance', default=10,
+        help='Max slow-down / memory growth accepted by --compare'
+             + ' (default: 10).')
+    parser.add_argument('--stage', dest='stage', help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    """ This script benchmarks the stages of an ingestion run separately:
+
+         parse    -- post_movies.parse() of 'ratings.dat'
+         assemble -- bulk body assembly w/ bulk.bulk_buffer
+         writer   -- bulk writer threads (post_movies.index_writer) sending
+                     to Elasticsearch, or to a local stub_es.py
+         details  -- post_movie_details.index() of the hetrec files
+
+        A synthetic data set (see gen_data.py) is generated on first use.
+        Use --save / --compare to catch performance regressions, e.g.
+
+         ./benchmark.py --ratings 10M --save base.json
+         (change things)
+         ./benchmark.py --ratings 10M --compare base.json
+    """
+    args = cmdl_args()
+    if args.stage:
+        run_stage(args)
+        sys.exit()
+
+    for s in args.stages:
+        if s not in STAGES:
+            sys.exit("Unknown stage %s, use one of %s." % (s,
+                                                        ", ".join(STAGES)))
+    if not os.path.exists(os.path.join(args.data, "ratings.dat")):
+        gen_data.generate(args.data, args.ratings)
+
+    results = run_all(args)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=1)
+    if args.compare and compare(results, args.compare, args.tolerance):
+        sys.exit(1)
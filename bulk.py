@@ -0,0 +1,528 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+#
+# Bulk indexing helpers shared by the movielens / hetrec indexing tools.
+#
+# This file is licensed to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import sys
+import time
+import json
+
+from Queue import Empty
+from itertools import izip
+from threading import Thread, Lock, Semaphore
+
+# Default byte budget of a single bulk request body
+BULK_BYTES = 10 * 1024 * 1024
+
+# HTTP status codes of bulk items / requests which are worth re-trying;
+#  429 is returned by ES when its bulk thread pool queue is full.
+RETRY_STATUS = (429, 502, 503, 504)
+
+
+class bulk_buffer(object):
+    """Builder for bulk request bodies.
+
+       Action / document line pairs are collected in a list and joined once
+       when the body is taken, so assembling a body is linear in its size.
+       A body is considered full once it exceeds a byte budget rather than a
+       fixed number of documents, which keeps request sizes predictable for
+       both tiny and huge documents.
+
+       If a metrics.stage_metrics instance is given, the time spent
+       assembling each body is recorded as its "serialize" stage. If an
+       adaptive.controller is given, its current 'bytes' is the byte budget
+       instead of 'max_bytes'.
+    """
+    def __init__(self, max_bytes=BULK_BYTES, metrics=None, control=None):
+        self.max_bytes = max_bytes
+        self.metrics   = metrics
+        self.control   = control
+        self.__parts   = []
+        self.__time    = 0.0
+        self.size      = 0
+        self.docs      = 0
+
+    def add(self, header, doc=None):
+        """Append an action / document line pair to the body.
+
+           Arguments:
+           header -- bulk action line, e.g. '{"index": {...}}'
+           doc    -- document source line; None for actions w/o source,
+                      i.e. 'delete'
+        """
+        if self.metrics:
+            t = time.time()
+        self.__parts.append(header)
+        self.size += len(header) + 1
+        if doc is not None:
+            self.__parts.append(doc)
+            self.size += len(doc) + 1
+        self.docs += 1
+        if self.metrics:
+            self.__time += time.time() - t
+
+    def full(self):
+        """Return True if the body has reached its byte budget."""
+        if self.control:
+            return self.size >= self.control.bytes
+        return self.size >= self.max_bytes
+
+    def take(self):
+        """Return the assembled body and reset the buffer."""
+        if not self.__parts:
+            return ""
+        t = time.time()
+        ret = "\n".join(self.__parts) + "\n"
+        if self.metrics:
+            self.metrics.observe("serialize", self.__time + time.time() - t)
+            self.__time = 0.0
+        self.__parts = []
+        self.size    = 0
+        self.docs    = 0
+        return ret
+
+    def __len__(self):
+        return self.docs
+
+
+def actions(body):
+    """Split a bulk request body into (action-line, source-line) tuples.
+
+       'delete' actions do not have a source line; None is returned as
+       source for them.
+
+       Arguments:
+       body -- bulk request body, one action / source line each per line
+    """
+    lines = body.split("\n")
+    ret = []
+    i = 0
+    while i < len(lines):
+        if not lines[i]:
+            i += 1
+            continue
+        if lines[i].lstrip("{ ").startswith('"delete"'):
+            ret.append((lines[i], None))
+            i += 1
+        else:
+            ret.append((lines[i], lines[i + 1]))
+            i += 2
+    return ret
+
+
+def rejections(res):
+    """Return the number of items of a bulk response rejected because
+        Elasticsearch's bulk thread pool queue was full, i.e. w/ status 429
+        or an EsRejectedExecutionException."""
+    if not res.get('errors'):
+        return 0
+    ret = 0
+    for item in res['items']:
+        r = item.values()[0]
+        if r.get('status') == 429 or \
+                "EsRejectedExecutionException" in "%s" % (r.get('error'),):
+            ret += 1
+    return ret
+
+
+def join_actions(acts):
+    """Re-assemble a bulk request body from (action, source) tuples.
+
+       Arguments:
+       acts -- array of tuples as returned by actions()
+    """
+    ret = []
+    for hdr, doc in acts:
+        ret.append(hdr)
+        if doc is not None:
+            ret.append(doc)
+    return "\n".join(ret) + "\n"
+
+
+class dead_letter(object):
+    """Thread-safe writer for documents which failed to index permanently.
+
+       Each failed document is written to an NDJSON file as one JSON dict
+       {"status": ..., "error": ..., "action": ..., "source": ...}, where
+       'action' and 'source' are the original bulk lines. The file is only
+       created when the first failure is recorded.
+    """
+    def __init__(self, fname):
+        self.fname  = fname
+        self.count  = 0
+        self.__f    = None
+        self.__lock = Lock()
+
+    def write(self, action, source, status, error):
+        """Record a failed document.
+
+           Arguments:
+           action -- bulk action line of the document
+           source -- bulk source line of the document (None for deletes)
+           status -- HTTP status of the failure, if any
+           error  -- error message
+        """
+        line = json.dumps({"status": status, "error": "%s" % (error,),
+                           "action": action, "source": source},
+                                                            encoding='latin1')
+        with self.__lock:
+            if not self.__f:
+                self.__f = open(self.fname, "a")
+            self.__f.write(line + "\n")
+            self.__f.flush()
+            self.count += 1
+
+    def close(self):
+        with self.__lock:
+            if self.__f:
+                self.__f.close()
+                self.__f = None
+
+
+class bulk_sender(object):
+    """Sends bulk requests, evaluating the per-item results of the response.
+
+       Documents rejected with a re-tryable status (see RETRY_STATUS) are
+       re-sent with exponential backoff; whole requests are re-sent the same
+       way on connection errors. Documents which still fail after 'retries'
+       attempts, or fail with any other status, are counted as failed and
+       written to the dead letter file, if one was given.
+
+       If send() is passed a metrics.stage_metrics instance, the latency of
+       each bulk request, the time Elasticsearch reports it took, re-tries,
+       and item errors per HTTP status are recorded. If it is passed an
+       adaptive.controller, each request waits for the controller's window,
+       and its outcome is reported to the controller.
+
+       A sender shared by the writers of several indices caps the number of
+       bulk requests they have in flight in total if 'max_requests' is set:
+       send() waits for a free request slot before each request, and an
+       asyncbulk.bulk_window holds a slot per batch in flight, see acquire().
+    """
+    def __init__(self, retries=5, backoff=0.5, max_backoff=60,
+                                        dead_letter=None, max_requests=0):
+        self.retries      = retries
+        self.backoff      = backoff
+        self.max_backoff  = max_backoff
+        self.dead_letter  = dead_letter
+        self.max_requests = max_requests
+        self.__slots      = Semaphore(max_requests) if max_requests else None
+
+    def acquire(self):
+        """Wait for a free request slot, if 'max_requests' is set."""
+        if self.__slots:
+            self.__slots.acquire()
+
+    def release(self):
+        """Free a request slot taken by acquire()."""
+        if self.__slots:
+            self.__slots.release()
+
+    def delay(self, attempt):
+        """Return the backoff delay before re-try number 'attempt' + 1."""
+        return min(self.backoff * 2 ** attempt, self.max_backoff)
+
+    def __fail(self, acts, status, error):
+        if self.dead_letter:
+            for hdr, doc in acts:
+                self.dead_letter.write(hdr, doc, status, error)
+        return len(acts)
+
+    def request_failed(self, body, status, error, attempt, metrics=None):
+        """Evaluate a bulk request which failed as a whole.
+
+           Arguments:
+           body    -- bulk request body
+           status  -- HTTP status of the failure, None for connection errors
+           error   -- error message or exception
+           attempt -- number of re-tries of the body so far
+
+           Keyword arguments:
+           metrics -- metrics.stage_metrics instance to record errors in
+
+           Returns:
+           tuple (documents-failed, body to re-try or None)
+        """
+        if metrics:
+            metrics.error(status if isinstance(status, int) else "connection",
+                          len(actions(body)))
+        if attempt < self.retries and (not isinstance(status, int)
+                                       or status in RETRY_STATUS):
+            return 0, body
+        return self.__fail(actions(body), status, error), None
+
+    def evaluate(self, body, res, attempt, metrics=None):
+        """Evaluate the per-item results of a bulk response.
+
+           Arguments:
+           body    -- bulk request body
+           res     -- decoded bulk response
+           attempt -- number of re-tries of the body so far
+
+           Keyword arguments:
+           metrics -- metrics.stage_metrics instance to record errors in
+
+           Returns:
+           tuple (documents-indexed, documents-failed, body to re-try or
+           None)
+        """
+        if metrics:
+            metrics.observe("bulk_took", res.get('took', 0) / 1000.0)
+        if not res.get('errors'):
+            return len(res['items']), 0, None
+
+        indexed = 0
+        failed  = 0
+        retry   = []
+        for act, item in izip(actions(body), res['items']):
+            op, r  = item.items()[0]
+            status = r.get('status', 500)
+            if status < 300 or (op == 'delete' and status == 404):
+                indexed += 1
+                continue
+            if metrics:
+                metrics.error(status)
+            if status in RETRY_STATUS and attempt < self.retries:
+                retry.append(act)
+            else:
+                failed += self.__fail([act], status, r.get('error'))
+        return indexed, failed, join_actions(retry) if retry else None
+
+    def send(self, es, body, metrics=None, control=None):
+        """Send a bulk request body, re-trying failed documents.
+
+           Arguments:
+           es   -- elasticsearch client instance to index data into
+           body -- bulk request body
+
+           Keyword arguments:
+           metrics -- metrics.stage_metrics instance to record requests in
+           control -- adaptive.controller instance of the index
+
+           Returns:
+           tuple (documents-indexed, documents-failed)
+        """
+        indexed = 0
+        failed  = 0
+        attempt = 0
+        while True:
+            if attempt and metrics:
+                metrics.count("bulk_retries")
+            if control:
+                control.acquire()
+            self.acquire()
+            t = time.time()
+            try:
+                res = es.bulk(body)
+            except Exception, e:
+                self.release()
+                status = getattr(e, 'status_code', None)
+                if control:
+                    control.release()
+                    control.observe(time.time() - t, rejected=len(
+                                actions(body)) if status == 429 else 0)
+                if metrics:
+                    metrics.observe("bulk_latency", time.time() - t)
+                f, body = self.request_failed(body, status, e, attempt,
+                                                                    metrics)
+            else:
+                self.release()
+                if control:
+                    control.release()
+                    control.observe(time.time() - t,
+                            res.get('took', 0) / 1000.0, rejections(res))
+                if metrics:
+                    metrics.observe("bulk_latency", time.time() - t)
+                i, f, body = self.evaluate(body, res, attempt, metrics)
+                indexed += i
+            failed += f
+            if body is None:
+                return indexed, failed
+            time.sleep(self.delay(attempt))
+            attempt += 1
+
+
+class progress(object):
+    """Thread-safe progress reporting for bulk writes.
+
+       With more than one writer thread, bulk batches complete out of order.
+       Progress is therefore only advanced up to the last batch for which all
+       preceding batches have completed as well (the "watermark"), so the
+       percentage printed never claims documents which are still in flight.
+       For the same reason, the watermark is what gets recorded when a
+       checkpoint is passed (see checkpoint.checkpoint).
+    """
+    def __init__(self, out=sys.stdout, start=0, checkpoint=None,
+                                                                label=None):
+        """Keyword arguments:
+           out        -- stream to print progress to, None for no output
+           start      -- number of the first document expected, e.g. when
+                          resuming from a checkpoint
+           checkpoint -- optional checkpoint.checkpoint instance to save
+                          each time the watermark advances
+           label      -- text to prefix progress w/, e.g. the index name,
+                          for several indices loaded at once
+        """
+        self.__lock    = Lock()
+        self.__out     = out
+        self.__label   = "%s: " % label if label else ""
+        self.__ckpt    = checkpoint
+        self.__pending = {}
+        self.__mark    = start
+        self.__saved   = start
+        self.__read    = 0
+        self.indexed   = 0
+        self.failed    = 0
+
+    def done(self, c_start, c_end, read, total, indexed=None, failed=0,
+                                                                report=True):
+        """Record a completed bulk batch and print progress.
+
+           Arguments:
+           c_start -- number of the first document in the batch
+           c_end   -- number of the document after the last one in the batch
+           read    -- input file offset after the last document of the
+                       batch, or None if no progress should be printed
+           total   -- total input bytes
+
+           Keyword arguments:
+           indexed -- number of documents of the batch indexed successfully,
+                       defaults to all documents but the failed ones
+           failed  -- number of documents of the batch which failed to index
+           report  -- print progress and save the checkpoint; False for
+                       all but the last of several parts of a batch
+        """
+        with self.__lock:
+            if indexed is None:
+                indexed = c_end - c_start - failed
+            self.indexed += indexed
+            self.failed  += failed
+            self.__pending[c_start] = (c_end, read)
+            while self.__mark in self.__pending:
+                self.__mark, rd = self.__pending.pop(self.__mark)
+                if rd:
+                    self.__read = rd
+            if not report:
+                return
+            if self.__mark != self.__saved and self.__ckpt and self.__read:
+                self.__ckpt.save(self.__read, self.__mark)
+                self.__saved = self.__mark
+            if read and self.__out:
+                self.__out.write(
+                        "\r   %s%s %% done (%s of %s KiB, %s documents)"
+                            % (self.__label, self.__read*100/total,
+                                self.__read / 1024, total / 1024,
+                                                                self.__mark))
+                self.__out.flush()
+
+    def summary(self):
+        """Return a one-line summary of indexed and failed documents."""
+        with self.__lock:
+            return "%s documents indexed, %s failed." % (self.indexed,
+                                                                self.failed)
+
+
+def client(writers, hosts=None):
+    """Create an Elasticsearch client to be shared by all writer threads.
+
+       The client's connection pool is sized to hold one connection per
+       writer, so concurrent bulk requests re-use connections instead of
+       opening new ones.
+
+       Arguments:
+       writers -- number of writer threads sharing the client
+
+       Keyword arguments:
+       hosts   -- array of Elasticsearch nodes, defaults to localhost:9200
+    """
+    import elasticsearch
+    return elasticsearch.Elasticsearch(hosts, maxsize=max(writers, 1))
+
+
+def start_writers(target, args, num):
+    """Start a pool of writer threads reading from a shared queue.
+
+       Arguments:
+       target -- writer function, e.g. index_writer()
+       args   -- arguments tuple passed to the writer function
+       num    -- number of threads to start
+
+       Returns:
+       array of Thread instances, to be passed to stop_writers()
+    """
+    threads = [ Thread(target=target, args=args) for i in range(num) ]
+    for t in threads:
+        t.start()
+    return threads
+
+
+def stop_writers(q, threads):
+    """Stop a writer pool started by start_writers() after the queue drained.
+
+       Arguments:
+       q       -- Queue instance the writers read from
+       threads -- array of Thread instances returned by start_writers()
+    """
+    for t in threads:
+        q.put("quit")
+    for t in threads:
+        t.join()
+
+
+class writer_pool(object):
+    """Pool of writer threads reading bulk batches from a bounded queue.
+
+       Batches are queued w/ put(), and stop() waits for all of them to be
+       written; cancel() only for those already being written.
+       asyncbulk.bulk_window offers the same interface w/o a thread per
+       writer.
+    """
+    def __init__(self, q, target, args, num, metrics=None):
+        """Arguments:
+           q      -- Queue instance the writers read from
+           target -- writer function, e.g. index_writer()
+           args   -- arguments tuple passed to the writer function
+           num    -- number of threads to start
+
+           Keyword arguments:
+           metrics -- metrics.stage_metrics instance to record queue waits
+                       in
+        """
+        self.q       = q
+        self.metrics = metrics
+        self.threads = start_writers(target, args, num)
+
+    def put(self, item):
+        """Queue a batch, waiting for a free slot if the queue is full."""
+        if self.metrics:
+            self.metrics.put(self.q, item)
+        else:
+            self.q.put(item)
+
+    def stop(self):
+        """Wait for all batches to be written, and stop the writers."""
+        stop_writers(self.q, self.threads)
+
+    def cancel(self):
+        """Drop the batches still queued, wait for those being written, and
+            stop the writers, e.g. once a load was interrupted. Dropped
+            batches are never reported, so checkpoints stay before them."""
+        try:
+            while True:
+                self.q.get_nowait()
+        except Empty:
+            pass
+        self.stop()
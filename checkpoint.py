@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+#
+# Durable ingestion checkpoints for the movielens / hetrec indexing tools.
+#
+# This file is licensed to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import os
+import json
+import archive
+
+
+class checkpoint(object):
+    """Durable record of how far an input file has been indexed.
+
+       A checkpoint holds the byte offset into the input file up to which all
+       documents have been acknowledged by Elasticsearch, and the number of
+       documents up to that offset. It is stored as a small JSON file per
+       index in a checkpoint directory, and written atomically (write to a
+       temporary file, fsync, rename) so a crash never leaves a truncated
+       checkpoint behind.
+
+       The size and mtime of the input file (of the zip archive for archive
+       members) are stored along with the offset; a checkpoint is ignored
+       when loaded for an input file which changed. Offsets of compressed
+       input files refer to the uncompressed data, see archive.reader.
+    """
+    def __init__(self, cdir, name, fname):
+        """Arguments:
+           cdir  -- checkpoint directory
+           name  -- checkpoint name, usually the index name
+           fname -- input file the checkpoint refers to
+        """
+        self.path   = os.path.join(cdir, "%s.checkpoint" % name)
+        self.fname  = fname
+        self.offset = 0
+        self.docs   = 0
+
+    def __stamp(self):
+        st = archive.stat(self.fname)
+        return st.st_size, int(st.st_mtime)
+
+    def load(self):
+        """Load the checkpoint from disk.
+
+           Returns:
+           True if a valid checkpoint for the (unchanged) input file was
+           loaded, False if indexing needs to start from the beginning.
+        """
+        self.offset = 0
+        self.docs   = 0
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return False
+        if [data.get("size"), data.get("mtime")] != list(self.__stamp()):
+            print "%s: input file %s changed, ignoring checkpoint." % (
+                                                        self.path, self.fname)
+            return False
+        self.offset = data["offset"]
+        self.docs   = data["docs"]
+        return True
+
+    def save(self, offset, docs):
+        """Durably record that all documents up to 'offset' were indexed.
+
+           Arguments:
+           offset -- byte offset into the input file
+           docs   -- number of documents up to 'offset'
+        """
+        size, mtime = self.__stamp()
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"file": self.fname, "size": size, "mtime": mtime,
+                       "offset": offset, "docs": docs}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.path)
+        self.offset = offset
+        self.docs   = docs
+
+    def clear(self):
+        """Remove the checkpoint from disk."""
+        self.offset = 0
+        self.docs   = 0
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def checkpoints(cdir, names, files):
+    """Create a checkpoint instance per input file.
+
+       Arguments:
+       cdir  -- checkpoint directory; created if it does not exist
+       names -- array of checkpoint names
+       files -- array of input files, one per name
+
+       Returns:
+       dict of checkpoint instances, keyed by name
+    """
+    if not os.path.isdir(cdir):
+        os.makedirs(cdir)
+    return dict( (n, checkpoint(cdir, n, f)) for n, f in zip(names, files) )
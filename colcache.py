@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+#
+# Memory-mapped columnar cache of parsed movielens / hetrec data files.
+#
+# This file is licensed to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import os
+import json
+import mmap
+import shutil
+import hashlib
+import numpy
+import archive
+
+from array import array
+from itertools import izip
+
+# Number of rows converted from columns to field arrays at once
+CHUNK_ROWS = 65536
+
+# Column kinds: typecode of the values while building the cache
+KINDS = {"i": "l", "f": "d", "s": "l"}
+
+
+def _save(fname, a):
+    """Save a typed array as .npy file."""
+    if len(a):
+        numpy.save(fname, numpy.frombuffer(a, dtype=a.typecode))
+    else:
+        numpy.save(fname, numpy.zeros(0, dtype=a.typecode))
+
+
+class table(object):
+    """Columnar cache of a data file w/ one record per line.
+
+       Each line is split into fields by a separator, the same way the
+       indexing tools do, and each field is stored in a column according to
+       its kind:
+        "i" -- integer, stored as int64 .npy array
+        "f" -- float, stored as float64 .npy array
+        "s" -- string, stored as a blob file of all values, each terminated
+               by a newline, plus an int64 .npy array of value offsets into
+               the blob
+       Byte offsets after each line and line numbers are kept as well, so
+       consumers can keep track of progress and checkpoints in terms of the
+       data file. Compressed data files (see archive.reader) are cached
+       w/ offsets of the uncompressed data; 'bytes' is the uncompressed size.
+
+       The cache is built once and memory-mapped by later runs. It is
+       re-built whenever the data file's size or mtime, the separator, or
+       the column kinds change. Lines w/ integer or float fields which do
+       not parse, e.g. header lines, are not cached.
+    """
+    def __init__(self, fname, sep, kinds, cdir):
+        """Arguments:
+           fname -- data file name
+           sep   -- field separator, e.g. "::" or "\\t"
+           kinds -- string of column kinds, one character per field; see
+                     above. Fields beyond the last kind are dropped.
+           cdir  -- cache directory; created if it does not exist
+        """
+        self.fname = fname
+        self.sep   = sep
+        self.kinds = kinds
+        self.path  = os.path.join(cdir, "%s-%s" % (os.path.basename(fname),
+                        hashlib.md5(os.path.abspath(fname)).hexdigest()[:8]))
+        st = archive.stat(fname)
+        self.__meta = {"file": os.path.abspath(fname), "size": st.st_size,
+                       "mtime": int(st.st_mtime), "sep": sep, "kinds": kinds}
+        if not self.__valid():
+            self.__build()
+        self.__load()
+
+    def __blob(self, i):
+        return os.path.join(self.path, "c%d.blob" % i)
+
+    def __valid(self):
+        try:
+            with open(os.path.join(self.path, "meta.json")) as f:
+                meta = json.load(f)
+        except (IOError, ValueError):
+            return False
+        rows = meta.pop("rows", None)
+        self.bytes = meta.pop("bytes", None)
+        return None not in (rows, self.bytes) and meta == self.__meta
+
+    def __build(self):
+        """Parse the data file and write all columns."""
+        print "Building cache of %s in %s." % (self.fname, self.path)
+        tmp = self.path + ".tmp"
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+
+        conv    = { "i": int, "f": float, "s": str }
+        convs   = [ conv[k] for k in self.kinds ]
+        cols    = [ array(KINDS[k]) for k in self.kinds ]
+        blobs   = [ open(os.path.join(tmp, "c%d.blob" % i), "wb")
+                        if k == "s" else None
+                                    for i, k in enumerate(self.kinds) ]
+        for i, k in enumerate(self.kinds):
+            if k == "s":
+                cols[i].append(0)
+        ends    = array('l')
+        lines   = array('l')
+        nfields = array('b')
+        rd      = 0
+        lnum    = 0
+        skipped = 0
+        with archive.reader(self.fname) as f:
+            for line in f:
+                rd   += len(line)
+                lnum += 1
+                fields = line.strip().split(self.sep)[:len(self.kinds)]
+                try:
+                    vals = [ c(v) for c, v in izip(convs, fields) ]
+                except ValueError:
+                    skipped += 1
+                    continue
+                for i, k in enumerate(self.kinds):
+                    if k == "s":
+                        v = fields[i] if i < len(fields) else ""
+                        blobs[i].write(v + "\n")
+                        cols[i].append(cols[i][-1] + len(v) + 1)
+                    else:
+                        cols[i].append(vals[i] if i < len(vals) else 0)
+                ends.append(rd)
+                lines.append(lnum)
+                nfields.append(len(fields))
+
+        for i, k in enumerate(self.kinds):
+            _save(os.path.join(tmp, "c%d.npy" % i), cols[i])
+            if blobs[i]:
+                blobs[i].close()
+        _save(os.path.join(tmp, "ends.npy"), ends)
+        _save(os.path.join(tmp, "lines.npy"), lines)
+        _save(os.path.join(tmp, "nfields.npy"), nfields)
+        with open(os.path.join(tmp, "meta.json"), "w") as f:
+            json.dump(dict(self.__meta, rows=len(ends), bytes=rd), f)
+        self.bytes = rd
+
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.rename(tmp, self.path)
+        if skipped:
+            print "   skipped %s lines which did not parse." % skipped
+
+    def __load(self):
+        """Memory-map all columns."""
+        def load(fname):
+            fname = os.path.join(self.path, fname)
+            try:
+                return numpy.load(fname, mmap_mode='r')
+            except ValueError:
+                # Empty arrays can not be memory-mapped
+                return numpy.load(fname)
+        self.__ends    = load("ends.npy")
+        self.__lines   = load("lines.npy")
+        self.__nfields = load("nfields.npy")
+        self.__cols    = [ load("c%d.npy" % i)
+                                for i in range(len(self.kinds)) ]
+        self.__blobs   = []
+        for i, k in enumerate(self.kinds):
+            blob = ""
+            if k == "s" and os.path.getsize(self.__blob(i)):
+                with open(self.__blob(i), "rb") as f:
+                    blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.__blobs.append(blob)
+
+    def __len__(self):
+        return len(self.__ends)
+
+    def column(self, i):
+        """Return the (memory-mapped) numpy array of an "i" or "f" column."""
+        return self.__cols[i]
+
+    def __values(self, i, a, b):
+        """Return the values of column 'i', rows a to b, as strings."""
+        if self.kinds[i] == "i":
+            return map(str, self.__cols[i][a:b].tolist())
+        if self.kinds[i] == "f":
+            return [ "%g" % v for v in self.__cols[i][a:b].tolist() ]
+        off = self.__cols[i]
+        return self.__blobs[i][int(off[a]):int(off[b]) - 1].split("\n")
+
+    def rows(self, start=0):
+        """Return a generator for the rows of the cache.
+
+           Rows are returned as (fields, end-offset, line-number) tuples;
+           'fields' is the tuple of field strings, as if the line was split
+           by the separator, 'end-offset' is the byte offset following the
+           line in the data file.
+
+           Keyword arguments:
+           start -- byte offset into the data file; only lines ending after
+                     'start' are returned
+        """
+        n = len(self)
+        first = int(numpy.searchsorted(self.__ends, start, side='right'))
+        for a in xrange(first, n, CHUNK_ROWS):
+            b = min(a + CHUNK_ROWS, n)
+            rows = zip(*[ self.__values(i, a, b)
+                                    for i in range(len(self.kinds)) ])
+            nflds = self.__nfields[a:b]
+            if nflds.min() < len(self.kinds):
+                rows = [ r[:nf] for r, nf in izip(rows, nflds.tolist()) ]
+            for row in izip(rows, self.__ends[a:b].tolist(),
+                                        self.__lines[a:b].tolist()):
+                yield row
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+#
+# Export of the bulk bodies of the movielens indexing tools to sharded
+#  NDJSON files, for replaying them into any number of clusters w/o parsing
+#  the data sets again, see replay.py.
+#
+# This file is licensed to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import gzip
+import io
+import json
+import os
+import bulk
+
+from Queue import Empty, Queue
+from threading import Lock, Thread
+
+# List of the streams of an export, one JSON line per stream, in the order
+#  the streams were completed
+STREAMS_FILE = "streams.jsonl"
+
+# Shard file name of a stream
+SHARD_NAME = "%s-%03d.ndjson"
+
+# Compression level of gzip'ed shards; 6 is about as small as 9, and twice
+#  as fast
+GZIP_LEVEL = 6
+
+
+class bulk_export(object):
+    """Directory of exported bulk bodies.
+
+       Each writer pool of an index (a "stream", e.g. the 'movies'
+       documents, or the statistics updates of them later on) writes its
+       bulk bodies to 'shards' files, see shard_writer. Once a stream is
+       complete, it is added to STREAMS_FILE; replay.py replays streams in
+       that order, so updates follow the documents they update.
+    """
+    def __init__(self, directory, shards=4, compress=False):
+        """Arguments:
+           directory -- directory to write the export to; an export in it
+                         is replaced
+
+           Keyword arguments:
+           shards    -- number of files (and writer threads) per stream
+           compress  -- gzip the shard files
+        """
+        self.directory = directory
+        self.shards    = shards
+        self.compress  = compress
+        self.__names   = set()
+        self.__lock    = Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        open(os.path.join(directory, STREAMS_FILE), "w").close()
+
+    def pool(self, index, prog, qlen=50, metrics=None):
+        """Return a shard_writer for a stream of bulk bodies of 'index'.
+
+           Streams are named after their index; further streams of the same
+           index are numbered, e.g. "movies-2".
+
+           Arguments:
+           index -- Elasticsearch index the bodies write to
+           prog  -- bulk.progress instance to report written bodies to
+
+           Keyword arguments:
+           qlen    -- max number of bodies queued for the writer threads
+           metrics -- metrics.stage_metrics instance to record queue waits
+                       in
+        """
+        with self.__lock:
+            stream, n = index, 1
+            while stream in self.__names:
+                n += 1
+                stream = "%s-%d" % (index, n)
+            self.__names.add(stream)
+        return shard_writer(self, stream, index, prog, qlen, metrics)
+
+    def open(self, fname):
+        """Open shard file 'fname' of the export for writing."""
+        path = os.path.join(self.directory, fname)
+        if self.compress:
+            return gzip.GzipFile(path, "wb", GZIP_LEVEL)
+        return open(path, "wb")
+
+    def completed(self, stream):
+        """Add the dict of a complete stream to STREAMS_FILE."""
+        with self.__lock:
+            with open(os.path.join(self.directory, STREAMS_FILE), "a") as f:
+                f.write(json.dumps(stream, sort_keys=True) + "\n")
+
+
+class shard_writer(object):
+    """Writes the bulk bodies of a stream to the shard files of an export.
+
+       Offers the interface of bulk.writer_pool: bodies are queued w/ put(),
+       stop() waits for all of them to be written, and cancel() drops those
+       still queued. Each shard file has a writer thread of its own taking
+       bodies from the shared queue, so shards are about equal in size, and
+       gzip (which releases the GIL) compresses several shards at once.
+       Bodies are reported to the progress once written. The documents of a
+       stream are counted by their actions, as document numbers include
+       lines which are skipped, e.g. w/ --sample.
+    """
+    def __init__(self, export, stream, index, prog, qlen=50, metrics=None):
+        """Arguments:
+           export -- bulk_export instance
+           stream -- stream name, see bulk_export.pool()
+           index  -- Elasticsearch index the bodies write to
+           prog   -- bulk.progress instance to report written bodies to
+
+           Keyword arguments:
+           qlen, metrics -- see bulk_export.pool()
+        """
+        self.export  = export
+        self.stream  = stream
+        self.index   = index
+        self.prog    = prog
+        self.metrics = metrics
+        self.q       = Queue(maxsize=qlen)
+        self.files   = [ SHARD_NAME % (stream, k)
+                            + (".gz" if export.compress else "")
+                                            for k in range(export.shards) ]
+        self.docs    = 0
+        self.bytes   = 0
+        self.__lock  = Lock()
+        self.threads = [ Thread(target=self.__write, args=(f,))
+                                                    for f in self.files ]
+        for t in self.threads:
+            t.start()
+
+    def __write(self, fname):
+        with self.export.open(fname) as f:
+            while True:
+                data = self.metrics.get(self.q) if self.metrics \
+                                                        else self.q.get()
+                if data == "quit":
+                    break
+                c_start, c_end, body, read, total = data
+                f.write(body)
+                docs = len(bulk.actions(body))
+                with self.__lock:
+                    self.docs  += docs
+                    self.bytes += len(body)
+                self.prog.done(c_start, c_end, read, total)
+
+    def put(self, item):
+        """Queue a batch, see bulk.writer_pool.put()."""
+        if self.metrics:
+            self.metrics.put(self.q, item)
+        else:
+            self.q.put(item)
+
+    def stop(self):
+        """Wait for all batches to be written, close the shard files, and
+            add the stream to the export."""
+        bulk.stop_writers(self.q, self.threads)
+        self.export.completed({"stream": self.stream, "index": self.index,
+                               "files": self.files, "docs": self.docs,
+                               "bytes": self.bytes})
+
+    def cancel(self):
+        """Drop the batches still queued, and close the shard files w/o
+            adding the incomplete stream to the export."""
+        try:
+            while True:
+                self.q.get_nowait()
+        except Empty:
+            pass
+        bulk.stop_writers(self.q, self.threads)
+
+
+def streams(directory):
+    """Return the streams of the export in 'directory', in the order they
+        were completed: array of dicts w/ the "stream" and "index" name,
+        shard "files", and the number of "docs" and (uncompressed) "bytes".
+    """
+    with open(os.path.join(directory, STREAMS_FILE)) as f:
+        return [ json.loads(line) for line in f if line.strip() ]
+
+
+def shard_actions(path):
+    """Return a generator for the (action-line, source-line) tuples of an
+        exported shard file, w/o line endings, see bulk.actions().
+
+       Arguments:
+       path -- shard file path; gzip'ed if it ends in ".gz"
+    """
+    if path.endswith(".gz"):
+        f = io.BufferedReader(gzip.GzipFile(path, "rb"), 1024 * 1024)
+    else:
+        f = open(path, "rb", 1024 * 1024)
+    with f:
+        for line in f:
+            action = line.rstrip("\n")
+            if not action:
+                continue
+            if action.lstrip("{ ").startswith('"delete"'):
+                yield action, None
+            else:
+                yield action, f.next().rstrip("\n")
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+#
+# External sort / group-by w/ bounded memory, used to aggregate the 'users'
+#  index from ratings in arbitrary order.
+#
+# This file is licensed to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import os
+import shutil
+import heapq
+import tempfile
+
+from itertools import groupby
+
+# Estimated per-record overhead of an in-memory record tuple, in bytes
+RECORD_OVERHEAD = 96
+
+
+def _read_run(fname):
+    """Return a generator for the (key, seq, value) records of a run file."""
+    with open(fname) as f:
+        for line in f:
+            key, seq, value = line.rstrip("\n").split("\t", 2)
+            yield int(key), int(seq), value
+
+
+def _write_run(fname, records):
+    """Write (key, seq, value) records to a run file."""
+    with open(fname, "w") as f:
+        for rec in records:
+            f.write("%d\t%d\t%s\n" % rec)
+
+
+class external_sort(object):
+    """Group (key, value) records by key w/ bounded memory.
+
+       Records are collected in memory until their estimated size exceeds
+       'max_bytes'. The records are then sorted by key and spilled to a run
+       file on disk. groups() k-way merges all runs (and the records still
+       in memory) and returns the values of each key, in key order. Values
+       of the same key are returned in the order they were added.
+
+       Keys must be integers; values must not contain newlines.
+    """
+    def __init__(self, max_bytes=256*1024*1024, tmpdir=None, fan_in=64):
+        """Keyword arguments:
+           max_bytes -- memory budget for records held in memory
+           tmpdir    -- directory to create the spill directory in
+           fan_in    -- max number of runs merged (and files open) at once
+        """
+        self.max_bytes = max_bytes
+        self.fan_in    = fan_in
+        self.__tmpdir  = tempfile.mkdtemp(prefix="extsort-", dir=tmpdir)
+        self.__recs    = []
+        self.__size    = 0
+        self.__seq     = 0
+        self.__runs    = []
+
+    def add(self, key, value):
+        """Add a record.
+
+           Arguments:
+           key   -- integer key to group by
+           value -- value string
+        """
+        self.__recs.append((key, self.__seq, value))
+        self.__seq  += 1
+        self.__size += len(value) + RECORD_OVERHEAD
+        if self.__size >= self.max_bytes:
+            self.__spill()
+
+    def __new_run(self):
+        return os.path.join(self.__tmpdir, "run-%06d" % len(self.__runs))
+
+    def __spill(self):
+        """Sort the in-memory records and write them to a new run file."""
+        self.__recs.sort()
+        fname = self.__new_run()
+        _write_run(fname, self.__recs)
+        self.__runs.append(fname)
+        self.__recs = []
+        self.__size = 0
+
+    def runs(self):
+        """Return the number of runs spilled to disk so far."""
+        return len(self.__runs)
+
+    def groups(self):
+        """Return a generator for (key, [values]) tuples in key order.
+
+           Temporary files are removed once the generator is exhausted or
+           closed; records can not be added afterwards.
+        """
+        try:
+            # Reduce the number of runs until all can be merged at once
+            while len(self.__runs) > self.fan_in:
+                merge, self.__runs = (self.__runs[:self.fan_in],
+                                        self.__runs[self.fan_in:])
+                fname = self.__new_run() + "-merged"
+                _write_run(fname, heapq.merge(*[ _read_run(r)
+                                                        for r in merge ]))
+                for r in merge:
+                    os.remove(r)
+                self.__runs.append(fname)
+
+            self.__recs.sort()
+            merged = heapq.merge(iter(self.__recs),
+                                 *[ _read_run(r) for r in self.__runs ])
+            for key, recs in groupby(merged, lambda r: r[0]):
+                yield key, [ r[2] for r in recs ]
+        finally:
+            self.close()
+
+    def close(self):
+        """Remove all temporary files."""
+        self.__recs = []
+        self.__runs = []
+        shutil.rmtree(self.__tmpdir, ignore_errors=True)
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+#
+# Synthetic MovieLens / hetrec data set generator for benchmarking the
+#  indexing tools w/o downloading the real data sets.
+#
+# This file is licensed to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import argparse
+import random
+import os
+
+# Proportions of the MovieLens 10M data set, per rating
+RATINGS_PER_USER  = 143
+RATINGS_PER_MOVIE = 936
+RATINGS_PER_TAG   = 105
+
+GENRES = ("Action", "Adventure", "Animation", "Children", "Comedy", "Crime",
+          "Documentary", "Drama", "Fantasy", "Film-Noir", "Horror", "IMAX",
+          "Musical", "Mystery", "Romance", "Sci-Fi", "Thriller", "War",
+          "Western")
+
+WORDS = ("dark", "funny", "classic", "twist", "space", "murder", "love",
+         "war", "music", "robots", "zombies", "heist", "family", "revenge",
+         "dystopia", "satire", "based on a book", "atmospheric", "quirky",
+         "Oscar (Best Picture)", "visually appealing", "slow")
+
+# A few latin1 characters, as found in the hetrec data set
+NAMES = ("Anna", "Bj\xf6rn", "Carlos", "Dana", "\xc9mile", "Fran\xe7ois",
+         "Greta", "Hans", "In\xe9s", "Jos\xe9", "Kim", "Lu\xeds", "Mar\xeda")
+
+COUNTRIES = ("USA", "UK", "France", "Germany", "Italy", "Japan", "Spain")
+
+HETREC_RT_FIELDS = ("rtAllCriticsRating", "rtAllCriticsNumReviews",
+                    "rtAllCriticsNumFresh", "rtAllCriticsNumRotten",
+                    "rtAllCriticsScore", "rtTopCriticsRating",
+                    "rtTopCriticsNumReviews", "rtTopCriticsNumFresh",
+                    "rtTopCriticsNumRotten", "rtTopCriticsScore",
+                    "rtAudienceRating", "rtAudienceNumRatings",
+                    "rtAudienceScore", "rtPictureURL")
+
+
+def scale(s):
+    """Parse a number w/ an optional K or M suffix, e.g. "10M"."""
+    s = s.strip().upper()
+    mult = {"K": 1000, "M": 1000 * 1000}.get(s[-1:], 1)
+    return int(float(s.rstrip("KM")) * mult)
+
+
+def title(rnd, movie):
+    """Return a random movie title."""
+    return "%s %s %s" % (rnd.choice(WORDS).capitalize(), rnd.choice(WORDS),
+                                                                    movie)
+
+
+def skewed(rnd, n):
+    """Return a random number 1..n; small numbers are a lot more likely,
+        similar to the popularity of movies."""
+    return int(n * rnd.random() ** 2) + 1
+
+
+def gen_movies(rnd, fname, movies):
+    """Write 'movies.dat': MovieID::Title (Year)::Genre|Genre..."""
+    with open(fname, "wb") as f:
+        for m in xrange(1, movies + 1):
+            f.write("%d::%s (%d)::%s\n" % (m, title(rnd, m),
+                        rnd.randint(1920, 2009),
+                        "|".join(rnd.sample(GENRES, rnd.randint(1, 3)))))
+
+
+def gen_ratings(rnd, fname, ratings, movies):
+    """Write 'ratings.dat', sorted by UserID like the original:
+        UserID::MovieID::Rating::Timestamp
+
+       Returns:
+       number of users
+    """
+    stars = ("0.5", "1", "1.5", "2", "2.5", "3", "3.5", "4", "4.5", "5")
+    weights = (1, 3, 1, 8, 4, 23, 9, 29, 8, 14)
+    choices = [ s for s, w in zip(stars, weights) for i in range(w) ]
+    user = 0
+    left = ratings
+    with open(fname, "wb") as f:
+        while left > 0:
+            user += 1
+            n = min(left, movies,
+                    max(20, int(rnd.expovariate(1.0 / RATINGS_PER_USER))))
+            left -= n
+            rated = set()
+            while len(rated) < n:
+                rated.add(skewed(rnd, movies))
+            ts = rnd.randint(789652009, 1231131736)
+            lines = []
+            for m in rated:
+                ts += rnd.randint(0, 600)
+                lines.append("%d::%d::%s::%d\n" % (user, m,
+                                                    rnd.choice(choices), ts))
+            f.write("".join(lines))
+    return user
+
+
+def gen_tags(rnd, fname, tags, users, movies):
+    """Write 'tags.dat', sorted by UserID:
+        UserID::MovieID::Tag::Timestamp
+    """
+    per_user = {}
+    for i in xrange(tags):
+        u = rnd.randint(1, users)
+        per_user[u] = per_user.get(u, 0) + 1
+    with open(fname, "wb") as f:
+        for u in sorted(per_user):
+            ts = rnd.randint(1137202000, 1231131736)
+            for i in xrange(per_user[u]):
+                ts += rnd.randint(1, 600)
+                f.write("%d::%d::%s::%d\n" % (u, skewed(rnd, movies),
+                                                    rnd.choice(WORDS), ts))
+
+
+def gen_hetrec(rnd, outdir, movies):
+    """Write the hetrec 'movies.dat', 'movie_*.dat', and 'tags.dat' files.
+        hetrec files are tab-separated, w/ a header line, latin1-encoded,
+        and sorted by movieID.
+    """
+    def tsv(name, header, rows):
+        with open(os.path.join(outdir, name), "wb") as f:
+            f.write("\t".join(header) + "\n")
+            for r in rows:
+                f.write("\t".join(map(str, r)) + "\n")
+
+    def person(i):
+        return "%s %s%d" % (NAMES[i % len(NAMES)], rnd.choice(NAMES), i)
+
+    tsv("movies.dat", ("id", "title", "imdbID", "spanishTitle",
+                        "imdbPictureURL", "year", "rtID") + HETREC_RT_FIELDS,
+        ( [ m, title(rnd, m), 100000 + m, "T\xedtulo %d" % m,
+            "http://ia.media-imdb.com/images/%d.jpg" % m,
+            rnd.randint(1920, 2009), "movie_%d" % m ]
+          + [ rnd.randint(0, 100) for f in HETREC_RT_FIELDS[:-1] ]
+          + [ "http://content.rottentomatoes.com/%d.jpg" % m ]
+                                            for m in xrange(1, movies + 1) ))
+    tsv("movie_actors.dat", ("movieID", "actorID", "actorName", "ranking"),
+        ( (m, "actor_%d" % a, person(a), r + 1)
+                for m in xrange(1, movies + 1)
+                for r, a in enumerate(rnd.sample(xrange(movies * 5),
+                                                 rnd.randint(4, 20))) ))
+    tsv("movie_countries.dat", ("movieID", "country"),
+        ( (m, rnd.choice(COUNTRIES)) for m in xrange(1, movies + 1) ))
+    tsv("movie_directors.dat", ("movieID", "directorID", "directorName"),
+        ( (m, "director_%d" % d, person(d)) for m in xrange(1, movies + 1)
+                                    for d in [ rnd.randint(0, movies) ] ))
+    tsv("movie_genres.dat", ("movieID", "genre"),
+        ( (m, g) for m in xrange(1, movies + 1)
+                    for g in rnd.sample(GENRES, rnd.randint(1, 3)) ))
+    tsv("movie_locations.dat", ("movieID", "location1", "location2",
+                                "location3", "location4"),
+        ( [ m, rnd.choice(COUNTRIES), "City %d" % rnd.randint(1, 500) ]
+              + [ "", "Street %d" % l ][:rnd.randint(0, 2)]
+                for m in xrange(1, movies + 1)
+                for l in range(rnd.randint(0, 3)) ))
+    tsv("movie_tags.dat", ("movieID", "tagID", "tagWeight"),
+        ( (m, t, rnd.randint(1, 20)) for m in xrange(1, movies + 1)
+                for t in sorted(rnd.sample(xrange(1, len(WORDS) + 1),
+                                           rnd.randint(0, 10))) ))
+    tsv("tags.dat", ("id", "value"),
+        ( (i + 1, w) for i, w in enumerate(WORDS) ))
+
+
+def generate(outdir, ratings, seed=42, hetrec=True):
+    """Generate a synthetic data set.
+
+       The MovieLens files are written to 'outdir', the hetrec files to
+       'outdir'/hetrec. Numbers of users, movies, and tags are derived from
+       the number of ratings, using the proportions of MovieLens 10M. The
+       same seed always generates the same data set.
+
+       Arguments:
+       outdir  -- output directory; created if it does not exist
+       ratings -- number of ratings to generate
+
+       Keyword arguments:
+       seed   -- random seed
+       hetrec -- also generate the hetrec files
+    """
+    rnd = random.Random(seed)
+    movies = max(20, ratings / RATINGS_PER_MOVIE)
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    print "Generating %s ratings of %s movies in %s." % (ratings, movies,
+                                                                    outdir)
+    gen_movies(rnd, os.path.join(outdir, "movies.dat"), movies)
+    users = gen_ratings(rnd, os.path.join(outdir, "ratings.dat"), ratings,
+                                                                    movies)
+    gen_tags(rnd, os.path.join(outdir, "tags.dat"),
+                                ratings / RATINGS_PER_TAG, users, movies)
+    if hetrec:
+        hdir = os.path.join(outdir, "hetrec")
+        if not os.path.isdir(hdir):
+            os.makedirs(hdir)
+        gen_hetrec(rnd, hdir, movies)
+
+
+def cmdl_args():
+    """Parse command line arguments
+
+       Returns
+        argparse instance ready to use
+    """
+    parser = argparse.ArgumentParser(
+                description='Generate a synthetic movielens + hetrec'
+                 + ' formatted data set.')
+    parser.add_argument('--out', metavar='dir', dest='out', default='.',
+        help='Directory to write the data set to.')
+    parser.add_argument('--ratings', metavar='ratings', dest='ratings',
+        default='1M', type=scale,
+        help='Number of ratings, e.g. 1M, 10M, or 100M (default: 1M).')
+    parser.add_argument('--seed', metavar='seed', type=int, dest='seed',
+        default=42, help='Random seed (default: 42).')
+    parser.add_argument('--no-hetrec', action='store_false', dest='hetrec',
+        help='Do not generate the hetrec files.')
+
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    """ This script generates 'movies.dat', 'ratings.dat', and 'tags.dat' in
+        MovieLens 10M format, and the hetrec 2011 'movies.dat',
+        'movie_*.dat', and 'tags.dat' files in a 'hetrec' sub-directory.
+        Use the result w/ post_movies.py --lens and post_movie_details.py
+        --datadir, e.g. for benchmarks (see benchmark.py).
+    """
+    args = cmdl_args()
+    generate(args.out, args.ratings, args.seed, args.hetrec)
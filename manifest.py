@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+#
+# Content hash manifests for incremental re-indexing of movielens data.
+#
+# This file is licensed to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import os
+import struct
+import hashlib
+
+
+def content_hash(source):
+    """Return a 64 bit hash of a document source string."""
+    return struct.unpack("<q", hashlib.md5(source).digest()[:8])[0]
+
+
+class manifest(object):
+    """Per-index record of document IDs and content hashes.
+
+       A manifest remembers the content hash of every document indexed by
+       the last complete run. During a run, changed() is called for every
+       document; it records the document's new hash and tells whether the
+       document was added or modified since the last run. IDs of the last
+       run which were not seen again are returned by removed().
+
+       Manifests are stored as text files with one "ID<TAB>hash" line per
+       document, and replaced atomically by save(). A run which failed to
+       index documents must not save its manifest, or the next run would
+       take them for indexed.
+    """
+    def __init__(self, mdir, name):
+        """Arguments:
+           mdir -- manifest directory; created if it does not exist
+           name -- manifest name, usually the index name
+        """
+        if not os.path.isdir(mdir):
+            os.makedirs(mdir)
+        self.path  = os.path.join(mdir, "%s.manifest" % name)
+        self.__old = {}
+        self.__new = {}
+
+    def load(self):
+        """Load the manifest of the last run.
+
+           Returns:
+           number of documents in the manifest, 0 if there is none
+        """
+        self.__old = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                for line in f:
+                    doc_id, h = line.rstrip("\n").split("\t")
+                    self.__old[doc_id] = int(h)
+        return len(self.__old)
+
+    def changed(self, doc_id, source):
+        """Record a document and return True if it is new or changed.
+
+           Arguments:
+           doc_id -- document ID
+           source -- document source string
+        """
+        h = content_hash(source)
+        self.__new[doc_id] = h
+        return self.__old.pop(doc_id, None) != h
+
+    def removed(self):
+        """Return the IDs of documents of the last run not seen since."""
+        return self.__old.keys()
+
+    def save(self):
+        """Write the documents seen in this run as the new manifest."""
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            for doc_id, h in self.__new.iteritems():
+                f.write("%s\t%s\n" % (doc_id, h))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.path)
+
+    def clear(self):
+        """Remove the manifest from disk, e.g. once the index was loaded
+            w/o it, so the next run sends all documents."""
+        self.__old = {}
+        self.__new = {}
+        if os.path.exists(self.path):
+            os.remove(self.path)
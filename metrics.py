@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+#
+# Pipeline stage metrics of the movielens / hetrec indexing tools, and their
+#  export to JSON-lines and Prometheus textfiles.
+#
+# This file is licensed to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import os
+import time
+import json
+
+from threading import Thread, Lock, Event
+
+# Timers reported by summary(), in pipeline order
+STAGES = ("parse", "serialize", "queue_put_wait", "queue_get_wait",
+          "bulk_latency", "bulk_took")
+
+
+class stage_metrics(object):
+    """Thread-safe counters, timers, and gauges of a single index run.
+
+       Timers accumulate the number of observations, their sum, and their
+       maximum, in seconds. Gauges keep their last and their maximum value.
+       Bulk item errors are counted per HTTP status.
+
+       Pipeline stages are timed as follows:
+        parse          -- reading, splitting, and formatting documents,
+                          including parser callbacks
+        serialize      -- assembling bulk request bodies
+        queue_put_wait -- parser blocked on a full bulk queue
+        queue_get_wait -- writers waiting for bulk bodies
+        bulk_latency   -- bulk requests, as seen by the client
+        bulk_took      -- bulk requests, as reported by Elasticsearch
+    """
+    def __init__(self, index, exporter=None):
+        """Arguments:
+           index -- name of the index, used as label of exported values
+
+           Keyword arguments:
+           exporter -- exporter instance to notify when the run finishes
+        """
+        self.index    = index
+        self.exporter = exporter
+        self.started  = time.time()
+        self.finished = None
+        self.__lock   = Lock()
+        self.counters = {}
+        self.timers   = {}
+        self.gauges   = {}
+        self.errors   = {}
+
+    def count(self, name, n=1):
+        """Add 'n' to counter 'name'."""
+        with self.__lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, seconds, n=1):
+        """Add 'n' observations, taking 'seconds' in total, to timer
+            'name'."""
+        with self.__lock:
+            t = self.timers.setdefault(name, [0, 0.0, 0.0])
+            t[0] += n
+            t[1] += seconds
+            t[2]  = max(t[2], seconds / n if n else 0)
+
+    def gauge(self, name, value):
+        """Set gauge 'name' to 'value'."""
+        with self.__lock:
+            self.gauges[name] = value
+            self.gauges[name + "_max"] = max(value,
+                                        self.gauges.get(name + "_max", value))
+
+    def error(self, status, n=1):
+        """Count 'n' bulk items which failed w/ HTTP status 'status'."""
+        with self.__lock:
+            self.errors[status] = self.errors.get(status, 0) + n
+
+    def timed(self, lines, name="parse"):
+        """Wrap a generator, adding the time spent in it to timer 'name'."""
+        it = iter(lines)
+        while True:
+            t = time.time()
+            try:
+                ret = it.next()
+            except StopIteration:
+                return
+            self.observe(name, time.time() - t)
+            yield ret
+
+    def put(self, q, item):
+        """Put 'item' into Queue 'q', timing the wait for a free slot and
+            recording the queue depth."""
+        t = time.time()
+        q.put(item)
+        self.observe("queue_put_wait", time.time() - t)
+        self.gauge("queue_depth", q.qsize())
+
+    def get(self, q):
+        """Get an item from Queue 'q', timing the wait for it."""
+        t = time.time()
+        ret = q.get()
+        self.observe("queue_get_wait", time.time() - t)
+        return ret
+
+    def finish(self):
+        """Mark the index run as finished, and have its final values
+            exported."""
+        self.finished = time.time()
+        if self.exporter:
+            self.exporter.write()
+
+    def snapshot(self):
+        """Return a dict of all current values."""
+        with self.__lock:
+            return {"index": self.index, "time": time.time(),
+                    "elapsed": (self.finished or time.time()) - self.started,
+                    "finished": self.finished is not None,
+                    "counters": dict(self.counters),
+                    "timers": dict( (k, {"count": v[0], "sum": v[1],
+                                         "max": v[2]})
+                                            for k, v in self.timers.items() ),
+                    "gauges": dict(self.gauges),
+                    "errors": dict( (str(k), v)
+                                            for k, v in self.errors.items() )}
+
+    def summary(self):
+        """Return a multi-line summary of stage times and bulk errors."""
+        s = self.snapshot()
+        t = s["timers"]
+        ret = [ "%s: %.1f s total" % (self.index, s["elapsed"]) ]
+        ret.append(", ".join([ "%s %.1f s" % (k, t[k]["sum"])
+                                            for k in STAGES if k in t ]))
+        if "bulk_latency" in t and t["bulk_latency"]["count"]:
+            b = t["bulk_latency"]
+            ret.append("%s bulk requests, latency avg %.3f s max %.3f s,"
+                       " queue depth max %s" % (b["count"],
+                            b["sum"] / b["count"], b["max"],
+                            s["gauges"].get("queue_depth_max", 0)))
+        if s["errors"]:
+            ret.append("item errors: " + ", ".join([ "%s x %s" % (v, k)
+                                    for k, v in sorted(s["errors"].items()) ]))
+        return "\n   ".join(ret)
+
+
+class exporter(object):
+    """Periodic export of stage_metrics to files.
+
+       Every 'interval' seconds, and whenever an index run finishes (see
+       stage_metrics.finish()), a snapshot of each running index run (see
+       stage_metrics.snapshot()) is appended to a JSON-lines file, and a
+       Prometheus textfile (e.g. for the node_exporter textfile collector)
+       is re-written w/ the current values of all index runs, labeled by
+       index.
+    """
+    def __init__(self, jsonl=None, textfile=None, interval=10,
+                                                        prefix="movielens"):
+        """Keyword arguments:
+           jsonl    -- JSON-lines file to append snapshots to
+           textfile -- Prometheus textfile to write; replaced atomically
+           interval -- export interval, in seconds
+           prefix   -- prefix of Prometheus metric names
+        """
+        self.jsonl    = jsonl
+        self.textfile = textfile
+        self.interval = interval
+        self.prefix   = prefix
+        self.__runs   = []
+        self.__lock   = Lock()
+        self.__stop   = Event()
+        self.__thread = Thread(target=self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def metrics(self, index):
+        """Return a new stage_metrics instance for an index run, exported
+            from now on."""
+        m = stage_metrics(index, self)
+        with self.__lock:
+            self.__runs.append([m, False])
+        return m
+
+    def __run(self):
+        while not self.__stop.wait(self.interval):
+            self.write()
+
+    def write(self):
+        """Export all index runs now."""
+        with self.__lock:
+            snaps = []
+            for run in self.__runs:
+                if not run[1]:
+                    snaps.append(run[0].snapshot())
+                    run[1] = snaps[-1]["finished"]
+            everything = [ run[0].snapshot() for run in self.__runs ]
+            if self.jsonl and snaps:
+                with open(self.jsonl, "a") as f:
+                    for s in snaps:
+                        f.write(json.dumps(s) + "\n")
+            if self.textfile:
+                self.__write_textfile(everything)
+
+    def __write_textfile(self, snaps):
+        samples = {}
+        def add(name, kind, labels, value):
+            samples.setdefault((name, kind), []).append((labels, value))
+        for s in snaps:
+            lbl = 'index="%s"' % s["index"]
+            add("run_elapsed_seconds", "gauge", lbl, s["elapsed"])
+            add("run_finished", "gauge", lbl, int(s["finished"]))
+            for k, v in s["counters"].items():
+                add(k + "_total", "counter", lbl, v)
+            for k, v in s["timers"].items():
+                add(k + "_seconds", "summary", lbl, v)
+                add(k + "_seconds_max", "gauge", lbl, v["max"])
+            for k, v in s["gauges"].items():
+                add(k, "gauge", lbl, v)
+            for k, v in s["errors"].items():
+                add("bulk_item_errors_total", "counter",
+                                            lbl + ',status="%s"' % k, v)
+
+        lines = []
+        for (name, kind), values in sorted(samples.items()):
+            name = "%s_%s" % (self.prefix, name)
+            lines.append("# TYPE %s %s" % (name, kind))
+            for labels, v in values:
+                if kind == "summary":
+                    lines.append("%s_sum{%s} %s" % (name, labels, v["sum"]))
+                    lines.append("%s_count{%s} %s" % (name, labels,
+                                                                v["count"]))
+                else:
+                    lines.append("%s{%s} %s" % (name, labels, v))
+        tmp = self.textfile + ".tmp"
+        with open(tmp, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.rename(tmp, self.textfile)
+
+    def close(self):
+        """Stop periodic exports and export one last time."""
+        self.__stop.set()
+        self.__thread.join()
+        self.write()
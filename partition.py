@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+#
+# Time-partitioned indices of the movielens indexing tool: documents are
+#  routed to one index per year or month of their Timestamp.
+#
+# This file is licensed to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import re
+import time
+import bulk
+
+from threading import Lock
+
+# Bucket name formats per period, appended to the index name w/ a '-'
+PERIODS = {"year": "%Y", "month": "%Y.%m"}
+
+# Max number of bulk bodies buffered over all buckets of an index
+MAX_BUFFERED = 8
+
+# Timestamp of a serialized document, in epoch milliseconds
+TIMESTAMP = re.compile(r'"Timestamp":(-?\d+)')
+
+DAY_MS = 24 * 3600 * 1000
+
+
+def bucket(ts, period):
+    """Return the bucket name of epoch milliseconds 'ts', e.g. "2009" for
+        period "year", "2009.03" for "month"."""
+    return time.strftime(PERIODS[period], time.gmtime(ts / 1000))
+
+
+def buckets(es, index):
+    """Return the sorted names of the existing bucket indices of 'index'.
+
+       Arguments:
+       es    -- elasticsearch client instance
+       index -- index name the buckets were derived from, e.g. "ratings"
+    """
+    res = es.indices.get_settings(index="%s-*" % index, ignore=404)
+    name = re.compile(r"%s-\d{4}(\.\d\d)?$" % re.escape(index))
+    return sorted([ i for i in res if name.match(i) ])
+
+
+def concrete(es, name):
+    """Return True if an index (rather than an alias) 'name' exists."""
+    return name in es.indices.get_settings(index=name, ignore=404)
+
+
+def create_template(es, index, doctype, mapping, settings=None):
+    """Create the index template applied to the buckets of 'index' as
+        they are created by their first bulk write.
+
+       Arguments:
+       es       -- elasticsearch client instance
+       index    -- index name the buckets are derived from
+       doctype  -- Elasticsearch doctype
+       mapping  -- dict of the field mappings of 'doctype'
+
+       Keyword arguments:
+       settings -- dict of index settings of the buckets, e.g.
+                    rebuild.BULK_SETTINGS
+    """
+    es.indices.put_template(name=index, body={"template": "%s-*" % index,
+                        "settings": settings or {},
+                        "mappings": {doctype: {"properties": mapping}}})
+
+
+def alias(es, name, indices):
+    """Point alias 'name' to 'indices' as well.
+
+       Arguments:
+       es      -- elasticsearch client instance
+       name    -- alias name, e.g. "ratings"
+       indices -- array of index names, see buckets()
+    """
+    if indices:
+        print "Adding alias %s to %s." % (name, ", ".join(indices))
+        es.indices.update_aliases(body={"actions": [
+                    {"add": {"index": i, "alias": name}} for i in indices ]})
+
+
+def freeze(es, indices):
+    """Force-merge 'indices', and block writes to them.
+
+       Old buckets do not change any more, so one segment each makes them
+       cheaper to search and keep.
+    """
+    if indices:
+        print "Freezing %s." % ", ".join(indices)
+        es.indices.optimize(index=",".join(indices), max_num_segments=1,
+                                                        request_timeout=3600)
+        es.indices.put_settings(index=",".join(indices),
+                                body={"index": {"blocks.write": True}})
+
+
+def thaw(es, indices):
+    """Lift the write block of those of 'indices' which were frozen, see
+        freeze(), so documents can be loaded into them again."""
+    if not indices:
+        return
+    res = es.indices.get_settings(index=",".join(indices),
+                                  name="index.blocks.write",
+                                  flat_settings=True)
+    frozen = sorted([ i for i, s in res.items() if "%s" % s.get("settings",
+                        {}).get("index.blocks.write") in ("true", "True") ])
+    if frozen:
+        print "Unfreezing %s." % ", ".join(frozen)
+        es.indices.put_settings(index=",".join(frozen),
+                                body={"index": {"blocks.write": False}})
+
+
+class run_progress(object):
+    """bulk.progress adapter for bulk batches of time buckets.
+
+       A bucket's batch holds documents scattered over the input, so it
+       covers several runs of consecutive document numbers. Writers report
+       the batch as usual; each of its runs is then passed on as a batch of
+       its own, so the watermark of the wrapped progress (and the
+       checkpoint) only advances once all documents before it completed, in
+       whatever bucket.
+    """
+    def __init__(self, prog):
+        """Arguments:
+           prog -- bulk.progress instance to report runs to
+        """
+        self.prog   = prog
+        self.__runs = {}
+        self.__lock = Lock()
+
+    def register(self, first, runs):
+        """Record the runs of a batch before it is queued.
+
+           Arguments:
+           first -- number of the first document of the batch
+           runs  -- array of (start-num, end-num, bytes-read) tuples
+        """
+        with self.__lock:
+            self.__runs[first] = runs
+
+    def done(self, c_start, c_end, read, total, indexed=None, failed=0):
+        """Record a completed batch, see bulk.progress.done()."""
+        with self.__lock:
+            runs = self.__runs.pop(c_start)
+        if indexed is None:
+            indexed = c_end - c_start - failed
+        last = len(runs) - 1
+        for k, (s, e, rd) in enumerate(runs):
+            self.prog.done(s, e, rd, total, indexed if k == 0 else 0,
+                            failed if k == 0 else 0, report=k == last)
+
+    def summary(self):
+        return self.prog.summary()
+
+
+class router(object):
+    """Routes documents to the bucket indices of their Timestamp.
+
+       Each bucket (e.g. "ratings-2009") has a bulk buffer of its own, and
+       full buffers are queued to a writer pool shared by all buckets, so
+       requests to different buckets are written in parallel. Once all
+       buffers together hold more than MAX_BUFFERED bulk bodies, all of them
+       are queued. This bounds memory for many (e.g. monthly) buckets, and
+       keeps the checkpoint moving, which has to wait for the oldest
+       document buffered.
+    """
+    def __init__(self, index, doctype, period, pool, prog,
+                    bulk_bytes=bulk.BULK_BYTES, metrics=None, control=None):
+        """Arguments:
+           index   -- index name the bucket names are derived from
+           doctype -- Elasticsearch doctype
+           period  -- bucket period, a key of PERIODS
+           pool    -- writer pool, see post_movies.start_writers()
+           prog    -- run_progress instance the pool reports to
+
+           Keyword arguments:
+           bulk_bytes, metrics, control -- see bulk.bulk_buffer
+        """
+        self.index      = index
+        self.doctype    = doctype
+        self.period     = period
+        self.pool       = pool
+        self.prog       = prog
+        self.bulk_bytes = bulk_bytes
+        self.metrics    = metrics
+        self.control    = control
+        self.indices    = set()
+        self.__buckets  = {}
+        self.__days     = {}
+        self.__size     = 0
+
+    def __bucket(self, doc):
+        m  = TIMESTAMP.search(doc)
+        ts = int(m.group(1)) if m else 0
+        day = ts // DAY_MS
+        name = self.__days.get(day)
+        if name is None:
+            name = self.__days[day] = "%s-%s" % (self.index,
+                                                    bucket(ts, self.period))
+        b = self.__buckets.get(name)
+        if b is None:
+            buf = bulk.bulk_buffer(self.bulk_bytes, self.metrics,
+                                                                self.control)
+            b = self.__buckets[name] = (buf, [],
+                    '{"index": {"_index": "%s", "_type": "%s"}}' % (name,
+                                                                self.doctype),
+                    '{"index": {"_index": "%s", "_type": "%s", "_id": "%%s"}}'
+                                                    % (name, self.doctype))
+            self.indices.add(name)
+        return b
+
+    def __flush(self, b, total):
+        buf, runs = b[0], b[1]
+        first = runs[0][0]
+        self.__size -= buf.size
+        self.prog.register(first, list(runs))
+        del runs[:]
+        self.pool.put((first, first + len(buf), buf.take(), None, total))
+
+    def add(self, num, read, total, doc_id, doc):
+        """Add a document to the bulk buffer of its bucket.
+
+           Arguments:
+           num    -- number of the document
+           read   -- input file offset after the document
+           total  -- total input bytes
+           doc_id -- document ID, or None
+           doc    -- JSON dict string of the document
+        """
+        b = self.__bucket(doc)
+        buf, runs = b[0], b[1]
+        size = buf.size
+        if doc_id is None:
+            buf.add(b[2], doc)
+        else:
+            buf.add(b[3] % doc_id, doc)
+        self.__size += buf.size - size
+        if runs and runs[-1][1] == num:
+            runs[-1] = (runs[-1][0], num + 1, read)
+        else:
+            runs.append((num, num + 1, read))
+        if buf.full():
+            self.__flush(b, total)
+        elif self.__size > MAX_BUFFERED * (self.control.bytes
+                                    if self.control else self.bulk_bytes):
+            self.flush(total)
+
+    def flush(self, total):
+        """Queue the buffered documents of all buckets."""
+        for b in self.__buckets.values():
+            if len(b[0]):
+                self.__flush(b, total)
@@ -17,102 +17,409 @@
 # specific language governing permissions and limitations
 # under the License.
 
-import elasticsearch
-
 import argparse
 import sys
 import traceback
 import os
-import json
+import bulk
+import archive
+import serialize
+import checkpoint
+import rebuild
+import adaptive
+import sample
 
-from threading import Thread
 from Queue import Queue
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import izip
 
 
-def index_writer(es, q, bulk):
+def index_writer(es, q, prog, sender, metrics=None, control=None):
     """Reads data tuple from queue
-        (documents-buf, line-num, bytes-read, bytes-total),
+        (start-line-num, end-line-num, documents-buf, bytes-read, bytes-total),
        writes documents to elasticsearch, and prints progress. Function is
-       intended to run in a separate thread.
+       intended to run in a separate thread; several writers may share one
+       queue, see bulk.start_writers().
 
        Arguments:
-       es    -- elasticsearch client instance to index data into
-       q     -- Queue instance to read from
+       es     -- elasticsearch client instance to index data into
+       q      -- Queue instance to read from
+       prog   -- bulk.progress instance shared by all writers of the queue
+       sender -- bulk.bulk_sender instance handling retries and failures
+
+       Keyword arguments:
+       metrics -- metrics.stage_metrics instance to record queue waits and
+                   bulk requests in
+       control -- adaptive.controller instance of the index, see
+                   bulk.bulk_sender.send()
     """
     while True:
-        data = q.get()
+        data = metrics.get(q) if metrics else q.get()
         if data == "quit":
             break
-        buf, lines, read, total = data
+        l_start, lines, buf, read, total = data
         try:
-            es.bulk(buf)
-            if read:
-                sys.stdout.write("\r   %s %% done (%s of %s KiB, %s documents)"
-                     % (read*100/total, read / 1024, total / 1024, lines))
-                sys.stdout.flush()
+            indexed, failed = sender.send(es, buf, metrics, control)
+            prog.done(l_start, lines, read, total, indexed, failed)
+            if metrics:
+                metrics.count("docs_indexed", indexed)
+                metrics.count("docs_failed", failed)
         except Exception, e:
-            print "Indexing error: skipping lines %s-%s." % (lines - bulk,
-                                                                        lines)
+            prog.done(l_start, lines, read, total, 0, buf.count("\n") / 2)
+            print "Indexing error: skipping lines %s-%s." % (l_start, lines)
             print e
         q.task_done()
 
 
-class index_file(file):
-    """Helper class which returns lines starting with a specific index number
-        from a properties file"""
-    def __init__(self, *args, **kwargs):
-        super(index_file, self).__init__(*args,**kwargs)
-        self.__remainder_line = []
-        self.__lnum = 0
+# Column kinds of the hetrec data files in the columnar cache, see
+#  colcache.table; side files are read w/o cache, see side_join()
+CACHE_KINDS = { "movies.dat": "isssss" }
+
+# Fields of the 'movie_details' documents, serialized w/ serialize.schema
+DETAILS_FIELDS = ("title", "year", "country", "director", "actors", "genres",
+                  "locations", "tags")
+DETAILS_TYPES  = { "year": "int", "actors": "list", "genres": "list",
+                   "locations": "list", "tags": "list" }
+DETAILS        = serialize.schema(DETAILS_FIELDS, DETAILS_TYPES, "latin-1")
+
+# Side files joined to 'movies.dat' by movie ID, see side_join()
+SIDE_FILES = ("movie_actors.dat", "movie_countries.dat",
+              "movie_directors.dat", "movie_genres.dat",
+              "movie_locations.dat", "movie_tags.dat")
+
+# Max size of a side file joined in memory, see side_join()
+JOIN_BYTES = 64 * 1024 * 1024
+
+
+def read_rows(fname, cache=None):
+    """Return a generator for the split lines of a hetrec data file.
+
+       Lines are returned as (fields, bytes-read, bytes-total, line-number)
+       tuples, with fields split by '\t'; byte counts are uncompressed, see
+       archive.reader. If a columnar cache directory is given, the lines are
+       read from the cache (see colcache.table) instead; lines of the file
+       which do not parse, e.g. the header line, are not returned then.
+
+       Arguments:
+       fname -- data file name, see archive.path()
+
+       Keyword arguments:
+       cache -- columnar cache directory
+    """
+    if cache:
+        import colcache
+        tbl = colcache.table(fname, '\t',
+                                CACHE_KINDS[archive.basename(fname)], cache)
+        for fields, rd, lnum in tbl.rows():
+            yield fields, rd, tbl.bytes, lnum
+        return
+    rd   = 0
+    lnum = 0
+    with archive.reader(fname) as f:
+        for line in f:
+            rd   += len(line)
+            lnum += 1
+            yield line.strip().split('\t'), rd, f.total, lnum
+
+
+def movie_runs(lines, fname):
+    """Generator for the runs of consecutive lines of the same movie in a
+        hetrec side file (e.g. 'movie_actors.dat').
+
+       Lines whose movie ID (first field) does not parse are skipped w/ a
+       message; the header line is skipped silently.
+
+       Arguments:
+       lines -- iterable of the lines of the file, w/ line endings
+       fname -- file name, for messages
+
+       Returns:
+       generator for (movie ID, start offset, end offset) tuples
+    """
+    run  = None
+    key  = None
+    rd   = 0
+    lnum = 0
+    for line in lines:
+        lnum += 1
+        k = line.split('\t', 1)[0]
+        if run and k == key:
+            run[2] = rd + len(line)
+        else:
+            if run:
+                yield tuple(run)
+                run = None
+            try:
+                run = [ int(k), rd, rd + len(line) ]
+                key = k
+            except ValueError:
+                if lnum > 1:
+                    print "%s: Error parsing line %s. Skipping." % (fname,
+                                                                    lnum)
+        rd += len(line)
+    if run:
+        yield tuple(run)
 
-    def lines_with_idx(self, idx):
-        """Return all lines that start with the number 'idx'. 
-           Stop reading from file when a line w/ number != 'idx' is
-           encountered, and buffer this line for succeeding access.
+
+def split_lines(data):
+    """Split lines of a hetrec data file into fields."""
+    return [ line.strip().split('\t') for line in data.splitlines() ]
+
+
+class hash_join(object):
+    """In-memory join of a hetrec side file (e.g. 'movie_actors.dat') to
+        'movies.dat' by movie ID. Lines may be in any order.
+
+       The file is kept as a single string, w/ a dict of the byte ranges
+       of each movie's lines; lines are split into fields on lookup.
+    """
+    def __init__(self, fname, keep=None):
+        """Arguments:
+           fname -- data file name, see archive.path()
+
+           Keyword arguments:
+           keep  -- predicate on the [movie ID] of a movie; lines of movies
+                     it rejects are not joined, see sample.sample
+        """
+        self.name   = fname
+        self.__runs = {}
+        with archive.reader(fname) as f:
+            self.__data = "".join(f)
+        for i, start, end in movie_runs(self.__data.splitlines(True), fname):
+            if keep is None or keep([ i ]):
+                self.__runs.setdefault(i, []).append((start, end))
+
+    def rows(self, idx):
+        """Return all lines of movie 'idx'.
 
            Arguments:
-           idx -- index (number) the lines are supposed to start with
+           idx -- movie ID
 
            Returns:
-           array of arrays: one entry per line, which is a nested array, which
-                            has one entry per field in the line (split by '\\t')
+           array of arrays: one entry per line, in file order, which is a
+                            nested array w/ one entry per field in the line
+                            (split by '\\t')
               e.g.
               [
                 ["1", "erik_von_detten", "Erik von Detten", "13"],
                 ["1", "greg-berg", "Greg Berg", "17"],
                 ...
               ]
-       """
-        ret = []
-        if self.__remainder_line:
-            if int(self.__remainder_line[0]) == idx:
-                ret.append(self.__remainder_line)
-            else:
-                return ""
-
-        for l in self:
-            self.__lnum += 1
-            try:
-                l = l.strip().split('\t')
-                i = int(l[0])
-            except Exception, e:
-                if self.__lnum > 1:
-                    print "%s: Error parsing line %s. Skipping." %(
-                                                        self.name, self.__lnum) 
-                    print traceback.format_exc()
-                continue
-
-            if idx == i:
-                ret.append(l)
-            else:
-                self.__remainder_line = l
-                break
-        return ret
-
-
-def index(es, datadir, tag_names, qlen=50, lines_per_bulk=1000):
+        """
+        runs = self.__runs.get(idx)
+        if not runs:
+            return []
+        if len(runs) == 1:
+            return split_lines(self.__data[runs[0][0]:runs[0][1]])
+        return split_lines("".join([ self.__data[s:e] for s, e in runs ]))
+
+
+class offset_index(object):
+    """Join of a hetrec side file to 'movies.dat' via an index of the byte
+        ranges of each movie's lines, for side files too large for a
+        hash_join.
+
+       The index holds one (movie ID, offset, length) entry per run of
+       consecutive lines of the same movie, in typed arrays sorted by movie
+       ID (24 bytes per run), and is looked up by bisection. Lines are read
+       from the file on lookup, which therefore must be a plain (not
+       compressed) file. The file is opened once per process, so lookups
+       work in parser processes forked after the index was built.
+    """
+    def __init__(self, fname, keep=None):
+        """Arguments:
+           fname -- data file name
+
+           Keyword arguments:
+           keep  -- predicate on the [movie ID] of a movie, see hash_join
+        """
+        self.name   = fname
+        self.__pid  = None
+        ids, starts, lens = array('l'), array('l'), array('l')
+        with open(fname, 'rb') as f:
+            for i, start, end in movie_runs(f, fname):
+                if keep is not None and not keep([ i ]):
+                    continue
+                ids.append(i)
+                starts.append(start)
+                lens.append(end - start)
+        if any( ids[k] > ids[k + 1] for k in xrange(len(ids) - 1) ):
+            # Stable, so a movie's runs stay in file order
+            order  = sorted(xrange(len(ids)), key=ids.__getitem__)
+            ids    = array('l', [ ids[k] for k in order ])
+            starts = array('l', [ starts[k] for k in order ])
+            lens   = array('l', [ lens[k] for k in order ])
+        self.__ids, self.__starts, self.__lens = ids, starts, lens
+
+    def rows(self, idx):
+        """Return all lines of movie 'idx', see hash_join.rows()."""
+        lo = bisect_left(self.__ids, idx)
+        hi = bisect_right(self.__ids, idx, lo)
+        if lo == hi:
+            return []
+        if self.__pid != os.getpid():
+            self.__f   = open(self.name, 'rb')
+            self.__pid = os.getpid()
+        data = []
+        for k in xrange(lo, hi):
+            self.__f.seek(self.__starts[k])
+            data.append(self.__f.read(self.__lens[k]))
+        return split_lines("".join(data))
+
+
+def side_join(fname, max_bytes=JOIN_BYTES, keep=None):
+    """Return a join of a hetrec side file to 'movies.dat': a hash_join if
+        the file is at most 'max_bytes' in size (or compressed, see
+        archive.reader), an offset_index otherwise. Only movies 'keep'
+        accepts are joined."""
+    if archive.compressed(fname) or os.stat(fname).st_size <= max_bytes:
+        return hash_join(fname, keep)
+    return offset_index(fname, keep)
+
+
+def details(fields, sides, tag_names):
+    """Return the values of the 'movie_details' document (see
+        DETAILS_FIELDS) of a split line of 'movies.dat'.
+
+       Arguments:
+       fields    -- fields of the line
+       sides     -- dict of the joins of the SIDE_FILES, see side_join()
+       tag_names -- dict of tag names by tag ID, see parse_tags()
+    """
+    idx = int(fields[0])
+    try:    cnty = sides["movie_countries.dat"].rows(idx)[0][1]
+    except: cnty = ""
+    try:    drcr = sides["movie_directors.dat"].rows(idx)[0][2]
+    except: drcr = ""
+    return ( fields[1], fields[5], cnty, drcr,
+             [ a[2] for a in sides["movie_actors.dat"].rows(idx) ],
+             [ a[1] for a in sides["movie_genres.dat"].rows(idx) ],
+             [ " ".join(a[1:5])
+                        for a in sides["movie_locations.dat"].rows(idx) ],
+             [ tag_names[int(t[1])]
+                        for t in sides["movie_tags.dat"].rows(idx) ] )
+
+
+def assemble(rows, sides, tag_names):
+    """Assemble and serialize the 'movie_details' documents of a batch of
+        lines of 'movies.dat'.
+
+       Arguments:
+       rows      -- array of (fields, bytes-read, bytes-total, line-number)
+                     tuples, see read_rows()
+       sides, tag_names -- see details()
+
+       Returns:
+       array of (movie ID, JSON dict string, bytes-read, bytes-total,
+       line-number) tuples of the lines which parse
+    """
+    vals = []
+    good = []
+    for fields, rd, total, lnum in rows:
+        try:
+            vals.append(details(fields, sides, tag_names))
+            good.append((int(fields[0]), rd, total, lnum))
+        except Exception:
+            if lnum > 1:
+                print "Parse / assemble error in line %s: %s" % (lnum, fields)
+                print traceback.format_exc()
+    ret = []
+    for (idx, rd, total, lnum), v, doc in izip(good, vals,
+                                                    DETAILS.encode(vals)):
+        if doc is None:
+            print "Serialize error in line %s: %s" % (lnum, v)
+            continue
+        ret.append((idx, doc, rd, total, lnum))
+    return ret
+
+
+# Side file joins, tag names, and line filter of the parser processes, set
+#  before they are forked, see assemble_parallel()
+_worker_args = None
+
+
+def _assemble_chunk(args):
+    """Process pool worker: assemble the documents of a byte range of
+        'movies.dat', see assemble().
+
+       Arguments:
+       args -- tuple (fname, start, end)
+
+       Returns:
+       tuple (array of assemble() results w/ line numbers relative to the
+       range, number of lines of the range)
+    """
+    fname, start, end = args
+    sides, tag_names, keep = _worker_args
+    with open(fname, 'rb') as f:
+        f.seek(start)
+        lines = f.read(end - start).splitlines(True)
+    total = os.stat(fname).st_size
+    rows  = []
+    for lnum, line in enumerate(lines, 1):
+        start += len(line)
+        fields = line.strip().split('\t')
+        if keep is None or keep(fields):
+            rows.append((fields, start, total, lnum))
+    return assemble(rows, sides, tag_names), len(lines)
+
+
+def assemble_parallel(fname, sides, tag_names, start=0, first_line=0,
+                        workers=4, chunk_bytes=256*1024, keep=None):
+    """Assemble the 'movie_details' documents of 'movies.dat' in a process
+        pool.
+
+       'movies.dat' is split into newline-aligned byte ranges, i.e. ranges
+       of movie IDs for a file sorted by movie ID, which are assembled and
+       serialized by 'workers' processes; the joins of the side files are
+       shared w/ the processes by forking. Results are yielded in file
+       order.
+
+       Arguments:
+       fname            -- 'movies.dat' file name; must not be compressed
+       sides, tag_names -- see details()
+
+       Keyword arguments:
+       start       -- byte offset to start at; must be a line boundary
+       first_line  -- number of the lines before 'start'
+       workers     -- number of processes
+       chunk_bytes -- approximate size of each byte range
+       keep        -- predicate on the fields of a line of 'movies.dat';
+                       lines it rejects are skipped, see sample.sample
+
+       Returns:
+       generator for assemble() results
+    """
+    global _worker_args
+    from multiprocessing import Pool
+
+    _worker_args = (sides, tag_names, keep)
+    tasks = [ (fname, s, e) for s, e in archive.chunk_ranges(fname,
+                                                        chunk_bytes, start) ]
+    pool = Pool(workers)
+    try:
+        for docs, lines in pool.imap(_assemble_chunk, tasks):
+            for idx, doc, rd, total, lnum in docs:
+                yield idx, doc, rd, total, first_line + lnum
+            first_line += lines
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        _worker_args = None
+
+
+def index(es, datadir, tag_names, qlen=50, bulk_bytes=bulk.BULK_BYTES,
+                                writers=1, sender=None, checkpoint=None,
+                                index_name="movie_details", cache=None,
+                                metrics=None, in_flight=0, parse_workers=1,
+                                join_bytes=JOIN_BYTES, control=None,
+                                keep=None, export=None, stop=None):
     """Parse hetrec data set and write the result JSON dicts to
-        elastisearch in a separate thread.
+        elastisearch in separate writer threads.
 
        Arguments:
        es        -- elastisearch client instance to index data into
@@ -120,70 +427,114 @@ def index(es, datadir, tag_names, qlen=50, lines_per_bulk=1000):
 
        Keyword arguments:
        qlen            -- Max number of bulk writes to queue
-       lines_per_bulk  -- Number of lines per bulk write
+       bulk_bytes      -- Byte budget of a bulk write, see bulk.bulk_buffer
+       writers         -- Number of writer threads sending bulk requests
+                          concurrently; 'es' should be shared, see
+                          bulk.client()
+       sender          -- bulk.bulk_sender instance to send bulk writes with
+       checkpoint      -- checkpoint.checkpoint instance for 'movies.dat';
+                          indexing starts at the checkpoint's offset, and
+                          the checkpoint is updated as bulk writes are
+                          acknowledged
+       index_name      -- Elasticsearch index to write to
+       cache           -- columnar cache directory to read 'movies.dat'
+                          via, see read_rows()
+       metrics         -- metrics.stage_metrics instance to record the
+                          pipeline stages in; reading and assembling
+                          documents is recorded as "parse". A summary is
+                          printed at the end.
+       in_flight       -- if set, send bulk writes asynchronously w/ at most
+                          this many in flight instead of 'writers' threads,
+                          see asyncbulk.bulk_window
+       parse_workers   -- Number of processes assembling documents; values
+                          > 1 split 'movies.dat' into ranges of movies, see
+                          assemble_parallel(). Compressed or cached files
+                          are always assembled by this process.
+       join_bytes      -- Max size of a side file joined in memory, see
+                          side_join()
+       control         -- adaptive.controller instance adjusting the size
+                          of bulk writes (instead of 'bulk_bytes') and the
+                          number of them in flight
+       keep            -- predicate on the fields of a line of 'movies.dat';
+                          only the movies it accepts are indexed and joined,
+                          see sample.sample
+       export          -- export.bulk_export instance to write bulk bodies
+                          to instead of 'es'
+       stop            -- threading.Event instance; once set, the batches
+                          still queued are dropped, and KeyboardInterrupt is
+                          raised, see post_movies.index_file()
     """
-    act = index_file(os.path.join(datadir, "movie_actors.dat"))
-    cnt = index_file(os.path.join(datadir, "movie_countries.dat"))
-    drc = index_file(os.path.join(datadir, "movie_directors.dat"))
-    gen = index_file(os.path.join(datadir, "movie_genres.dat"))
-    loc = index_file(os.path.join(datadir, "movie_locations.dat"))
-    tag = index_file(os.path.join(datadir, "movie_tags.dat"))
-
-    buf     = ""
-    header = '{"index": {"_index": "movie_details", "_type": "movie_detail"'
-    q = Queue(maxsize=qlen)
-    trd = Thread(target=index_writer, args=(es, q, lines_per_bulk))
-    trd.start()
-
-    movie_fn  = os.path.join(datadir, "movies.dat")
-    bytes_tot = os.stat(movie_fn).st_size
-    bytes_rd  = 0
-    lines_read= 0
-
-    with open(movie_fn) as movie_f:
-        for line in  movie_f:
-            lines_read += 1
-            try:
-                bytes_rd += len(line)
-                line  = line.strip().split('\t')
-                idx   = int(line[0])
-
-                try:    cnty = json.dumps(cnt.lines_with_idx(idx)[0][1],
-                                                            encoding="latin1")
-                except: cnty = '""'
-                try:    drcr = json.dumps(drc.lines_with_idx(idx)[0][2],
-                                                            encoding='latin1')
-                except: drcr = '""'
-                acts = json.dumps([ a[2] for a in act.lines_with_idx(idx) ],
-                                                            encoding='latin1')
-                gens = json.dumps([ a[1] for a in gen.lines_with_idx(idx) ],
-                                                            encoding='latin1')
-                locs = json.dumps( [ " ".join(a[1:5])
-                                            for a in loc.lines_with_idx(idx) ]
-                                    , encoding="latin1") 
-                tags = json.dumps([ tag_names[int(t[1])]
-                                            for t in tag.lines_with_idx(idx)],
-                                                            encoding='latin1')
-                mdata = ( '{ "title":%s, "year":"%s","country":%s,"director":%s,'
-                         +'  "actors":%s,"genres":%s,"locations":%s,"tags":%s}' ) \
-                        % ( json.dumps(line[1], encoding='latin1'), line[5],
-                                cnty, drcr, acts, gens, locs, tags )
-            except Exception, e:
-                if lines_read > 1:
-                    print "Parse / assemble error in line %s: %s" % (
-                                                            lines_read, line)
-                    print traceback.format_exc()
-                continue
-            buf = buf + '%s,_id:"%s"}}\n%s\n' % (header, idx, mdata)
-
-            if lines_read % lines_per_bulk == 0:
-                q.put((buf, lines_read, bytes_rd, bytes_tot))
-                buf = ""
-    if lines_read % lines_per_bulk != 0:
-        q.put((buf, lines_read, bytes_rd, bytes_tot))
-    q.put("quit")
-    trd.join()
+    sides = dict( (name, side_join(archive.path(datadir, name), join_bytes,
+                                            keep)) for name in SIDE_FILES )
+
+    buf     = bulk.bulk_buffer(bulk_bytes, metrics, control)
+    header = '{"index": {"_index": "%s", "_type": "movie_detail"' % index_name
+    start = checkpoint.offset if checkpoint else 0
+    sender = sender or bulk.bulk_sender()
+    prog = bulk.progress(start=checkpoint.docs if checkpoint else 0,
+                         checkpoint=checkpoint, label=index_name)
+    if export:
+        pool = export.pool(index_name, prog, qlen, metrics)
+    elif in_flight:
+        import asyncbulk
+        pool = asyncbulk.bulk_window(es, prog, sender, in_flight, metrics,
+                                                                    control)
+    else:
+        q = Queue(maxsize=qlen)
+        pool = bulk.writer_pool(q, index_writer,
+                    (es, q, prog, sender, metrics, control), writers, metrics)
+
+    # Movies are joined to the side files by ID, so all files may be in any
+    #  order
+    movie_fn   = archive.path(datadir, "movies.dat")
+    lines_read = checkpoint.docs if checkpoint else 0
+    l_start    = lines_read
+    if parse_workers > 1 and not cache and not archive.compressed(movie_fn):
+        docs = assemble_parallel(movie_fn, sides, tag_names, start,
+                                    lines_read, parse_workers, keep=keep)
+    else:
+        rows = ( r for r in read_rows(movie_fn, cache) if r[1] > start
+                                            and (keep is None or keep(r[0])) )
+        docs = ( d for batch in serialize.batches(rows)
+                        for d in assemble(batch, sides, tag_names) )
+    if metrics:
+        docs = metrics.timed(docs, "parse")
+    try:
+        for idx, doc, bytes_rd, bytes_tot, lines_read in docs:
+            if stop is not None and stop.is_set():
+                raise KeyboardInterrupt
+            buf.add('%s,_id:"%s"}}' % (header, idx), doc)
+            if buf.full():
+                pool.put((l_start, lines_read, buf.take(), bytes_rd,
+                                                                bytes_tot))
+                l_start = lines_read
+        if l_start < lines_read:
+            pool.put((l_start, lines_read, buf.take(), bytes_rd, bytes_tot))
+    except:
+        pool.cancel()
+        raise
+    pool.stop()
     print ""
+    print "   %s" % prog.summary()
+    if metrics:
+        metrics.finish()
+        print "   %s" % metrics.summary()
+
+
+def create_mapping(es, index_name="movie_details"):
+    """Create the 'movie_details' index, unless it exists, and its
+        mapping.
+
+       Arguments
+       es         -- ES client instance
+
+       Keyword arguments:
+       index_name -- actual index name to use, see rebuild.rebuild.name()
+    """
+    es.indices.create(index=index_name, ignore=400)
+    details_mapping = {'year': {'boost': 1.0, 'type': 'integer'}}
+    es.indices.put_mapping("movie_detail",
+                {'movie_detail': {'properties':details_mapping}}, index_name)
 
 
 def parse_tags(datadir, fname):
@@ -194,7 +545,7 @@ def parse_tags(datadir, fname):
     skipped = []
     lnum    = 1
 
-    with open(os.path.join(datadir, fname)) as t:
+    with archive.reader(archive.path(datadir, fname)) as t:
         for line in t:
             try:
                 line = line.strip().split('\t')
@@ -216,11 +567,94 @@ def cmdl_args():
                  + ' and post message therein to a running elasticsearch'
                  + ' instance.')
     parser.add_argument('--datadir', metavar='datadir', dest='datadir',
-            default=".", help='Path to data directory in local filesystem.')
+            default=".", help='Path to data directory in local filesystem;'
+                + ' may also be a zip archive (e.g. hetrec2011-movielens-2k'
+                + '-v2.zip) or a directory inside one. Data files may be'
+                + ' gzip or bzip2 compressed (e.g. movies.dat.gz).')
     parser.add_argument('--clear', metavar='clearance', dest='clear',
         help='Set to "true" to clear the existing index before re-indexing.')
     parser.add_argument('--stop', metavar='clearonly', dest='clearonly',
         help='Only clear index, do not add more documents.')
+    parser.add_argument('--parse-workers', metavar='workers', type=int,
+        dest='parse_workers', default=1,
+        help='Number of processes used to assemble movie details, each'
+             + ' taking a range of movies (default: 1).')
+    parser.add_argument('--join-mb', metavar='MiB', type=int, dest='join_mb',
+        default=JOIN_BYTES / (1024 * 1024),
+        help='Join side files of up to MiB to movies.dat in memory, and'
+             + ' larger ones via an index of byte offsets per movie'
+             + ' (default: %s).' % (JOIN_BYTES / (1024 * 1024)))
+    parser.add_argument('--writers', metavar='writers', type=int,
+        dest='writers', default=4,
+        help='Number of concurrent bulk writers (default: 4).')
+    parser.add_argument('--qlen', metavar='qlen', type=int, dest='qlen',
+        default=50, help='Max number of bulk writes to queue (default: 50).')
+    parser.add_argument('--engine', dest='engine', default='threads',
+        choices=('threads', 'async'),
+        help='Send bulk writes from --writers threads, or asynchronously'
+             + ' from a single event loop w/ up to --in-flight requests in'
+             + ' flight (default: threads).')
+    parser.add_argument('--in-flight', metavar='requests', type=int,
+        dest='in_flight', default=16,
+        help='Max number of bulk requests in flight of the async engine'
+             + ' (default: 16).')
+    parser.add_argument('--bulk-mb', metavar='MiB', type=int, dest='bulk_mb',
+        default=10, help='Size of a bulk write in MiB (default: 10).')
+    parser.add_argument('--adaptive', action='store_true', dest='adaptive',
+        help='Adjust the size of bulk writes (starting at --bulk-mb) and the'
+             + ' number of them in flight (up to --writers, or --in-flight'
+             + ' w/ --engine async) to bulk latencies and rejections, see'
+             + ' adaptive.py.')
+    parser.add_argument('--target-latency', metavar='seconds', type=float,
+        dest='target_latency', default=adaptive.TARGET_LATENCY,
+        help='Bulk latency --adaptive keeps below (default: %s).'
+                                                % adaptive.TARGET_LATENCY)
+    parser.add_argument('--retries', metavar='retries', type=int,
+        dest='retries', default=5,
+        help='Max number of re-tries of rejected documents (default: 5).')
+    parser.add_argument('--dead-letter', metavar='file', dest='dead_letter',
+        default='dead_letter.ndjson',
+        help='File to write documents which failed to index to'
+             + ' (default: dead_letter.ndjson).')
+    parser.add_argument('--resume', action='store_true', dest='resume',
+        help='Resume an interrupted run from the last checkpoint.')
+    parser.add_argument('--checkpoints', metavar='dir', dest='checkpoints',
+        default='checkpoints',
+        help='Directory to keep checkpoints in (default: checkpoints).')
+    parser.add_argument('--rebuild', action='store_true', dest='rebuild',
+        help='Load into a new, versioned index using bulk load settings,'
+             + ' and switch the index alias over once done.')
+    parser.add_argument('--replicas', metavar='replicas', type=int,
+        dest='replicas', default=1,
+        help='Number of replicas of the rebuilt index (default: 1).')
+    parser.add_argument('--cache', metavar='dir', dest='cache',
+        help='Read movies.dat via a memory-mapped columnar cache in dir,'
+             + ' which is built on first use and whenever the file'
+             + ' changed. Requires NumPy.')
+    parser.add_argument('--sample', metavar='fraction', type=float,
+        dest='sample',
+        help='Only load the movies of a deterministic hash-based fraction'
+             + ' of all, the same as post_movies.py --sample, see'
+             + ' sample.py.')
+    parser.add_argument('--metrics-jsonl', metavar='file',
+        dest='metrics_jsonl',
+        help='Append pipeline stage metrics periodically to file, as JSON'
+             + ' lines.')
+    parser.add_argument('--metrics-prom', metavar='file', dest='metrics_prom',
+        help='Write pipeline stage metrics periodically to file, in'
+             + ' Prometheus textfile format.')
+    parser.add_argument('--metrics-interval', metavar='seconds', type=float,
+        dest='metrics_interval', default=10,
+        help='Interval of metrics exports in seconds (default: 10).')
+    parser.add_argument('--export', metavar='dir', dest='export',
+        help='Write the bulk bodies to NDJSON files in dir instead of'
+             + ' sending them to Elasticsearch, for loading them into any'
+             + ' cluster w/ replay.py. Not w/ --rebuild or --resume.')
+    parser.add_argument('--export-shards', metavar='files', type=int,
+        dest='export_shards', default=4,
+        help='Number of files (and writer threads) exported (default: 4).')
+    parser.add_argument('--export-gzip', action='store_true',
+        dest='export_gzip', help='gzip the exported files.')
 
     args = parser.parse_args()
     return args
@@ -235,6 +669,11 @@ if __name__ == "__main__":
         and yes, the hetrec data set seems to include the same movies multiple
         times, featuring multiple IDs.
 
+        Movies are joined to the actors, countries, directors, genres,
+        locations, and tags files by movie ID (in memory, or via an index of
+        byte offsets for files larger than --join-mb), so the files may be
+        in any order.
+
         GET movie_details/_search
         {
           "query": {
@@ -250,23 +689,108 @@ if __name__ == "__main__":
                 "max_query_terms" : 5
             }}
         }
+
+        recommend.py runs the latter for many movies in one multi-search,
+        and caches the results, e.g.
+
+        ./recommend.py more-like-this 54995,8903
     """
     args = cmdl_args()
-    es = elasticsearch.Elasticsearch()
+    if args.sample is not None and not 0 < args.sample <= 1:
+        sys.exit("--sample must be above 0 and at most 1.")
+    dump = None
+    if args.export:
+        if args.rebuild or args.resume:
+            sys.exit("--export does not support --rebuild or --resume.")
+        if args.export_shards < 1:
+            sys.exit("--export-shards must be at least 1.")
+        import export
+        dump = export.bulk_export(args.export, args.export_shards,
+                                                        args.export_gzip)
+        args.checkpoints = args.export
+    if args.cache:
+        try:
+            import numpy  # noqa: F401, only checks it is available
+        except ImportError, e:
+            sys.exit("--cache requires NumPy (%s)." % e)
+    es = bulk.client(args.writers)
 
-    if args.clear == 'true':
+    if args.clear == 'true' and not dump:
         es.indices.delete(index='movie_details', ignore=404)
         if args.clearonly == 'true':
             sys.exit()
-    es.indices.create(index='movie_details', ignore=400)
 
-    details_mapping = {'year': {'boost': 1.0, 'type': 'integer'}}
-    es.indices.put_mapping("movie_detail", {'movie_detail': {'properties':details_mapping}}, "movie_details")
+    # With --rebuild, load into a versioned index behind an alias
+    index_name = 'movie_details'
+    rebuilder  = None
+    if args.rebuild:
+        version = None
+        if args.resume and args.clear != 'true':
+            version = rebuild.pending(args.checkpoints, ['movie_details'])
+        rebuilder = rebuild.rebuild(es, ['movie_details'], version,
+                                                                args.replicas)
+        rebuilder.save(args.checkpoints)
+        rebuilder.create()
+        index_name = rebuilder.name('movie_details')
+        print "Rebuilding into %s." % index_name
+    if dump:
+        print "Exporting to %s." % args.export
+    else:
+        create_mapping(es, index_name)
 
     sys.stdout.write("Parsing tags..."); sys.stdout.flush()
     tags, skipped = parse_tags(args.datadir, "tags.dat")
     sys.stdout.write("Done, skipped %s lines.\n" % (len(skipped) - 1))
 
     sys.stdout.write("Parsing + Indexing movie details")
-    index(es, args.datadir, tags)
+    ckpt = checkpoint.checkpoints(args.checkpoints, ('movie_details',),
+                    (archive.path(args.datadir, "movies.dat"),))['movie_details']
+    if args.resume and args.clear != 'true':
+        ckpt.load()
+    else:
+        ckpt.clear()
+
+    exporter = None
+    if args.metrics_jsonl or args.metrics_prom:
+        import metrics
+        exporter = metrics.exporter(args.metrics_jsonl, args.metrics_prom,
+                                    args.metrics_interval)
+
+    in_flight = args.in_flight if args.engine == 'async' else 0
+    run_metrics = exporter.metrics(index_name) if exporter else None
+    control = None
+    if args.adaptive:
+        control = adaptive.controller(index_name, args.bulk_mb * 1024 * 1024,
+                                in_flight or args.writers, args.target_latency,
+                                run_metrics)
+
+    failures = bulk.dead_letter(args.dead_letter)
+    interrupted = False
+    try:
+        index(es, args.datadir, tags, args.qlen, args.bulk_mb * 1024 * 1024,
+            writers=args.writers,
+            sender=bulk.bulk_sender(args.retries, dead_letter=failures),
+            checkpoint=ckpt, index_name=index_name, cache=args.cache,
+            metrics=run_metrics, in_flight=in_flight,
+            parse_workers=args.parse_workers,
+            join_bytes=args.join_mb * 1024 * 1024, control=control,
+            keep=sample.sample(args.sample, ("MovieID",))
+                                        if args.sample is not None else None,
+            export=dump)
+    except KeyboardInterrupt:
+        interrupted = True
+    if exporter:
+        exporter.close()
+    failures.close()
+    if failures.count:
+        print "%s failed documents written to %s." % (failures.count,
+                                                        failures.fname)
+    if interrupted:
+        sys.exit("\nInterrupted%s." % ("" if dump
+                                else "; run again w/ --resume to continue"))
+    if dump:
+        print "Exported to %s; load w/ ./replay.py %s" % (args.export,
+                                                                args.export)
+    if rebuilder:
+        rebuilder.finish(args.checkpoints)
 
@@ -20,19 +20,30 @@
 # under the License.
 
 from pprint import pprint
-import elasticsearch
 
 import argparse
 import string
 import sys
 import os
 import json
+import bulk
+import archive
+import serialize
+import checkpoint
+import manifest
+import rebuild
+import extsort
+import scheduler
+import adaptive
+import partition
+import sample
 
-from threading import Thread
+from itertools import izip, compress
 from Queue import Queue
 
 
-def parse(fname, field_types, custom_append=None):
+def parse(fname, field_types, custom_append=None, start=0, offsets=False,
+            id_fields=None, keep=None):
     """Parse a data file from the Movie Lens data set.
 
        This function parses a file from the Movie Lens data set.
@@ -45,22 +56,50 @@ def parse(fname, field_types, custom_append=None):
 
         custom_append(fields)
 
+       or, if 'offsets' is set,
+
+        custom_append(fields, offset)
+
+       with 'offset' being the byte offset of the start of the line parsed.
+
+       Besides the JSON dict string, the generator returns the byte offset
+       following the line parsed, the file size, and the document ID (see
+       doc_id()) if 'id_fields' was given, None otherwise.
+
+       Field values are typed (see serialize.TYPES): IDs are integers,
+       ratings are numbers, timestamps are epoch milliseconds, and genres
+       are arrays. Lines are serialized in batches of serialize.BATCH_ROWS;
+       lines w/ values which do not convert are skipped w/ a message.
+
+       The data file may be a zip archive member or gzip / bzip2 compressed
+       (see archive.reader). Offsets then refer to the uncompressed data,
+       and the file size is the estimated uncompressed size, so progress
+       follows the compressed bytes read.
+
        Arguments:
-       fname -- file name of the data file.
+       fname -- file name of the data file, see archive.path()
        field_types -- array of field identifiers. Must match the number of
                        fields per line.
                        NOTE: The "Genres" field entries will be put in an
                        array in the return dict.
 
+       Keyword arguments:
+       start     -- byte offset to start parsing at; must be a line boundary
+       offsets   -- pass line offsets to custom_append
+       id_fields -- field identifiers to derive the document ID from
+       keep      -- predicate on the fields of a line; lines it rejects are
+                     skipped before serializing them, and not passed to
+                     custom_append, see sample.sample
+
        Example Usage:
         for line in parse('ratings.dat',
                             ("UserID", "MovieID", "Rating", "Timestamp"):
             print line
 
        Example output:
-        {"UserID":"1","MovieID":"122","Rating":"5","Timestamp":"838985046"}
-        {"UserID":"1","MovieID":"362","Rating":"5","Timestamp":"838984885"}
-        {"UserID":"1","MovieID":"364","Rating":"5","Timestamp":"838983707"}
+        {"UserID":1,"MovieID":122,"Rating":5,"Timestamp":838985046000}
+        {"UserID":1,"MovieID":362,"Rating":5,"Timestamp":838984885000}
+        {"UserID":1,"MovieID":364,"Rating":5,"Timestamp":838983707000}
         ...
 
        Exaample for "movies.dat":
@@ -68,67 +107,354 @@ def parse(fname, field_types, custom_append=None):
             print line
 
        Output:
-        {"MovieID":"65130","Title":"Revolutionary Road (2008)","Genres":["Drama","Romance"]}
+        {"MovieID":65130,"Title":"Revolutionary Road (2008)","Genres":["Drama","Romance"]}
         ...
     """
     if not custom_append:
-        custom_append = lambda x: ""
-    sz = os.stat(fname).st_size
-    rd = 0
-    with open(fname) as f:
-        num_fields = len(field_types)
-        for line in f: 
-            line = line.strip()
-            fields = line.split("::")
-            ret = "{"
-            for i in range(num_fields):
-                val = fields[i]
-                if field_types[i] == "Genres":
-                    g   = fields[i].split("|")
-                    ret = ret + '"Genres":["%s"],' % '","'.join(g)
-                elif field_types[i] == "Timestamp":
-                    ret = ret + '"%s":%s000,' % (field_types[i], val)
+        custom_append = lambda *x: ""
+    id_idx = id_indices(field_types, id_fields)
+    enc = serialize.schema(field_types, open_dict=True)
+    rd = start
+    with archive.reader(fname) as f:
+        f.seek(start)
+        for lines in serialize.batches(f):
+            rows = [ line.strip().split("::") for line in lines ]
+            kept = [ keep(r) for r in rows ] if keep else None
+            docs = iter(enc.encode(list(compress(rows, kept)) if keep
+                                                                else rows))
+            for k, (line, fields) in enumerate(izip(lines, rows)):
+                offset = rd
+                rd = rd + len(line)
+                if keep and not kept[k]:
+                    continue
+                ret = next(docs)
+                if ret is None:
+                    skip_line(fname, offset, line)
+                    continue
+                if offsets:
+                    ret += custom_append(fields, offset)
                 else:
-                    ret = ret + '"%s":%s,' % (field_types[i], json.dumps(val))
-            rd = rd + len(line)
-            ret += custom_append(fields)
-            yield ret[:-1] + '}', rd, sz
+                    ret += custom_append(fields)
+                yield ret[:-1] + '}', rd, f.total, doc_id(fields, id_idx)
+
+
+def id_indices(field_types, id_fields):
+    """Map the identifiers of the fields forming a document ID to indices.
+
+       Arguments:
+       field_types -- array of field identifiers, see parse() documentation
+       id_fields   -- array of field identifiers forming the ID, or None
+    """
+    if not id_fields:
+        return None
+    return [ field_types.index(f) for f in id_fields ]
+
+
+def doc_id(fields, id_idx):
+    """Return the deterministic document ID of a parsed line.
+
+       The ID is made of the values of the ID fields, joined by '_', e.g.
+       "UserID_MovieID" for ratings. Deterministic IDs make re-runs update
+       documents instead of duplicating them.
+
+       Arguments:
+       fields -- array of field values of one line
+       id_idx -- indices of the ID fields as returned by id_indices(), or
+                  None for documents without ID
+    """
+    if id_idx is None:
+        return None
+    return "_".join([ fields[i] for i in id_idx ])
+
+
+def user_chunk_id(user_id, chunk):
+    """Return the document ID of chunk number 'chunk' of the 'users'
+        documents of a user: UserID for the first chunk, so users w/ a
+        single chunk keep their ID, and UserID_Chunk for the others."""
+    return str(user_id) if not chunk else "%s_%d" % (user_id, chunk)
+
+
+def user_chunk_ids(user_id, count, chunk_size):
+    """Return the document IDs of the 'users' documents of a user w/
+        'count' ratings, see user_docs()."""
+    if not chunk_size:
+        return [ str(user_id) ]
+    chunks = max(1, (count + chunk_size - 1) // chunk_size)
+    return [ user_chunk_id(user_id, k) for k in range(chunks) ]
+
+
+def user_docs(user_id, ratings, chunk_size=0):
+    """Return a generator for the (ID, JSON dict string) tuples of the
+        'users' documents of a user.
+
+       W/o 'chunk_size', the user has one document w/ all ratings nested.
+       Otherwise, ratings are split into documents ("chunks") of at most
+       'chunk_size' ratings, in order, so heavy raters do not make for
+       documents of several MB w/ thousands of nested documents. Each chunk
+       holds the UserID, its sequence number (Chunk, from 0), the number of
+       chunks (Chunks), and the number of ratings of the user (RatingCount);
+       recommend.recommender.user_ratings() stitches chunks back together.
+
+       Arguments:
+       user_id -- UserID string
+       ratings -- array of JSON dict strings of the ratings of the user
+
+       Keyword arguments:
+       chunk_size -- max number of ratings per document, 0 for no limit
+    """
+    if not chunk_size:
+        yield str(user_id), '{"UserID":%d,"Ratings":[%s]}' % (int(user_id),
+                                                        ",".join(ratings))
+        return
+    ids = user_chunk_ids(user_id, len(ratings), chunk_size)
+    for k, i in enumerate(ids):
+        yield i, ('{"UserID":%d,"Chunk":%d,"Chunks":%d,"RatingCount":%d,'
+                  '"Ratings":[%s]}' % (int(user_id), k, len(ids), len(ratings),
+                    ",".join(ratings[k * chunk_size:(k + 1) * chunk_size])))
+
+
+def skip_line(fname, offset, line):
+    """Report a line which does not parse, see parse()."""
+    print "\n%s: skipping line at byte %s, which does not parse: %s" % (
+                                                fname, offset, line.strip())
+
+
+def _parse_chunk(args):
+    """Process pool worker: parse all lines of a byte range of a data file.
+
+       Arguments:
+       args -- tuple (fname, start, end, field_types, with_fields, id_idx,
+               keep). If 'with_fields' is set, the parsed fields are returned
+               along with each formatted line so the caller can run a
+               custom_append callback on them. 'id_idx' is passed on to
+               doc_id(). Lines 'keep' rejects are not returned, see parse().
+
+       Returns:
+       array of (open JSON dict string, fields or None, offset, end-offset,
+       doc-ID) tuples, offset being the byte offset of the line and
+       end-offset the one following it; the JSON dict string is None for
+       lines which do not parse, and 'fields' is the line then
+    """
+    fname, start, end, field_types, with_fields, id_idx, keep = args
+    with open(fname, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    lines = data.splitlines(True)
+    rows  = [ line.strip().split("::") for line in lines ]
+    enc   = serialize.schema(field_types, open_dict=True)
+    kept  = [ keep(r) for r in rows ] if keep else None
+    docs  = iter(enc.encode(list(compress(rows, kept)) if keep else rows))
+    ret   = []
+    for k, (line, fields) in enumerate(izip(lines, rows)):
+        offset = start
+        start += len(line)
+        if keep and not kept[k]:
+            continue
+        doc = next(docs)
+        if doc is None:
+            ret.append((None, line, offset, start, None))
+            continue
+        ret.append((doc, fields if with_fields else None, offset, start,
+                        doc_id(fields, id_idx)))
+    return ret
+
+
+def parse_parallel(fname, field_types, custom_append=None, start=0,
+                    offsets=False, id_fields=None, workers=4,
+                    chunk_bytes=4*1024*1024, keep=None):
+    """Parse a data file from the Movie Lens data set in a process pool.
+
+       Drop-in replacement for parse(). The file is split into newline-aligned
+       byte ranges (see archive.chunk_ranges()) which are formatted by
+       'workers' processes. Results are yielded in file order, and
+       custom_append is called in this (the calling) process, so stateful
+       callbacks like the 'users' index generator keep working.
+
+       Arguments:
+       fname       -- file name of the data file.
+       field_types -- array of field identifiers, see parse() documentation
+
+       Keyword arguments:
+       custom_append -- optional parser callback, see parse() documentation
+       start         -- byte offset to start parsing at, see parse()
+       offsets       -- pass line offsets to custom_append, see parse()
+       id_fields     -- fields to derive the document ID from, see parse()
+       workers       -- number of parser processes
+       chunk_bytes   -- approximate size of each byte range handed to a worker
+       keep          -- predicate on the fields of a line, see parse(); it is
+                        called in the parser processes
+    """
+    from multiprocessing import Pool
+
+    ranges = archive.chunk_ranges(fname, chunk_bytes, start)
+    sz = os.stat(fname).st_size
+    id_idx = id_indices(field_types, id_fields)
+    tasks = [ (fname, s, e, field_types, custom_append is not None, id_idx,
+                                                keep) for s, e in ranges ]
+    pool = Pool(workers)
+    try:
+        for lines in pool.imap(_parse_chunk, tasks):
+            for ret, fields, offset, rd, i in lines:
+                if ret is None:
+                    skip_line(fname, offset, fields)
+                    continue
+                if offsets:
+                    ret += custom_append(fields, offset)
+                elif custom_append:
+                    ret += custom_append(fields)
+                yield ret[:-1] + '}', rd, sz, i
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+# Kinds of the numeric fields in the columnar cache, see colcache.table;
+#  all other fields are cached as strings
+FIELD_KINDS = {"UserID": "i", "MovieID": "i", "Rating": "f", "Timestamp": "i"}
+
+
+def field_kinds(field_types):
+    """Return the colcache.table column kinds of an array of fields."""
+    return "".join([ FIELD_KINDS.get(f, "s") for f in field_types ])
 
 
-def index_writer(es, q, index, doctype):
+def parse_cached(fname, field_types, custom_append=None, start=0,
+                    offsets=False, id_fields=None, cache="cache", keep=None):
+    """Parse a data file from the Movie Lens data set via a columnar cache.
+
+       Drop-in replacement for parse(). The file is parsed once into a
+       memory-mapped columnar cache in directory 'cache' (see
+       colcache.table); later calls read the cache instead of tokenizing
+       the file, as long as the file did not change.
+
+       Arguments:
+       fname       -- file name of the data file.
+       field_types -- array of field identifiers, see parse() documentation
+
+       Keyword arguments:
+       custom_append -- optional parser callback, see parse() documentation
+       start         -- byte offset to start parsing at, see parse()
+       offsets       -- pass line offsets to custom_append, see parse()
+       id_fields     -- fields to derive the document ID from, see parse()
+       cache         -- cache directory
+       keep          -- predicate on the fields of a line, see parse()
+    """
+    import colcache
+
+    if not custom_append:
+        custom_append = lambda *x: ""
+    tbl = colcache.table(fname, "::", field_kinds(field_types), cache)
+    id_idx = id_indices(field_types, id_fields)
+    enc = serialize.schema(field_types, open_dict=True)
+    sz = tbl.bytes
+    offset = start
+    for rows in serialize.batches(tbl.rows(start)):
+        kept = [ keep(r[0]) for r in rows ] if keep else None
+        docs = iter(enc.encode([ fields for fields, rd, lnum
+                            in (compress(rows, kept) if keep else rows) ]))
+        for k, (fields, rd, lnum) in enumerate(rows):
+            if keep and not kept[k]:
+                offset = rd
+                continue
+            ret = next(docs)
+            if ret is None:
+                skip_line(fname, offset, "::".join(fields))
+                offset = rd
+                continue
+            if offsets:
+                ret += custom_append(fields, offset)
+            else:
+                ret += custom_append(fields)
+            offset = rd
+            yield ret[:-1] + '}', rd, sz, doc_id(fields, id_idx)
+
+
+def index_writer(es, q, index, doctype, prog, sender, metrics=None,
+                                                                control=None):
     """Reads data tuple from queue
         (start-document-num, end-document-num, documents-buf,
             bytes-read, bytes-total),
        writes documents to elasticsearch, and prints progress. Function is
-       intended to run in a separate thread.
+       intended to run in a separate thread; several writers may share one
+       queue, see bulk.start_writers().
 
        Arguments:
        es      -- elasticsearch client instance to index data into
        q       -- Queue instance to read from
        index   -- Elasticsearch index
        doctype -- Elasticsearch doctype
+       prog    -- bulk.progress instance shared by all writers of the queue
+       sender  -- bulk.bulk_sender instance handling retries and failures
+
+       Keyword arguments:
+       metrics -- metrics.stage_metrics instance to record queue waits and
+                   bulk requests in
+       control -- adaptive.controller instance of the index, see
+                   bulk.bulk_sender.send()
     """
     while True:
-        data = q.get()
+        data = metrics.get(q) if metrics else q.get()
         if data == "quit":
             break
         c_start, counter, buf, read, total = data
         try:
-            es.bulk(buf)
-            if read:
-                sys.stdout.write("\r   %s %% done (%s of %s KiB, %s documents)"
-                     % (read*100/total, read / 1024, total / 1024, counter))
-                sys.stdout.flush()
+            indexed, failed = sender.send(es, buf, metrics, control)
+            prog.done(c_start, counter, read, total, indexed, failed)
+            if metrics:
+                metrics.count("docs_indexed", indexed)
+                metrics.count("docs_failed", failed)
         except Exception, e:
+            prog.done(c_start, counter, read, total, 0, counter - c_start)
             print "Indexing error: skipping lines %s-%s." % (c_start, counter)
             print e
         q.task_done()
 
 
+def start_writers(es, index, doctype, prog, sender, writers=1, qlen=50,
+                    in_flight=0, metrics=None, control=None, export=None):
+    """Start the bulk writers of an index.
+
+       Arguments:
+       es, index, doctype, prog, sender -- see index_writer()
+
+       Keyword arguments:
+       writers   -- number of index_writer() threads
+       qlen      -- max number of bulk writes to queue for the threads
+       in_flight -- if set, use an asyncbulk.bulk_window w/ at most this many
+                     bulk requests in flight instead of writer threads
+       metrics   -- metrics.stage_metrics instance, see index_writer()
+       control   -- adaptive.controller instance, see index_writer()
+       export    -- export.bulk_export instance; if given, bulk batches are
+                     written to its files instead of Elasticsearch
+
+       Returns:
+       bulk.writer_pool, asyncbulk.bulk_window, or export.shard_writer
+       instance; put() bulk batches, and stop() once done
+    """
+    if export:
+        return export.pool(index, prog, qlen, metrics)
+    if in_flight:
+        import asyncbulk
+        return asyncbulk.bulk_window(es, prog, sender, in_flight, metrics,
+                                                                    control)
+    q = Queue(maxsize=qlen)
+    return bulk.writer_pool(q, index_writer,
+                    (es, q, index, doctype, prog, sender, metrics, control),
+                    writers, metrics)
+
+
 def index_file(es, fname, field_types, index, doctype,
-                parse_append_cb=None, qlen=50, lines_per_bulk=10000):
+                parse_append_cb=None, qlen=50, bulk_bytes=bulk.BULK_BYTES,
+                parse_workers=1, writers=1, sender=None, checkpoint=None,
+                replay_from=None, offsets=False, id_fields=None,
+                manifest=None, cache=None, metrics=None, in_flight=0,
+                control=None, period=None, keep=None, export=None,
+                stop=None):
     """Parse a movielens data file and write the result JSON dicts to
-        elastisearch in a separate thread.
+        elastisearch in separate writer threads.
 
        Arguments:
        es        -- pyes 'es' instance to index data into
@@ -140,31 +466,248 @@ def index_file(es, fname, field_types, index, doctype,
        Keyword arguments:
        parse_append_cb -- optional parser callback, see parse() documentation
        qlen            -- Max number of bulk writes to queue
-       lines_per_bulk  -- Number of lines per bulk write
+       bulk_bytes      -- Byte budget of a bulk write, see bulk.bulk_buffer
+       parse_workers   -- Number of parser processes; values > 1 parse the
+                          file in parallel, see parse_parallel(). Compressed
+                          files are always parsed by this process.
+       writers         -- Number of writer threads sending bulk requests
+                          concurrently; 'es' should be shared, see
+                          bulk.client()
+       sender          -- bulk.bulk_sender instance to send bulk writes with
+       checkpoint      -- checkpoint.checkpoint instance; indexing starts at
+                          the checkpoint's offset, and the checkpoint is
+                          updated as bulk writes are acknowledged
+       replay_from     -- byte offset to start parsing at if before the
+                          checkpoint's offset. Lines between 'replay_from'
+                          and the checkpoint are only passed to
+                          parse_append_cb, to rebuild the callback's state.
+       offsets         -- pass line offsets to parse_append_cb, see parse()
+       id_fields       -- fields to derive document IDs from, see doc_id()
+       manifest        -- manifest.manifest instance of the index. Only
+                          documents added or changed since the manifest's
+                          last run are sent, and documents removed since
+                          are deleted. Requires 'id_fields'.
+       cache           -- columnar cache directory; if given, the file is
+                          read via the cache, see parse_cached(), and
+                          'parse_workers' is ignored
+       metrics         -- metrics.stage_metrics instance to record the
+                          pipeline stages in; a summary is printed at the end
+       in_flight       -- if set, send bulk writes asynchronously w/ at most
+                          this many in flight instead of 'writers' threads,
+                          see start_writers()
+       control         -- adaptive.controller instance adjusting the size
+                          of bulk writes (instead of 'bulk_bytes') and the
+                          number of them in flight
+       period          -- if set, write documents to one index per "year"
+                          or "month" of their Timestamp instead, e.g.
+                          'index'-2009, see partition.router. Documents
+                          removed from the 'manifest' are not deleted.
+       keep            -- predicate on the fields of a line; only lines it
+                          accepts are indexed, see sample.sample
+       export          -- export.bulk_export instance to write bulk bodies
+                          to instead of 'es', see start_writers()
+       stop            -- threading.Event instance; once set, the batches
+                          still queued are dropped, and KeyboardInterrupt is
+                          raised, see scheduler.scheduler.stop
+
+       Returns:
+       size of the data file in bytes, uncompressed (see parse())
     """
-    q = Queue(maxsize=qlen)
     es.bulk_size = 1
-    t = Thread(target=index_writer, args=(es, q, index, doctype))
-    t.start()
 
-    counter = 0
-    c_start = 0
-    buf     = ""
+    start   = checkpoint.offset if checkpoint else 0
+    counter = checkpoint.docs if checkpoint else 0
+    c_start = counter
+    buf     = bulk.bulk_buffer(bulk_bytes, metrics, control)
     header = '{"index": {"_index": "%s", "_type": "%s"}}' %(index, doctype)
+    id_header = '{"%%s": {"_index": "%s", "_type": "%s", "_id": "%%s"}}' % (
+                                                                index, doctype)
+
+    prog = bulk.progress(start=counter, checkpoint=checkpoint, label=index)
+    wprog = partition.run_progress(prog) if period else prog
+    pool = start_writers(es, index, doctype, wprog,
+                            sender or bulk.bulk_sender(), writers, qlen,
+                            in_flight, metrics, control, export)
+    router = None
+    if period:
+        router = partition.router(index, doctype, period, pool, wprog,
+                                            bulk_bytes, metrics, control)
+
+    parse_from = start if replay_from is None else min(start, replay_from)
+    if cache:
+        lines = parse_cached(fname, field_types, parse_append_cb,
+                                start=parse_from, offsets=offsets,
+                                id_fields=id_fields, cache=cache,
+                                keep=keep)
+    elif parse_workers > 1 and not archive.compressed(fname):
+        lines = parse_parallel(fname, field_types, parse_append_cb,
+                                start=parse_from, offsets=offsets,
+                                id_fields=id_fields, workers=parse_workers,
+                                keep=keep)
+    else:
+        lines = parse(fname, field_types, parse_append_cb,
+                                start=parse_from, offsets=offsets,
+                                id_fields=id_fields, keep=keep)
+    if metrics:
+        lines = metrics.timed(lines, "parse")
 
-    print "Indexing %s" % index
-    for line, read, total in parse(fname,field_types, parse_append_cb):
-        counter = counter + 1
-        buf = buf + "%s\n%s\n" % (header, line)
-        if counter % lines_per_bulk == 0:
-            q.put((c_start, counter, buf, read, total))
-            c_start = counter
-            buf = ""
-    if c_start < counter:
-        q.put((c_start, counter, buf, total, total))
-    q.put("quit")
-    t.join()
+    if start:
+        print "Resuming %s at byte %s (%s documents)" % (index, start,
+                                                                    counter)
+    else:
+        print "Indexing %s" % index
+    total = archive.size(fname)
+    try:
+        for line, read, total, i in lines:
+            if stop is not None and stop.is_set():
+                raise KeyboardInterrupt
+            if read <= start:
+                continue
+            if manifest and not manifest.changed(i, line):
+                continue
+            counter = counter + 1
+            if router:
+                router.add(counter - 1, read, total, i, line)
+                continue
+            if i is None:
+                buf.add(header, line)
+            else:
+                buf.add(id_header % ("index", i), line)
+            if buf.full():
+                pool.put((c_start, counter, buf.take(), read, total))
+                c_start = counter
+        if manifest and not start and not router:
+            for i in manifest.removed():
+                counter = counter + 1
+                buf.add(id_header % ("delete", i))
+                if buf.full():
+                    pool.put((c_start, counter, buf.take(), total, total))
+                    c_start = counter
+        if router:
+            router.flush(total)
+        elif c_start < counter:
+            pool.put((c_start, counter, buf.take(), total, total))
+    except:
+        pool.cancel()
+        raise
+    pool.stop()
     print ""
+    print "   %s" % prog.summary()
+    if metrics:
+        metrics.finish()
+        print "   %s" % metrics.summary()
+    if manifest and not start:
+        save_manifest(manifest, prog)
+    # Compressed data resumed at its end: 'total' is still the stored size
+    return max(total, start)
+
+
+def save_manifest(mfst, prog):
+    """Save the manifest of an index once loaded, unless documents failed
+        to index; the manifest of the last run is kept then, so the next
+        --delta run sends all changes since again.
+
+       Arguments:
+       mfst -- manifest.manifest instance
+       prog -- bulk.progress instance of the index
+    """
+    if prog.failed:
+        print "   %s documents failed, keeping the manifest of the last" \
+              " run." % prog.failed
+    else:
+        mfst.save()
+
+
+def post_docs(es, docs, index, doctype, action="index", qlen=50,
+                bulk_bytes=bulk.BULK_BYTES, writers=1, sender=None,
+                metrics=None, in_flight=0, control=None, export=None,
+                stop=None):
+    """Bulk index generated documents.
+
+       Arguments:
+       es      -- elasticsearch client instance to index data into
+       docs    -- iterable of (document-ID, JSON dict string) tuples
+       index   -- Elasticsearch index
+       doctype -- Elasticsearch doctype
+
+       Keyword arguments:
+       action  -- bulk action, "index" or "update"; for "update", 'docs'
+                   must be partial documents, i.e. '{"doc":...}'
+       qlen, bulk_bytes, writers, sender, metrics, in_flight, control,
+       export, stop -- see index_file()
+    """
+    counter = 0
+    c_start = 0
+    buf     = bulk.bulk_buffer(bulk_bytes, metrics, control)
+    header  = '{"%s": {"_index": "%s", "_type": "%s", "_id": "%%s"}}' % (
+                                                    action, index, doctype)
+
+    prog = bulk.progress(out=None)
+    pool = start_writers(es, index, doctype, prog,
+                            sender or bulk.bulk_sender(), writers, qlen,
+                            in_flight, metrics, control, export)
+    print "%s %s" % ("Updating" if action == "update" else "Indexing", index)
+    try:
+        for i, doc in docs:
+            if stop is not None and stop.is_set():
+                raise KeyboardInterrupt
+            counter = counter + 1
+            buf.add(header % i, doc)
+            if buf.full():
+                pool.put((c_start, counter, buf.take(), None, None))
+                c_start = counter
+        if c_start < counter:
+            pool.put((c_start, counter, buf.take(), None, None))
+    except:
+        pool.cancel()
+        raise
+    pool.stop()
+    print "   %s" % prog.summary()
+    if metrics:
+        metrics.finish()
+        print "   %s" % metrics.summary()
+
+
+def update_docs(es, docs, index, doctype, qlen=50, bulk_bytes=bulk.BULK_BYTES,
+                writers=1, sender=None, metrics=None, in_flight=0,
+                control=None, export=None, stop=None):
+    """Partially update existing documents by bulk 'update' actions.
+
+       Arguments:
+       es      -- elasticsearch client instance to index data into
+       docs    -- iterable of (document-ID, JSON dict string) tuples; the
+                   fields of each JSON dict are merged into the document
+       index   -- Elasticsearch index
+       doctype -- Elasticsearch doctype
+
+       Keyword arguments:
+       qlen, bulk_bytes, writers, sender, metrics, in_flight, control,
+       export, stop -- see index_file()
+    """
+    post_docs(es, ( (i, '{"doc":%s}' % d) for i, d in docs ), index, doctype,
+                "update", qlen, bulk_bytes, writers, sender, metrics,
+                in_flight, control, export, stop)
+
+
+def create_similar_mapping(es, index_name="movie_similar"):
+    """Re-create the "movie_similar" index, create its mapping.
+
+       Arguments
+       es -- ES client instance
+
+       Keyword arguments:
+       index_name -- actual name of the index, see rebuild.rebuild.names()
+    """
+    es.indices.create(index=index_name, ignore=400)
+    es.indices.put_mapping("similar", {"similar": {"properties": {
+                       'MovieID' : {'type': 'integer'},
+                       'Similar' : {
+                            "properties":{
+                                'MovieID':{'type':'integer'},
+                                'Title'  :{'type':'string'},
+                                'Score'  :{'type':'float'},
+                                'Count'  :{'type':'integer'}}}}}},
+                                                                index_name)
 
 
 def delete_indices(es):
@@ -174,44 +717,78 @@ def delete_indices(es):
        es -- ES client instance
     """
     print "Deleting indices."
+    for n in ('ratings', 'tags'):
+        buckets = partition.buckets(es, n)
+        if buckets:
+            es.indices.delete(index=",".join(buckets))
     es.indices.delete(index='movies', ignore=404)
     es.indices.delete(index='tags', ignore=404)
     es.indices.delete(index='ratings', ignore=404)
     es.indices.delete(index='users', ignore=404)
 
-def create_mappings(es):
+def create_mappings(es, names=None, partitioned=(), settings=None):
     """Re-create indices, create mappings.
 
        Arguments
-       es -- ES client instance
+       es    -- ES client instance
+
+       Keyword arguments:
+       names       -- dict of the actual index names to use, keyed by
+                      'movies', 'tags', 'ratings', and 'users'; see
+                      rebuild.rebuild.names()
+       partitioned -- keys of 'names' loaded into time buckets; an index
+                      template is created for their buckets instead of
+                      the index, see partition.create_template()
+       settings    -- index settings of the buckets
     """
+    if not names:
+        names = dict( (n, n) for n in ('movies', 'tags', 'ratings', 'users') )
     print "Creating indices and mappings."
-    es.indices.create(index='movies', ignore=400)
-    es.indices.create(index='tags', ignore=400)
-    es.indices.create(index='ratings', ignore=400)
-    es.indices.create(index='users', ignore=400)
+    for n in ('movies', 'tags', 'ratings', 'users'):
+        if n not in partitioned:
+            es.indices.create(index=names[n], ignore=400)
 
-    ts_mapping = {     'Timestamp' : { 'boost': 1.0, 'type': 'date'} }
+    ts_mapping = {     'Timestamp' : { 'boost': 1.0, 'type': 'date'},
+                       'UserID'    : { 'type': 'integer'},
+                       'MovieID'   : { 'type': 'integer'} }
+    stats_mapping = {  'RatingCount'    : {'type': 'integer'},
+                       'RatingMean'     : {'type': 'float'},
+                       'RatingVariance' : {'type': 'float'},
+                       'RatingBayesAvg' : {'type': 'float'},
+                       'LastRated'      : {'type': 'date'},
+                       'RatingHistogram': {'type': 'integer'} }
+    movies_mapping = dict(ts_mapping, **stats_mapping)
     ratings_mapping = {'Timestamp' : { 'boost': 1.0, 'type': 'date'}, 
+                       'UserID'    : { 'type': 'integer'},
+                       'MovieID'   : { 'type': 'integer'},
                        'Rating'    : { 'boost': 1.0, 'type': 'float'},
                        'Title'     : { "type": "string",
                                           "fields": { "raw" : {
                                                       "type": "string",
                                                       "index": "not_analyzed"
                                                 } } } }
-    users_mapping = {  'UserID' :{'type':'string'},
+    users_mapping = {  'UserID' :{'type':'integer'},
+                       'Chunk'  :{'type':'integer'},
+                       'Chunks' :{'type':'integer'},
                        'Ratings':{
                             "type":"nested",
                             "properties":{
+                                'MovieID'  :{'type':'integer'},
                                 'Rating'   :{'boost':1.0,'type':'float'},
                                 'Timestamp':{'boost':1.0,'type':'date'},
                                 'Title'    :{"type":"string","fields":{
                                                   "raw" : {
                                                     "type": "string",
                                                     "index": "not_analyzed"}}}}}}
+    users_mapping.update(stats_mapping)
     def put(es, doc, mappings):
-        es.indices.put_mapping(doc, {doc: {'properties':mappings}}, doc+'s')
-    put(es, "movie", ts_mapping)
+        if doc+'s' in partitioned:
+            partition.create_template(es, names[doc+'s'], doc, mappings,
+                                                                    settings)
+        else:
+            es.indices.put_mapping(doc, {doc: {'properties':mappings}},
+                                                            names[doc+'s'])
+    put(es, "movie", movies_mapping)
     put(es, "rating", ratings_mapping)
     put(es, "tag", ts_mapping)
     put(es, "user", users_mapping)
@@ -228,11 +805,150 @@ def cmdl_args():
                  + ' and post message therein to a running elasticsearch'
                  + ' instance.')
     parser.add_argument('--lens', metavar='lens', dest='lens', default='.',
-        help='Path to movielens directory in local filesystem.')
+        help='Path to movielens directory in local filesystem, or to a'
+             + ' movielens zip archive (e.g. ml-10m.zip) or a directory'
+             + ' inside it. Data files may be gzip or bzip2 compressed.')
     parser.add_argument('--clear', metavar='clearance', dest='clear',
         help='Set to "true" to clear the existing index before re-indexing.')
     parser.add_argument('--stop', metavar='clearonly', dest='clearonly',
         help='Only clear index, do not add more documents.')
+    parser.add_argument('--parse-workers', metavar='workers', type=int,
+        dest='parse_workers', default=1,
+        help='Number of processes used to parse data files; movie titles'
+             + ' are still added to ratings, and the "users" index'
+             + ' generated, by the main process. Each data file loaded at'
+             + ' once (see --max-loads) has its own parser processes'
+             + ' (default: 1).')
+    parser.add_argument('--writers', metavar='writers', type=int,
+        dest='writers', default=4,
+        help='Number of concurrent bulk writers per index (default: 4).')
+    parser.add_argument('--max-requests', metavar='requests', type=int,
+        dest='max_requests', default=0,
+        help='Max number of bulk requests in flight over all indices loaded'
+             + ' at once (default: 0, only limited per index).')
+    parser.add_argument('--max-loads', metavar='loads', type=int,
+        dest='max_loads', default=0,
+        help='Max number of indices to load at once; 1 loads them one'
+             + ' after another (default: 0, all which do not wait for'
+             + ' another index).')
+    parser.add_argument('--details', metavar='datadir', dest='details',
+        help='Also load the "movie_details" index from the hetrec data set'
+             + ' in datadir, alongside the movielens indices, see'
+             + ' post_movie_details.py.')
+    parser.add_argument('--qlen', metavar='qlen', type=int, dest='qlen',
+        default=50, help='Max number of bulk writes to queue (default: 50).')
+    parser.add_argument('--engine', dest='engine', default='threads',
+        choices=('threads', 'async'),
+        help='Send bulk writes from --writers threads per index, or'
+             + ' asynchronously from a single event loop per index w/ up to'
+             + ' --in-flight requests in flight (default: threads).')
+    parser.add_argument('--in-flight', metavar='requests', type=int,
+        dest='in_flight', default=16,
+        help='Max number of bulk requests in flight per index of the async'
+             + ' engine (default: 16).')
+    parser.add_argument('--bulk-mb', metavar='MiB', type=int, dest='bulk_mb',
+        default=10, help='Size of a bulk write in MiB (default: 10).')
+    parser.add_argument('--adaptive', action='store_true', dest='adaptive',
+        help='Adjust the size of bulk writes (starting at --bulk-mb) and the'
+             + ' number of them in flight per index (up to --writers, or'
+             + ' --in-flight w/ --engine async) to bulk latencies and'
+             + ' rejections, see adaptive.py.')
+    parser.add_argument('--target-latency', metavar='seconds', type=float,
+        dest='target_latency', default=adaptive.TARGET_LATENCY,
+        help='Bulk latency --adaptive keeps below (default: %s).'
+                                                % adaptive.TARGET_LATENCY)
+    parser.add_argument('--retries', metavar='retries', type=int,
+        dest='retries', default=5,
+        help='Max number of re-tries of rejected documents (default: 5).')
+    parser.add_argument('--dead-letter', metavar='file', dest='dead_letter',
+        default='dead_letter.ndjson',
+        help='File to write documents which failed to index to'
+             + ' (default: dead_letter.ndjson).')
+    parser.add_argument('--resume', action='store_true', dest='resume',
+        help='Resume an interrupted run from the last checkpoints.')
+    parser.add_argument('--checkpoints', metavar='dir', dest='checkpoints',
+        default='checkpoints',
+        help='Directory to keep checkpoints in (default: checkpoints).')
+    parser.add_argument('--delta', action='store_true', dest='delta',
+        help='Only send documents added, changed, or removed since the last'
+             + ' --delta run, see --manifests. Not w/ --resume.')
+    parser.add_argument('--manifests', metavar='dir', dest='manifests',
+        default='manifests',
+        help='Directory to keep document content hashes of the last --delta'
+             + ' run in; loads w/o --delta remove them (default: manifests).')
+    parser.add_argument('--rebuild', action='store_true', dest='rebuild',
+        help='Load into new, versioned indices using bulk load settings,'
+             + ' and switch the index aliases over once done.')
+    parser.add_argument('--replicas', metavar='replicas', type=int,
+        dest='replicas', default=1,
+        help='Number of replicas of rebuilt indices (default: 1).')
+    parser.add_argument('--partition', dest='partition',
+        choices=sorted(partition.PERIODS.keys()),
+        help='Load "ratings" and "tags" into one index per year or month'
+             + ' of their Timestamp (e.g. "ratings-2009" or'
+             + ' "ratings-2009.03") behind a "ratings" and "tags" alias.'
+             + ' Not w/ --delta.')
+    parser.add_argument('--freeze', action='store_true', dest='freeze',
+        help='W/ --partition, force-merge all but the latest time bucket'
+             + ' of "ratings" and "tags" once loaded, and block writes to'
+             + ' them.')
+    parser.add_argument('--users-sort-mb', metavar='MiB', type=int,
+        dest='users_sort_mb', default=0,
+        help='Generate the "users" index by an external sort using at most'
+             + ' MiB of memory. Required if ratings are not sorted by UserID'
+             + ' (default: 0, do not sort).')
+    parser.add_argument('--sample', metavar='fraction', type=float,
+        dest='sample',
+        help='Only load the users and movies of a deterministic hash-based'
+             + ' fraction of all, e.g. 0.1 for 10%% of users and movies'
+             + ' and about 1%% of ratings, see sample.py.')
+    parser.add_argument('--user-chunk', metavar='ratings', type=int,
+        dest='user_chunk', default=1000,
+        help='Max number of ratings per "users" document; the ratings of'
+             + ' users w/ more are split into several documents (default:'
+             + ' 1000, 0 for no limit).')
+    parser.add_argument('--cache', metavar='dir', dest='cache',
+        help='Read data files via a memory-mapped columnar cache in dir,'
+             + ' which is built on first use and whenever a data file'
+             + ' changed. Requires NumPy.')
+    parser.add_argument('--stats', action='store_true', dest='stats',
+        help='Compute rating statistics per movie and per user, and add'
+             + ' them to the "movies" and "users" documents. Requires NumPy.')
+    parser.add_argument('--similar', action='store_true', dest='similar',
+        help='Compute the movies most often liked together w/ each movie,'
+             + ' and index them into "movie_similar". Requires NumPy and'
+             + ' SciPy.')
+    parser.add_argument('--similar-top', metavar='K', type=int,
+        dest='similar_top', default=20,
+        help='Max number of similar movies per movie (default: 20).')
+    parser.add_argument('--similar-score', dest='similar_score',
+        default='llr', choices=('llr', 'jlh'),
+        help='Significance score of movies liked together: log-likelihood'
+             + ' ratio or JLH (default: llr).')
+    parser.add_argument('--like-rating', metavar='rating', type=float,
+        dest='like_rating', default=4.0,
+        help='Min rating of a movie liked, for --similar (default: 4.0).')
+    parser.add_argument('--metrics-jsonl', metavar='file',
+        dest='metrics_jsonl',
+        help='Append pipeline stage metrics of each index periodically to'
+             + ' file, as JSON lines.')
+    parser.add_argument('--metrics-prom', metavar='file', dest='metrics_prom',
+        help='Write pipeline stage metrics of each index periodically to'
+             + ' file, in Prometheus textfile format.')
+    parser.add_argument('--metrics-interval', metavar='seconds', type=float,
+        dest='metrics_interval', default=10,
+        help='Interval of metrics exports in seconds (default: 10).')
+    parser.add_argument('--export', metavar='dir', dest='export',
+        help='Write the bulk bodies to NDJSON files in dir instead of'
+             + ' sending them to Elasticsearch, for loading them into any'
+             + ' cluster w/ replay.py. Not w/ --rebuild, --partition,'
+             + ' --delta, or --resume.')
+    parser.add_argument('--export-shards', metavar='files', type=int,
+        dest='export_shards', default=4,
+        help='Number of files (and writer threads) per index and bulk'
+             + ' action exported (default: 4).')
+    parser.add_argument('--export-gzip', action='store_true',
+        dest='export_gzip', help='gzip the exported files.')
 
     args = parser.parse_args()
     return args
@@ -247,53 +963,258 @@ if __name__ == "__main__":
 
         Note that the 'users' index uses nested documents to store the movies
         rated per user. You will need to specify the nested path in your
-        queries, e.g.:
-
-        GET users/_search?search_type=count
-        {
-          "query": {
-            "nested": {
-              "path": "Ratings",
-              "query": {
-                "bool": {"must" : [
-                        {"range": {"Ratings.Rating": {"gte": 4}}},
-                        {"match_phrase": {"Ratings.Title": "Planet Terror"}} ]
-            }}}},
-          "aggs": {
-            "Ratings" : {
-                "nested": { "path": "Ratings"},
-                "aggs"  : { "Title" : {
-                    "significant_terms":{"field" : "Ratings.Title.raw"}}}}}}
-
-        to run a significant terms aggregation on movies rated by users who 
-        rated "Planet Terror" a "4" ("good") or better.
+        queries, e.g. "Ratings.Title". Users w/ more than --user-chunk
+        ratings get several documents ("chunks", IDs UserID, UserID_1,
+        UserID_2, ...) of the same UserID, w/ sequence number Chunk, the
+        number of Chunks, and the RatingCount of the user each;
+        recommend.recommender.user_ratings() stitches them together.
+
+        With --similar, the movies liked (rated --like-rating or better) by
+        the same users are counted per pair of movies after all ratings
+        were parsed, and the --similar-top most significant ones per movie
+        (see similar.py) are indexed into 'movie_similar', so "people who
+        liked Planet Terror also liked" is a single GET of the document of
+        its MovieID:
+
+        GET movie_similar/similar/<MovieID>
+
+        instead of a significant terms aggregation over the nested ratings
+        of all users who liked it. recommend.py runs both kinds of queries,
+        batched and cached.
+
+        With --stats, rating statistics (count, mean, variance, Bayesian
+        average, latest rating, and a histogram of ratings) are computed per
+        movie and per user after all ratings were parsed, and added to the
+        'movies' and 'users' documents by partial updates.
+
+        With --metrics-jsonl and / or --metrics-prom, the time spent in each
+        pipeline stage (parsing, bulk body assembly, queue waits, bulk
+        requests) and bulk item errors are recorded per index, exported
+        periodically, and summarized at the end of each index.
+
+        With --partition year (or month), ratings and tags go to one index
+        per year (or month) of their Timestamp, e.g. 'ratings-2009', behind
+        a 'ratings' and 'tags' alias for reading. Buckets get their mapping
+        from an index template, and share the writers of their index.
+        Queries of a time range may name the buckets they need, e.g.
+        'ratings-2009*', instead of searching all shards; w/ --freeze, all
+        but the latest bucket are force-merged and made read-only.
+
+        With --engine async, bulk writes are sent over --in-flight
+        non-blocking connections per index by one event loop thread (see
+        asyncbulk.py) instead of one writer thread per connection, which
+        keeps Elasticsearch busy at high latencies w/o many threads.
+
+        With --sample, only the users and movies whose hashed IDs fall into
+        the fraction given are loaded (see sample.py), consistently across
+        all files and runs, and w/ post_movie_details.py --sample; e.g.
+        --sample 0.1 loads 10% of users and movies, and the ratings among
+        them, about 1% of all.
+
+        Indices are loaded concurrently as far as they do not depend on each
+        other (see scheduler.py): 'movies' first, as its titles are added to
+        'ratings' and 'users', while 'tags' (and 'movie_details', w/
+        --details) are loaded right away. Each index has its own writers;
+        --max-requests caps the bulk requests in flight over all of them.
         """
     args = cmdl_args()
 
-    es = elasticsearch.Elasticsearch()
+    # Documents may move between time buckets, which --delta cannot tell
+    partitioned = ('ratings', 'tags') if args.partition else ()
+    if args.partition and args.delta:
+        sys.exit("--partition does not support --delta.")
+    if args.freeze and not args.partition:
+        sys.exit("--freeze requires --partition.")
+    # A resumed run skips the documents before its checkpoint, so it can
+    #  neither tell removed documents nor save a complete manifest; a new
+    #  --delta run against the last complete one sends what is missing
+    if args.delta and args.resume:
+        sys.exit("--delta does not support --resume, run --delta again.")
+    if args.user_chunk < 0:
+        sys.exit("--user-chunk must not be negative.")
+    if args.sample is not None and not 0 < args.sample <= 1:
+        sys.exit("--sample must be above 0 and at most 1.")
+    smp = sample.sample(args.sample) if args.sample is not None else None
+    keep = lambda field_types: smp.of(field_types) if smp else None
+
+    # With --export, bulk bodies go to files, and Elasticsearch is not
+    #  contacted at all; checkpoints of the run are kept in the export
+    #  directory, so they do not mix w/ those of loads
+    dump = None
+    if args.export:
+        if args.rebuild or args.partition or args.delta or args.resume:
+            sys.exit("--export does not support --rebuild, --partition,"
+                     " --delta, or --resume.")
+        if args.export_shards < 1:
+            sys.exit("--export-shards must be at least 1.")
+        import export
+        dump = export.bulk_export(args.export, args.export_shards,
+                                                        args.export_gzip)
+        args.checkpoints = args.export
+
+    if args.stats or args.cache or args.similar:
+        try:
+            import numpy  # noqa: F401, only checks it is available
+        except ImportError, e:
+            sys.exit("--stats, --similar, and --cache require NumPy (%s)."
+                                                                        % e)
+    if args.similar:
+        try:
+            import similar
+        except ImportError, e:
+            sys.exit("--similar requires SciPy (%s)." % e)
+
+    # Collect all ratings for per-movie and per-user statistics, and for
+    #  similar movies
+    rstats = None
+    if args.stats or args.similar:
+        import stats
+        rstats = stats.rating_stats()
+
+    # Pipeline stage metrics per index, if exported
+    exporter = None
+    if args.metrics_jsonl or args.metrics_prom:
+        import metrics
+        exporter = metrics.exporter(args.metrics_jsonl, args.metrics_prom,
+                                    args.metrics_interval)
+
+    # Runs the loads of the indices, see below
+    loads = scheduler.scheduler(args.max_loads)
 
-    if args.clear == 'true':
+    # Keyword arguments 'metrics', 'control', and 'stop' of an index run:
+    #  its pipeline stage metrics, if exported, w/ --adaptive its control
+    #  of bulk size and concurrency, and the event stopping it once the
+    #  loads were interrupted
+    def run_opts(index):
+        m = exporter.metrics(index) if exporter else None
+        c = None
+        if args.adaptive:
+            c = adaptive.controller(index, bulk_bytes,
+                            in_flight or args.writers, args.target_latency, m)
+        return dict(metrics=m, control=c, stop=loads.stop)
+
+    # Up to five indices are loaded at once: movies, ratings, users, tags,
+    #  and movie details or similar movies. Their writers share the
+    #  client, and a cap on bulk requests in flight.
+    if args.details:
+        import post_movie_details
+    es = bulk.client(args.max_requests or 5 * args.writers)
+    in_flight = args.in_flight if args.engine == 'async' else 0
+    bulk_bytes = args.bulk_mb * 1024 * 1024
+    failures = bulk.dead_letter(args.dead_letter)
+    sender = bulk.bulk_sender(args.retries, dead_letter=failures,
+                                max_requests=args.max_requests)
+
+    if args.clear == 'true' and not dump:
         delete_indices(es)
+        if args.details:
+            es.indices.delete(index='movie_details', ignore=404)
+        if args.similar:
+            es.indices.delete(index='movie_similar', ignore=404)
         if args.clearonly == 'true':
             sys.exit()
 
-    create_mappings(es)
+    # With --rebuild, load into versioned indices behind aliases
+    names = dict( (n, n) for n in ('movies', 'ratings', 'tags', 'users') )
+    if args.details:
+        names['movie_details'] = 'movie_details'
+    if args.similar:
+        names['movie_similar'] = 'movie_similar'
+    rebuilder = None
+    if args.rebuild:
+        version = None
+        if args.resume and args.clear != 'true':
+            version = rebuild.pending(args.checkpoints, names.keys())
+        rebuilder = rebuild.rebuild(es, names.keys(), version, args.replicas,
+                                    partitioned=partitioned)
+        rebuilder.save(args.checkpoints)
+        rebuilder.create()
+        names = rebuilder.names()
+        print "Rebuilding into %s." % ", ".join(names.values())
+    elif args.partition:
+        for n in partitioned:
+            if partition.concrete(es, n):
+                sys.exit("Index %s is in the way of the alias of its time"
+                         " buckets; load w/ --clear true or --rebuild." % n)
+            # Buckets frozen by an earlier --freeze would reject all
+            #  documents routed to them
+            partition.thaw(es, partition.buckets(es, n))
+
+    if dump:
+        print "Exporting to %s." % args.export
+    else:
+        create_mappings(es, names, partitioned,
+                        rebuild.BULK_SETTINGS if rebuilder else None)
+    if args.details and not dump:
+        post_movie_details.create_mapping(es, names['movie_details'])
+    if args.similar and not dump:
+        # Similar movies are always re-computed in full, drop stale ones
+        if not rebuilder:
+            es.indices.delete(index=names['movie_similar'], ignore=404)
+        create_similar_mapping(es, names['movie_similar'])
+
+    movies_fn  = archive.path(args.lens, 'movies.dat')
+    ratings_fn = archive.path(args.lens, 'ratings.dat')
+    tags_fn    = archive.path(args.lens, 'tags.dat')
+
+    # Checkpoints per index; 'users' offsets refer to 'ratings.dat'
+    ckpt_names = ['movies', 'ratings', 'tags', 'users']
+    ckpt_files = [movies_fn, ratings_fn, tags_fn, ratings_fn]
+    if args.details:
+        ckpt_names.append('movie_details')
+        ckpt_files.append(archive.path(args.details, 'movies.dat'))
+    ckpts = checkpoint.checkpoints(args.checkpoints, ckpt_names, ckpt_files)
+    for c in ckpts.values():
+        if args.resume and args.clear != 'true':
+            c.load()
+        else:
+            c.clear()
+
+    # Content hashes of the documents indexed, only kept by --delta runs.
+    #  Other loads remove the manifests of earlier runs, which no longer
+    #  match the indices.
+    mfsts = {}
+    if args.delta:
+        mfsts = dict( (n, manifest.manifest(args.manifests, n))
+                        for n in ('movies', 'ratings', 'tags', 'users') )
+        if args.clear != 'true' and not args.rebuild:
+            for n, m in mfsts.items():
+                print "%s: %s documents in manifest." % (n, m.load())
+    elif not dump and os.path.isdir(args.manifests):
+        for n in ('movies', 'ratings', 'tags', 'users'):
+            manifest.manifest(args.manifests, n).clear()
 
     # Generate "users" index w/ movies rated per user
-    #  This index is generated on the fly when parsing 'ratings.dat'
+    #  This index is generated on the fly when parsing 'ratings.dat', which
+    #  requires 'ratings.dat' to be sorted by UserID. When resuming, user
+    #  documents are re-generated starting w/ the first user not acknowledged
+    #  yet ('users_from').
+    #  With --users-sort-mb, ratings are grouped by an external sort instead
+    #  ('users_sort'), and user documents are generated after the ratings
+    #  pass. This works for any order of ratings, but always re-generates all
+    #  users.
     user_id=None
-    ratings_buf= ""
-    users_buf= ""
-    users_scount = 0
-    users_count = 0
-    users_header = '{"index": {"_index": "users", "_type": "user"}}'
-    users_bulk = 500
-    users_q = Queue(50)
-    users_es = elasticsearch.Elasticsearch()
-    users_es.bulk_size = 1
-    users_t = Thread(target=index_writer,
-                     args=(users_es, users_q, "users", "user"))
-    users_t.start()
+    user_ratings = []
+    users_done = set()
+    users_warned = False
+    users_mfst = mfsts.get('users')
+    users_opts = run_opts(names['users'])
+    users_metrics = users_opts['metrics']
+    users_buf = bulk.bulk_buffer(bulk_bytes, users_metrics,
+                                                        users_opts['control'])
+    users_sort = None
+    if args.users_sort_mb:
+        users_sort = extsort.external_sort(args.users_sort_mb * 1024 * 1024)
+        ckpts['users'].clear()
+        ckpts['users'] = None
+    users_from = ckpts['users'].offset if ckpts['users'] else 0
+    users_scount = ckpts['users'].docs if ckpts['users'] else 0
+    users_count = users_scount
+    users_header = '{"%%s": {"_index": "%s", "_type": "user", "_id": "%%s"}}' \
+                                                            % names['users']
+    users_prog = bulk.progress(out=None, start=users_scount,
+                                checkpoint=ckpts['users'])
+    users_pool = None
 
     # Extract movie titles when parsing 'movies.dat'
     titles = {}
@@ -301,43 +1222,223 @@ if __name__ == "__main__":
         titles[fields[0]] = json.dumps(fields[1])
         return ""
 
+    # Queue the 'users' bulk buffer if full (or if 'force' is set).
+    #  'offset' is the 'ratings.dat' offset of the first user not in the
+    #  buffer.
+    def flush_users(offset, force=False):
+        global users_scount
+        if users_buf.full() or (force and users_scount < users_count):
+            users_pool.put((users_scount, users_count, users_buf.take(),
+                                                            offset, None))
+            users_scount = users_count
+
+    # Add the documents of the current user to the 'users' bulk buffer
+    def add_user():
+        global users_count, users_warned
+        if not users_sort:
+            if user_id in users_done and not users_warned:
+                users_warned = True
+                print ("\nWARNING: ratings of user %s are not contiguous,"
+                       + " 'users' documents will be incomplete. Use"
+                       + " --users-sort-mb for unsorted ratings.") % user_id
+            users_done.add(user_id)
+        for i, doc in user_docs(user_id, user_ratings, args.user_chunk):
+            if not users_mfst or users_mfst.changed(i, doc):
+                users_buf.add(users_header % ("index", i), doc)
+                users_count = users_count + 1
+
     # Callbakc to generate 'users' index and append movie titles
     #  to ratings documents. 'users' index was inspired by a script
     #  by Mark Karwood.
-    def gen_users_and_append_titles(fields):
-        global user_id, ratings_buf, users_buf, users_scount, users_count
+    def gen_users_and_append_titles(fields, offset):
+        global user_id, user_ratings
+        if rstats is not None and not args.cache:
+            rstats.add(*fields)
+        if offset < users_from:
+            return '"Title":%s ' % titles[fields[1]]
+        rating = '{"MovieID":%d,"Title":%s,"Rating":%r}'                 \
+                        % (int(fields[1]), titles[fields[1]], float(fields[2]))
+        if users_sort:
+            users_sort.add(int(fields[0]), rating)
+            return '"Title":%s ' % titles[fields[1]]
         if user_id and user_id != fields[0]:
-            users_buf = users_buf + '%s\n%s\n' \
-                        % (users_header, '{"UserID":"%s","Ratings":[%s]}' \
-                                             % (fields[0], ratings_buf[:-1]))
-            ratings_buf = ''
-            users_count = users_count + 1
-            if users_count % users_bulk == 0:
-                users_q.put((users_scount,users_count,users_buf,None,None))
-                users_buf = ''
+            add_user()
+            user_ratings = []
+            flush_users(offset)
         user_id = fields[0]
-        rating = '{"MovieID": "%s", "Title":%s, "Rating":"%s"},'         \
-                             % (fields[1], titles[fields[1]], fields[2])
-        ratings_buf = ratings_buf + rating
+        user_ratings.append(rating)
         return '"Title":%s ' % titles[fields[1]]
 
-    # Parse movies, ratings, and tags
-    index_file(es, os.path.join(args.lens, 'movies.dat'),
-                ("MovieID", "Title", "Genres"), 'movies', 'movie',
-                extract_titles)
-    sys.stdout.write("Generating + Indexing 'users', ")
-    # this will also geerate the 'users' index
-    index_file(es, os.path.join(args.lens,'ratings.dat'),
-            ("UserID", "MovieID", "Rating", "Timestamp"), 'ratings', 'rating',
-                gen_users_and_append_titles)
-    index_file(es, os.path.join(args.lens,'tags.dat'),
-            ("UserID", "MovieID", "Tag", "Timestamp"), 'tags', 'tag')
-
-    # Write the last user document
-    users_buf = users_buf + '%s\n%s\n' \
-                % (users_header, '{"UserID":"%s","Ratings":[%s]}\n' \
-                                             % (user_id, ratings_buf[:-1]))
-    users_q.put((users_scount,users_count,users_buf,None,None))
-    users_q.put("quit")
-    users_t.join()
+    # Loads of the indices, run by a scheduler
+    def load_movies():
+        index_file(es, movies_fn,
+                ("MovieID", "Title", "Genres"), names['movies'], 'movie',
+                extract_titles, args.qlen, bulk_bytes,
+                parse_workers=args.parse_workers, writers=args.writers,
+                sender=sender, checkpoint=ckpts['movies'], replay_from=0,
+                id_fields=("MovieID",), manifest=mfsts.get('movies'),
+                cache=args.cache, in_flight=in_flight,
+                keep=keep(("MovieID", "Title", "Genres")), export=dump,
+                **run_opts(names['movies']))
+
+    def load_ratings():
+        global users_pool
+        users_pool = start_writers(es, names['users'], "user", users_prog,
+                                sender, args.writers, args.qlen, in_flight,
+                                users_metrics, users_opts['control'], dump)
+        try:
+            index_ratings()
+        except:
+            users_pool.cancel()
+            raise
+
+    def index_ratings():
+        sys.stdout.write("Generating + Indexing 'users', ")
+        # this will also geerate the 'users' index
+        ratings_sz = index_file(es, ratings_fn,
+            ("UserID", "MovieID", "Rating", "Timestamp"), names['ratings'],
+                'rating',
+                gen_users_and_append_titles, args.qlen, bulk_bytes,
+                parse_workers=args.parse_workers, writers=args.writers,
+                sender=sender, checkpoint=ckpts['ratings'],
+                replay_from=0 if rstats is not None and not args.cache
+                                                        else users_from,
+                offsets=True, id_fields=("UserID", "MovieID"),
+                manifest=mfsts.get('ratings'),
+                cache=args.cache, in_flight=in_flight, period=args.partition,
+                keep=keep(("UserID", "MovieID", "Rating", "Timestamp")),
+                export=dump, **run_opts(names['ratings']))
+        if rstats is not None and args.cache:
+            # Use the cached columns of all ratings instead of parsed lines
+            import colcache
+            tbl = colcache.table(ratings_fn, "::", field_kinds(("UserID",
+                            "MovieID", "Rating", "Timestamp")), args.cache)
+            cols = [ tbl.column(i) for i in range(4) ]
+            if smp:
+                kept = smp.mask("user", cols[0]) & smp.mask("movie", cols[1])
+                cols = [ c[kept] for c in cols ]
+            rstats.add_columns(*cols)
+        finish_users(ratings_sz)
+
+    def load_tags():
+        index_file(es, tags_fn,
+            ("UserID", "MovieID", "Tag", "Timestamp"), names['tags'], 'tag',
+                qlen=args.qlen, bulk_bytes=bulk_bytes,
+                parse_workers=args.parse_workers, writers=args.writers,
+                sender=sender, checkpoint=ckpts['tags'],
+                id_fields=("UserID", "MovieID", "Timestamp"),
+                manifest=mfsts.get('tags'), cache=args.cache,
+                in_flight=in_flight, period=args.partition,
+                keep=keep(("UserID", "MovieID", "Tag", "Timestamp")),
+                export=dump, **run_opts(names['tags']))
+
+    def load_details():
+        tag_names, skipped = post_movie_details.parse_tags(args.details,
+                                                                "tags.dat")
+        post_movie_details.index(es, args.details, tag_names, args.qlen,
+                bulk_bytes, writers=args.writers, sender=sender,
+                checkpoint=ckpts['movie_details'],
+                index_name=names['movie_details'], cache=args.cache,
+                in_flight=in_flight, parse_workers=args.parse_workers,
+                keep=keep(("MovieID",)), export=dump,
+                **run_opts(names['movie_details']))
+
+    # Write the remaining users once all ratings were parsed
+    def finish_users(ratings_sz):
+        global user_id, user_ratings, users_count
+
+        # Write the users of the external sort
+        if users_sort:
+            print "Merging %s sorted runs of 'users'." % users_sort.runs()
+            for user_id, user_ratings in users_sort.groups():
+                if loads.stop.is_set():
+                    raise KeyboardInterrupt
+                user_id = str(user_id)
+                add_user()
+                flush_users(None)
+            user_id = None
+
+        # Write the last user document, and delete users which are gone
+        if user_id:
+            add_user()
+        if users_mfst and not users_from:
+            for i in users_mfst.removed():
+                users_buf.add(users_header % ("delete", i))
+                users_count = users_count + 1
+                flush_users(ratings_sz)
+        flush_users(ratings_sz, force=True)
+        users_pool.stop()
+        print "Users: %s" % users_prog.summary()
+        if users_metrics:
+            users_metrics.finish()
+            print "   %s" % users_metrics.summary()
+        if users_mfst and not users_from:
+            save_manifest(users_mfst, users_prog)
+
+    # Add rating statistics to 'movies' and 'users' once all users exist
+    def load_stats():
+        print "Computing rating statistics of %s ratings." % len(rstats)
+        update_docs(es, ( (i, d) for i, d in stats.fields(rstats.movies())
+                                                        if i in titles ),
+                        names['movies'], 'movie', args.qlen, bulk_bytes,
+                        args.writers, sender, in_flight=in_flight,
+                        export=dump, **run_opts(names['movies'] + "-stats"))
+        # Users w/ several chunks get their statistics in each chunk
+        ust = rstats.users()
+        update_docs(es, ( (c, d) for (i, d), n in izip(stats.fields(ust),
+                                                                ust["count"])
+                            for c in user_chunk_ids(i, n, args.user_chunk) ),
+                        names['users'], 'user',
+                        args.qlen, bulk_bytes, args.writers, sender,
+                        in_flight=in_flight, export=dump,
+                        **run_opts(names['users'] + "-stats"))
+
+    # Index the movies liked together most significantly w/ each movie
+    def load_similar():
+        users, movies, ratings, ts = rstats.columns()
+        print "Computing similar movies of %s ratings." % len(ratings)
+        post_docs(es, similar.docs(similar.neighbours(users, movies, ratings,
+                        args.similar_top, args.like_rating,
+                        args.similar_score), titles),
+                    names['movie_similar'], 'similar', qlen=args.qlen,
+                    bulk_bytes=bulk_bytes, writers=args.writers,
+                    sender=sender, in_flight=in_flight, export=dump,
+                    **run_opts(names['movie_similar']))
+
+    # Movies go first, their titles are added to ratings and users. Tags
+    #  and movie details do not depend on any other index, so they are
+    #  loaded alongside.
+    loads.add("movies", load_movies)
+    loads.add("ratings", load_ratings, after=("movies",))
+    loads.add("tags", load_tags)
+    if args.details:
+        loads.add("movie_details", load_details)
+    if args.stats:
+        loads.add("stats", load_stats, after=("ratings",))
+    if args.similar:
+        loads.add("movie_similar", load_similar, after=("ratings",))
+    failed = loads.run()
+    print "Loads: %s" % loads.summary()
 
+    if exporter:
+        exporter.close()
+    failures.close()
+    if failures.count:
+        print "%s failed documents written to %s." % (failures.count,
+                                                        failures.fname)
+    if failed:
+        sys.exit("Loads %s did not complete; fix the cause and run again%s."
+                 % (", ".join(failed),
+                    "" if dump or args.delta else " w/ --resume"))
+    if dump:
+        print "Exported to %s; load w/ ./replay.py %s" % (args.export,
+                                                                args.export)
+    elif rebuilder:
+        rebuilder.finish(args.checkpoints)
+    else:
+        for n in partitioned:
+            partition.alias(es, n, partition.buckets(es, n))
+    if args.freeze:
+        # The latest bucket may still get new documents
+        for n in partitioned:
+            partition.freeze(es, partition.buckets(es, names[n])[:-1])
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+#
+# Zero-downtime index rebuilds for the movielens / hetrec indexing tools.
+#
+# This file is licensed to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import os
+import time
+import partition
+
+# Index settings used while bulk loading: no refreshes, no replicas
+BULK_SETTINGS = {"index": {"refresh_interval": "-1", "number_of_replicas": 0}}
+
+
+def _version_file(cdir, aliases):
+    return os.path.join(cdir, "%s.rebuild" % "+".join(sorted(aliases)))
+
+
+def pending(cdir, aliases):
+    """Return the version of an unfinished rebuild, or None.
+
+       Arguments:
+       cdir    -- directory passed to rebuild.save()
+       aliases -- array of alias names rebuilt
+    """
+    try:
+        with open(_version_file(cdir, aliases)) as f:
+            return f.read().strip() or None
+    except IOError:
+        return None
+
+
+class rebuild(object):
+    """Rebuild a set of indices behind aliases, w/o downtime.
+
+       Each alias (e.g. 'movies') gets a new, versioned index (e.g.
+       'movies-20141201120000') created with BULK_SETTINGS. Once loaded,
+       finish() restores refresh and replica settings, force-merges the new
+       indices, and atomically moves the aliases over to them. Queries keep
+       hitting the old indices until the very moment of the alias swap.
+
+       The version is recorded in a file so an interrupted rebuild can be
+       resumed into the same indices, see save() and pending().
+
+       A 'partitioned' alias gets the time buckets of its versioned index
+       name (e.g. 'ratings-20141201120000-2009', see partition.py)
+       instead, which are created on their first write from a template,
+       and the alias is moved to all of them.
+    """
+    def __init__(self, es, aliases, version=None, replicas=1,
+                    refresh_interval="1s", keep_old=False, partitioned=()):
+        """Arguments:
+           es       -- elasticsearch client instance
+           aliases  -- array of alias names to rebuild
+
+           Keyword arguments:
+           version          -- version suffix of the new indices; defaults
+                                to the current time
+           replicas         -- number of replicas to restore after loading
+           refresh_interval -- refresh interval to restore after loading
+           keep_old         -- do not delete indices the aliases pointed to
+           partitioned      -- aliases of time-partitioned indices
+        """
+        self.es       = es
+        self.aliases  = aliases
+        self.version  = version or time.strftime("%Y%m%d%H%M%S")
+        self.replicas = replicas
+        self.refresh  = refresh_interval
+        self.keep_old = keep_old
+        self.partitioned = partitioned
+
+    def name(self, alias):
+        """Return the versioned index name for an alias."""
+        return "%s-%s" % (alias, self.version)
+
+    def names(self):
+        """Return a dict of versioned index names, keyed by alias."""
+        return dict( (a, self.name(a)) for a in self.aliases )
+
+    def indices(self, alias):
+        """Return the versioned indices of an alias, i.e. its versioned
+            index or, if partitioned, the buckets created so far."""
+        if alias in self.partitioned:
+            return partition.buckets(self.es, self.name(alias))
+        return [ self.name(alias) ]
+
+    def create(self):
+        """Create the versioned indices w/ bulk load settings, except
+            partitioned ones."""
+        for a in self.aliases:
+            if a in self.partitioned:
+                continue
+            self.es.indices.create(index=self.name(a),
+                                    body={"settings": BULK_SETTINGS},
+                                    ignore=400)
+
+    def save(self, cdir):
+        """Record the version in directory 'cdir', see pending()."""
+        if not os.path.isdir(cdir):
+            os.makedirs(cdir)
+        with open(_version_file(cdir, self.aliases), "w") as f:
+            f.write(self.version)
+
+    def __current(self, alias):
+        """Return the indices an alias currently points to."""
+        res = self.es.indices.get_alias(name=alias, ignore=404)
+        return [ i for i, v in res.items()
+                    if isinstance(v, dict) and alias in v.get("aliases", {}) ]
+
+    def finish(self, cdir=None):
+        """Restore settings, force-merge, and swap the aliases.
+
+           Keyword arguments:
+           cdir -- directory passed to save(); the version record is
+                    removed from it once the aliases were swapped
+        """
+        new = dict( (a, self.indices(a)) for a in self.aliases )
+        all_new = ",".join([ i for a in self.aliases for i in new[a] ])
+        print "Restoring index settings of %s." % all_new
+        self.es.indices.put_settings(index=all_new,
+                                body={"index": {
+                                    "refresh_interval": self.refresh,
+                                    "number_of_replicas": self.replicas}})
+        print "Force-merging %s." % all_new
+        self.es.indices.optimize(index=all_new,
+                                    max_num_segments=1, request_timeout=3600)
+        for a in self.partitioned:
+            self.es.indices.delete_template(name=self.name(a), ignore=404)
+
+        actions = []
+        old     = []
+        for a in self.aliases:
+            cur = self.__current(a)
+            if not cur and self.es.indices.exists(index=a):
+                # A concrete index is in the way of the alias. This only
+                #  happens once, when migrating from non-aliased indices.
+                print "Deleting index %s to replace it by an alias." % a
+                self.es.indices.delete(index=a)
+            actions.extend([ {"remove": {"index": i, "alias": a}}
+                                            for i in cur if i not in new[a] ])
+            actions.extend([ {"add": {"index": i, "alias": a}}
+                                                            for i in new[a] ])
+            old.extend([ i for i in cur if i not in new[a] ])
+        print "Moving aliases %s." % ", ".join(self.aliases)
+        self.es.indices.update_aliases(body={"actions": actions})
+
+        if old and not self.keep_old:
+            print "Deleting old indices %s." % ", ".join(old)
+            self.es.indices.delete(index=",".join(old))
+        if cdir and os.path.exists(_version_file(cdir, self.aliases)):
+            os.remove(_version_file(cdir, self.aliases))
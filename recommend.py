@@ -0,0 +1,424 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+#
+# Recommendation queries against the movielens / hetrec indices, batched
+#  into multi-searches and cached.
+#
+# This file is licensed to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import argparse
+import json
+import sys
+import time
+import bulk
+
+from collections import OrderedDict
+from threading import Lock
+
+# Cache size (number of responses) and time to live (seconds)
+CACHE_SIZE = 10000
+CACHE_TTL  = 300
+
+# Interval of checks for swapped aliases, i.e. finished rebuilds, seconds
+CHECK_INTERVAL = 10
+
+# Number of 'users' documents (chunks) fetched per user and search
+USER_PAGE = 10
+
+# Indices queried, which rebuild.rebuild may move aliases of
+ALIASES = ("movie_similar", "users", "movie_details")
+
+
+def normalize(header, body):
+    """Return the cache key of a search: its header and body as JSON w/
+        sorted keys and w/o whitespace, so equal searches share a key no
+        matter how they were written.
+
+       Arguments:
+       header -- dict of the multi-search header, e.g. {"index": "users"}
+       body   -- dict of the search body
+    """
+    return json.dumps([header, body], sort_keys=True, separators=(",", ":"))
+
+
+class query_cache(object):
+    """LRU cache of search responses w/ a time to live.
+
+       Responses are evicted when they were not used for the longest time
+       once more than 'size' are cached, and expire 'ttl' seconds after
+       they were added. The cache is safe to share between threads.
+    """
+    def __init__(self, size=CACHE_SIZE, ttl=CACHE_TTL):
+        """Keyword arguments:
+           size -- max number of responses cached, 0 to disable the cache
+           ttl  -- seconds a response stays valid
+        """
+        self.size    = size
+        self.ttl     = ttl
+        self.hits    = 0
+        self.misses  = 0
+        self.__items = OrderedDict()
+        self.__lock  = Lock()
+
+    def get(self, key):
+        """Return the cached response for 'key', or None."""
+        with self.__lock:
+            item = self.__items.pop(key, None)
+            if item is None or item[0] < time.time():
+                self.misses += 1
+                return None
+            self.__items[key] = item
+            self.hits += 1
+            return item[1]
+
+    def put(self, key, value):
+        """Cache response 'value' for 'key'."""
+        if not self.size:
+            return
+        with self.__lock:
+            self.__items.pop(key, None)
+            self.__items[key] = (time.time() + self.ttl, value)
+            while len(self.__items) > self.size:
+                self.__items.popitem(last=False)
+
+    def clear(self):
+        """Drop all cached responses."""
+        with self.__lock:
+            self.__items.clear()
+
+    def __len__(self):
+        with self.__lock:
+            return len(self.__items)
+
+    def summary(self):
+        """Return a one-line summary of cache hits and misses."""
+        with self.__lock:
+            return "%s cached, %s hits, %s misses." % (len(self.__items),
+                                                    self.hits, self.misses)
+
+
+def similar_search(movie_id):
+    """Return the (header, body) of the search for the 'movie_similar'
+        document of a movie, see post_movies.py --similar."""
+    return ({"index": "movie_similar"},
+            {"query": {"ids": {"values": [str(int(movie_id))]}}, "size": 1})
+
+
+def also_liked_search(title, min_rating=4.0, size=10):
+    """Return the (header, body) of the significant terms aggregation on
+        the titles of movies rated by users who rated movie 'title'
+        'min_rating' or better.
+
+       This runs over the nested ratings of all those users, so is costly;
+       post_movies.py --similar precomputes movies liked together, see
+       similar_search(). For users split into several documents (see
+       post_movies.py --user-chunk), only the chunks rating 'title' are
+       aggregated.
+    """
+    return ({"index": "users", "search_type": "count"},
+            {"query": {"nested": {"path": "Ratings", "query": {"bool": {
+                "must": [
+                    {"range": {"Ratings.Rating": {"gte": float(min_rating)}}},
+                    {"match_phrase": {"Ratings.Title": title.strip()}} ]}}}},
+             "aggs": {"Ratings": {"nested": {"path": "Ratings"},
+                "aggs": {"Title": {"significant_terms": {
+                    "field": "Ratings.Title.raw", "size": int(size) + 1}}}}}})
+
+
+def user_search(user_id, start=0, size=USER_PAGE):
+    """Return the (header, body) of the search for the 'users' documents
+        of a user, chunks 'start' to 'start' + 'size', in order of their
+        Chunk. Documents w/o Chunk, i.e. loaded w/ --user-chunk 0, come
+        first."""
+    return ({"index": "users"},
+            {"query": {"term": {"UserID": int(user_id)}},
+             "sort": [{"Chunk": {"order": "asc", "missing": "_first",
+                                 "ignore_unmapped": True}}],
+             "from": int(start), "size": int(size)})
+
+
+def more_like_this_search(movie_ids, fields=("genres",), size=10):
+    """Return the (header, body) of a more_like_this search for movies
+        like movies 'movie_ids' in 'movie_details', see
+        post_movie_details.py."""
+    ids = sorted(set([ int(i) for i in movie_ids ]))
+    return ({"index": "movie_details"},
+            {"query": {"more_like_this": {"fields": sorted(fields),
+                                          "ids": ids, "min_term_freq": 1,
+                                          "max_query_terms": 5}},
+             "size": int(size)})
+
+
+class recommender(object):
+    """Runs recommendation searches, batched into multi-searches and
+        cached.
+
+       All searches of a call go to Elasticsearch in one '_msearch'
+       request, except those answered from the cache. Error responses are
+       not cached. Every 'check_interval' seconds, the indices behind
+       'aliases' are looked up before a search; if they changed, i.e. a
+       rebuild finished (see rebuild.py), the cache is cleared, so no
+       results of replaced indices are served.
+
+       E.g.
+
+        r = recommender(bulk.client(1))
+        for movie_id, similar in zip(ids, r.similar(ids)):
+            ...
+    """
+    def __init__(self, es, cache=None, aliases=ALIASES,
+                    check_interval=CHECK_INTERVAL):
+        """Arguments:
+           es             -- elasticsearch client instance
+
+           Keyword arguments:
+           cache          -- query_cache instance, None for a default one
+           aliases        -- names of the indices / aliases queried
+           check_interval -- seconds between alias checks, None for no
+                              checks
+        """
+        self.es             = es
+        self.cache          = cache if cache is not None else query_cache()
+        self.aliases        = aliases
+        self.check_interval = check_interval
+        self.searches       = 0
+        self.__indices      = None
+        self.__checked      = 0
+        self.__lock         = Lock()
+
+    def __current(self):
+        """Return the set of (index, alias) pairs of 'aliases'."""
+        res = self.es.indices.get_alias(name=",".join(self.aliases),
+                                                                ignore=404)
+        return frozenset([ (i, a) for i, v in res.items()
+                                        if isinstance(v, dict)
+                                for a in v.get("aliases", {}) ])
+
+    def check(self):
+        """Clear the cache if the indices behind the aliases changed since
+            the last check."""
+        with self.__lock:
+            self.__checked = time.time()
+            cur = self.__current()
+            if self.__indices is not None and cur != self.__indices:
+                print "Indices of %s changed, clearing the cache." % (
+                                                    ", ".join(self.aliases))
+                self.cache.clear()
+            self.__indices = cur
+
+    def search(self, searches):
+        """Run searches, and return their responses.
+
+           Arguments:
+           searches -- array of (header, body) tuples, see e.g.
+                        similar_search()
+
+           Returns:
+           array of response dicts, in the order of 'searches'; responses
+           of failed searches hold an "error"
+        """
+        if self.check_interval is not None \
+                and time.time() - self.__checked >= self.check_interval:
+            self.check()
+        keys = [ normalize(h, b) for h, b in searches ]
+        ret  = [ self.cache.get(k) for k in keys ]
+        # Search each distinct query missing only once
+        missing = OrderedDict()
+        for i, k in enumerate(keys):
+            if ret[i] is None:
+                missing.setdefault(k, []).append(i)
+        if missing:
+            body = []
+            for k, idx in missing.items():
+                body.extend(searches[idx[0]])
+            res = self.es.msearch(body=body)["responses"]
+            self.searches += len(res)
+            for (k, idx), r in zip(missing.items(), res):
+                if "error" not in r:
+                    self.cache.put(k, r)
+                for i in idx:
+                    ret[i] = r
+        return ret
+
+    def __results(self, searches, searches_of):
+        res = self.search(searches)
+        for (h, b), r in zip(searches, res):
+            if "error" in r:
+                raise RuntimeError("Search in %s failed: %s" % (h["index"],
+                                                                r["error"]))
+        return [ searches_of(r) for r in res ]
+
+    def similar(self, movie_ids, size=10):
+        """Return the movies liked together w/ each of 'movie_ids'.
+
+           Returns:
+           array of arrays of {"MovieID", "Title", "Score", "Count"} dicts,
+           most significant first; empty for movies w/o similar movies
+        """
+        def similar_of(r):
+            hits = r["hits"]["hits"]
+            return hits[0]["_source"]["Similar"][:size] if hits else []
+        return self.__results([ similar_search(i) for i in movie_ids ],
+                                                                similar_of)
+
+    def also_liked(self, titles, min_rating=4.0, size=10):
+        """Return the movies significantly often rated 'min_rating' or
+            better by users who rated each of 'titles' as well.
+
+           Returns:
+           array of arrays of {"Title", "Score", "Count"} dicts, most
+           significant first
+        """
+        ret = self.__results([ also_liked_search(t, min_rating, size)
+                                                    for t in titles ],
+            lambda r: [ {"Title": b["key"], "Score": b["score"],
+                         "Count": b["doc_count"]}
+                        for b in r.get("aggregations", {}).get("Ratings",
+                            {}).get("Title", {}).get("buckets", []) ])
+        # The movie itself, w/ or w/o its year, is liked by all these users
+        own = lambda t, m: m["Title"] == t or m["Title"].startswith(t + " (")
+        return [ [ m for m in movies if not own(t.strip(), m) ][:size]
+                                        for t, movies in zip(titles, ret) ]
+
+    def user_ratings(self, user_ids, page=USER_PAGE):
+        """Return the ratings of each of 'user_ids', stitched together
+            from the chunks of the user (see post_movies.user_docs()).
+
+           The chunks of all users are searched 'page' per user and
+           multi-search, so responses stay bounded no matter how many
+           ratings a user has; users w/ more chunks are searched again for
+           the next page.
+
+           Returns:
+           array of arrays of {"MovieID", "Title", "Rating"} dicts, in the
+           order they were indexed; empty for unknown users
+        """
+        ret = [ [] for i in user_ids ]
+        todo = [ (n, 0) for n in range(len(user_ids)) ]
+        while todo:
+            res = self.__results([ user_search(user_ids[n], start, page)
+                                            for n, start in todo ],
+                                                        lambda r: r["hits"])
+            more = []
+            for (n, start), hits in zip(todo, res):
+                for h in hits["hits"]:
+                    ret[n].extend(h["_source"].get("Ratings", []))
+                if hits["hits"] and start + page < hits["total"]:
+                    more.append((n, start + page))
+            todo = more
+        return ret
+
+    def more_like_this(self, movie_id_sets, fields=("genres",), size=10):
+        """Return the movies like each set of movies in 'movie_id_sets'.
+
+           Returns:
+           array of arrays of {"MovieID", "Title", "Score"} dicts, best
+           match first
+        """
+        return self.__results([ more_like_this_search(s, fields, size)
+                                                for s in movie_id_sets ],
+            lambda r: [ {"MovieID": int(h["_id"]),
+                         "Title": h.get("_source", {}).get("title"),
+                         "Score": h["_score"]} for h in r["hits"]["hits"] ])
+
+
+def cmdl_args():
+    """Parse command line arguments
+
+       Returns
+        argparse instance ready to use
+    """
+    parser = argparse.ArgumentParser(
+                description='Query movie recommendations from a running'
+                 + ' elasticsearch instance loaded by post_movies.py and'
+                 + ' post_movie_details.py.')
+    parser.add_argument('query', choices=('similar', 'also-liked',
+                                        'more-like-this', 'user-ratings'),
+        help='"similar": movies liked together w/ a MovieID, see'
+             + ' post_movies.py --similar; "also-liked": significant terms'
+             + ' aggregation on users who liked a title; "more-like-this":'
+             + ' movies like a comma separated list of MovieIDs in'
+             + ' "movie_details"; "user-ratings": all ratings of a UserID,'
+             + ' stitched together from its "users" documents.')
+    parser.add_argument('movies', metavar='movie', nargs='+',
+        help='MovieID, title, MovieIDs, or UserID, depending on the query;'
+             + ' all are searched in one multi-search.')
+    parser.add_argument('--size', metavar='size', type=int, dest='size',
+        default=10, help='Number of movies per result (default: 10).')
+    parser.add_argument('--min-rating', metavar='rating', type=float,
+        dest='min_rating', default=4.0,
+        help='Min rating of a movie liked, for also-liked (default: 4.0).')
+    parser.add_argument('--fields', metavar='fields', dest='fields',
+        default='genres',
+        help='Comma separated fields to compare, for more-like-this'
+             + ' (default: genres).')
+    parser.add_argument('--repeat', metavar='times', type=int,
+        dest='repeat', default=1,
+        help='Run the queries this many times and print timings, e.g. to'
+             + ' see the effect of the cache (default: 1).')
+    parser.add_argument('--cache-size', metavar='responses', type=int,
+        dest='cache_size', default=CACHE_SIZE,
+        help='Max number of responses cached, 0 for no cache (default: %s).'
+                                                                % CACHE_SIZE)
+    parser.add_argument('--ttl', metavar='seconds', type=float, dest='ttl',
+        default=CACHE_TTL,
+        help='Seconds cached responses stay valid (default: %s).' % CACHE_TTL)
+
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    """ This script queries movie recommendations, e.g.
+
+        ./recommend.py similar 2571 1196
+        ./recommend.py also-liked "Planet Terror"
+        ./recommend.py more-like-this 54995,8903
+        ./recommend.py user-ratings 75
+
+        Services running many such queries should use the recommender
+        class, which batches the queries of a page into one '_msearch'
+        request and caches responses until they expire or a rebuild swaps
+        the aliases.
+    """
+    args = cmdl_args()
+    rec  = recommender(bulk.client(1),
+                        query_cache(args.cache_size, args.ttl))
+
+    if args.query == 'similar':
+        run = lambda: rec.similar(args.movies, args.size)
+    elif args.query == 'also-liked':
+        run = lambda: rec.also_liked(args.movies, args.min_rating, args.size)
+    elif args.query == 'more-like-this':
+        run = lambda: rec.more_like_this([ m.split(",") for m in args.movies ],
+                                        args.fields.split(","), args.size)
+    else:
+        run = lambda: rec.user_ratings(args.movies)
+
+    for n in range(args.repeat):
+        t = time.time()
+        try:
+            res = run()
+        except (RuntimeError, ValueError), e:
+            sys.exit(str(e))
+        if args.repeat > 1:
+            print "Run %s: %.1f ms" % (n + 1, (time.time() - t) * 1000)
+
+    for movie, movies in zip(args.movies, res):
+        print "%s:" % movie
+        for m in movies:
+            print "   %8.3f  %s" % (m.get("Score", m.get("Rating")),
+                                    m.get("Title") or m.get("MovieID"))
+    if args.repeat > 1:
+        print "Cache: %s" % rec.cache.summary()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+#
+# Replay of the bulk bodies exported by post_movies.py and
+#  post_movie_details.py (--export) into an Elasticsearch cluster.
+#
+# This file is licensed to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import argparse
+import os
+import sys
+import time
+import bulk
+import export
+import post_movies
+import post_movie_details
+
+from threading import Event, Lock, Thread
+
+
+def replay_stream(directory, stream, pool, prog, bulk_bytes=bulk.BULK_BYTES):
+    """Queue the actions of an exported stream to a writer pool.
+
+       The shard files of the stream are read concurrently, one thread
+       each, and their actions re-assembled into bulk bodies of
+       'bulk_bytes', so the bulk size may differ from the exported one.
+       Documents are numbered in the order their bodies are queued, for
+       'prog'. On KeyboardInterrupt, the readers stop before it is raised.
+
+       Arguments:
+       directory -- export directory
+       stream    -- stream dict, see export.streams()
+       pool      -- writer pool to put() bulk batches to, see
+                     post_movies.start_writers()
+       prog      -- bulk.progress instance 'pool' reports to
+
+       Keyword arguments:
+       bulk_bytes -- byte budget of a bulk write, see bulk.bulk_buffer
+    """
+    lock   = Lock()
+    queued = [0, 0]
+    errors = []
+    total  = max(stream["bytes"], 1)
+    stop   = Event()
+
+    def put(buf):
+        with lock:
+            start = queued[0]
+            queued[0] += len(buf)
+            queued[1] += buf.size
+            batch = (start, queued[0], buf.take(), queued[1], total)
+        pool.put(batch)
+
+    def read(fname):
+        try:
+            buf = bulk.bulk_buffer(bulk_bytes)
+            for action, source in export.shard_actions(os.path.join(directory,
+                                                                    fname)):
+                if stop.is_set():
+                    return
+                buf.add(action, source)
+                if buf.full():
+                    put(buf)
+            if len(buf):
+                put(buf)
+        except Exception, e:
+            errors.append("%s: %s" % (fname, e))
+
+    readers = [ Thread(target=read, args=(f,)) for f in stream["files"] ]
+    for t in readers:
+        t.start()
+    try:
+        # Thread.join() w/o a timeout would hold off KeyboardInterrupt
+        for t in readers:
+            while t.is_alive():
+                t.join(1)
+    except KeyboardInterrupt:
+        stop.set()
+        for t in readers:
+            t.join()
+        raise
+    if errors:
+        raise IOError("Reading %s failed: %s" % (stream["stream"],
+                                                        "; ".join(errors)))
+    return queued[0]
+
+
+def create_mappings(es, streams):
+    """Create the indices and mappings of the indices of 'streams', see
+        export.streams(), unless they exist."""
+    indices = set([ s["index"] for s in streams ])
+    if indices & set(('movies', 'ratings', 'tags', 'users')):
+        post_movies.create_mappings(es)
+    if 'movie_details' in indices:
+        post_movie_details.create_mapping(es)
+    if 'movie_similar' in indices:
+        post_movies.create_similar_mapping(es)
+
+
+def cmdl_args():
+    """Parse command line arguments
+
+       Returns
+        argparse instance ready to use
+    """
+    parser = argparse.ArgumentParser(
+                description='Load the bulk bodies exported by post_movies.py'
+                 + ' or post_movie_details.py --export into a running'
+                 + ' elasticsearch instance.')
+    parser.add_argument('directory', metavar='dir',
+        help='Export directory, see --export.')
+    parser.add_argument('--hosts', metavar='hosts', dest='hosts',
+        help='Comma separated Elasticsearch nodes to load into, e.g.'
+             + ' es1:9200,es2:9200 (default: localhost:9200).')
+    parser.add_argument('--mappings', action='store_true', dest='mappings',
+        help='Create the indices and mappings of post_movies.py and'
+             + ' post_movie_details.py first, unless they exist.')
+    parser.add_argument('--writers', metavar='writers', type=int,
+        dest='writers', default=4,
+        help='Number of concurrent bulk writers (default: 4).')
+    parser.add_argument('--qlen', metavar='qlen', type=int, dest='qlen',
+        default=50, help='Max number of bulk writes to queue (default: 50).')
+    parser.add_argument('--engine', dest='engine', default='threads',
+        choices=('threads', 'async'),
+        help='Send bulk writes from --writers threads, or asynchronously'
+             + ' from a single event loop w/ up to --in-flight requests in'
+             + ' flight (default: threads).')
+    parser.add_argument('--in-flight', metavar='requests', type=int,
+        dest='in_flight', default=16,
+        help='Max number of bulk requests in flight of the async engine'
+             + ' (default: 16).')
+    parser.add_argument('--bulk-mb', metavar='MiB', type=int, dest='bulk_mb',
+        default=10, help='Size of a bulk write in MiB (default: 10).')
+    parser.add_argument('--retries', metavar='retries', type=int,
+        dest='retries', default=5,
+        help='Max number of re-tries of rejected documents (default: 5).')
+    parser.add_argument('--dead-letter', metavar='file', dest='dead_letter',
+        default='dead_letter.ndjson',
+        help='File to write documents which failed to index to (default:'
+             + ' dead_letter.ndjson).')
+
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    """ This script loads an export of post_movies.py (or
+        post_movie_details.py) into a cluster, e.g.
+
+        ./post_movies.py --lens ml-10m.zip --stats --export ml-10m-export
+        ./replay.py ml-10m-export --hosts staging:9200 --mappings
+        ./replay.py ml-10m-export --hosts prod1:9200,prod2:9200 --mappings
+
+        Streams are replayed one after another in the order they were
+        exported, so e.g. the --stats updates of 'movies' follow the
+        'movies' documents. The shard files of a stream are read
+        concurrently, and sent by --writers bulk writers.
+    """
+    args = cmdl_args()
+    streams = export.streams(args.directory)
+    in_flight = args.in_flight if args.engine == 'async' else 0
+    es = bulk.client(max(args.writers, in_flight),
+                        args.hosts.split(",") if args.hosts else None)
+    if args.mappings:
+        create_mappings(es, streams)
+
+    failures = bulk.dead_letter(args.dead_letter)
+    sender = bulk.bulk_sender(args.retries, dead_letter=failures)
+    t = time.time()
+    docs = 0
+    for s in streams:
+        print "Replaying %s (%s documents, %s KiB in %s files)" % (
+                s["stream"], s["docs"], s["bytes"] / 1024, len(s["files"]))
+        prog = bulk.progress(label=s["stream"])
+        pool = post_movies.start_writers(es, s["index"], None, prog, sender,
+                                    args.writers, args.qlen, in_flight)
+        try:
+            docs += replay_stream(args.directory, s, pool, prog,
+                                    args.bulk_mb * 1024 * 1024)
+        except KeyboardInterrupt:
+            pool.cancel()
+            failures.close()
+            sys.exit("\nInterrupted; %s of the documents of %s indexed."
+                                                % (prog.indexed, s["stream"]))
+        except:
+            pool.cancel()
+            raise
+        pool.stop()
+        print ""
+        print "   %s" % prog.summary()
+    t = time.time() - t
+    print "Replayed %s documents in %.1f s (%.0f documents/s)." % (docs, t,
+                                                        docs / max(t, 1e-3))
+    failures.close()
+    if failures.count:
+        print "%s failed documents written to %s." % (failures.count,
+                                                        failures.fname)
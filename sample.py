@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+#
+# Deterministic hash-based samples of the movielens / hetrec data sets, for
+#  quick development loads.
+#
+# This file is licensed to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import hashlib
+
+# Fields holding the keys sampled, and the kind of key, which salts the hash
+#  so users and movies w/ the same ID are sampled independently
+KEYS = {"UserID": "user", "MovieID": "movie"}
+
+
+def position(kind, key):
+    """Return the position of a key in [0, 1), derived from its MD5 hash.
+
+       The position only depends on the kind and value of the key, so a
+       sample is the same in every file, process, and run.
+
+       Arguments:
+       kind -- kind of key, a value of KEYS
+       key  -- integer key, e.g. a UserID
+    """
+    return int(hashlib.md5("%s:%d" % (kind, key)).hexdigest()[:8],
+                                                            16) / 4294967296.0
+
+
+class sample(object):
+    """Deterministic subset of the users and movies of a data set.
+
+       A user (movie) is in the sample if the position() of its ID is below
+       'fraction'. A line is kept if all its UserID and MovieID fields are
+       in the sample, so 'ratings.dat', 'tags.dat', and the 'users' index
+       hold the same users, and 'movies.dat' and the hetrec 'movie_*.dat'
+       files the same movies; ratings and tags only refer to movies which
+       are loaded. About 'fraction' squared of the ratings are kept, e.g.
+       1% for 0.1.
+
+       Instances are callable on the split fields of a line, see of(), and
+       can be passed to parser processes.
+    """
+    def __init__(self, fraction, field_types=("UserID", "MovieID")):
+        """Arguments:
+           fraction    -- fraction of users and movies to keep, 0 to 1
+
+           Keyword arguments:
+           field_types -- array of field identifiers of the lines tested,
+                           see post_movies.parse()
+        """
+        self.fraction = fraction
+        self.fields   = [ (i, KEYS[f]) for i, f in enumerate(field_types)
+                                                                if f in KEYS ]
+        self.__keys   = {}
+
+    def of(self, field_types):
+        """Return a sample of the same fraction testing lines of
+            'field_types'."""
+        return sample(self.fraction, field_types)
+
+    def keeps(self, kind, key):
+        """Return True if key 'key' of kind 'kind' is in the sample.
+
+           Keys which are not integers are kept, so the lines holding them
+           are reported by the parser rather than dropped silently.
+        """
+        ret = self.__keys.get((kind, key))
+        if ret is None:
+            try:
+                ret = position(kind, int(key)) < self.fraction
+            except ValueError:
+                ret = True
+            self.__keys[(kind, key)] = ret
+        return ret
+
+    def __call__(self, fields):
+        """Return True if the line of split 'fields' is in the sample."""
+        for i, kind in self.fields:
+            if i < len(fields) and not self.keeps(kind, fields[i]):
+                return False
+        return True
+
+    def mask(self, kind, column):
+        """Return a boolean NumPy array of the keys of 'column' (an integer
+            array, e.g. a colcache.table column) in the sample."""
+        import numpy as np
+        keys, inverse = np.unique(column, return_inverse=True)
+        return np.array([ self.keeps(kind, int(k)) for k in keys ],
+                                                        dtype=bool)[inverse]
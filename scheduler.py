@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+#
+# Dependency-aware scheduler running the index loads of the movielens /
+#  hetrec indexing tools concurrently.
+#
+# This file is licensed to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import time
+import traceback
+
+from threading import Thread, Condition, Event
+
+
+class scheduler(object):
+    """Runs a set of loads, each in a thread of its own, as soon as the
+        loads they depend on completed.
+
+       Loads are added w/ add() in an order that respects their
+       dependencies, i.e. a load may only depend on loads added before it;
+       with 'max_parallel' set to 1, loads run one after another in that
+       order. A load which raises an exception is reported w/ its traceback;
+       loads depending on it are skipped, all other loads still run.
+
+       Once run() is interrupted (Ctrl-C), the 'stop' event is set, and
+       loads not started yet are skipped. Loads are expected to check the
+       event, stop their writers, and raise KeyboardInterrupt (see
+       post_movies.index_file()); run() waits for them to do so, as their
+       writer threads would keep the process alive otherwise.
+
+       E.g.
+
+        s = scheduler()
+        s.add("movies", load_movies)
+        s.add("ratings", load_ratings, after=("movies",))
+        s.add("tags", load_tags)
+        failed = s.run()
+    """
+    def __init__(self, max_parallel=0):
+        """Keyword arguments:
+           max_parallel -- max number of loads running at once, 0 for no
+                            limit
+        """
+        self.max_parallel = max_parallel
+        self.stop     = Event()
+        self.times    = {}
+        self.__loads  = []
+        self.__after  = {}
+        self.__state  = {}
+        self.__cond   = Condition()
+
+    def add(self, name, run, after=()):
+        """Add a load.
+
+           Arguments:
+           name  -- unique name of the load, e.g. the index name
+           run   -- function to call w/o arguments
+
+           Keyword arguments:
+           after -- names of the loads which must complete before this one
+                     starts; all must have been added already
+        """
+        if name in self.__after:
+            raise ValueError("Load %s added twice" % name)
+        for a in after:
+            if a not in self.__after:
+                raise ValueError("Load %s depends on unknown load %s"
+                                                                % (name, a))
+        self.__loads.append((name, run))
+        self.__after[name] = tuple(after)
+
+    def __run(self, name, run):
+        t = time.time()
+        try:
+            run()
+            state = "done"
+        except KeyboardInterrupt:
+            state = "interrupted"
+        except Exception:
+            print "\nLoad %s failed:" % name
+            traceback.print_exc()
+            state = "failed"
+        with self.__cond:
+            self.times[name] = time.time() - t
+            self.__state[name] = state
+            self.__cond.notify()
+
+    def __ready(self, name):
+        """Return True if load 'name' may start, None if it never will, and
+            False if it has to wait."""
+        states = [ self.__state.get(a) for a in self.__after[name] ]
+        if "failed" in states or "skipped" in states \
+                                            or "interrupted" in states:
+            return None
+        return all([ s == "done" for s in states ])
+
+    def run(self):
+        """Run all loads, and wait for them to complete.
+
+           Returns:
+           array of the names of the loads which failed, were skipped, or
+           were interrupted
+        """
+        try:
+            self.__start()
+        except KeyboardInterrupt:
+            print "\nInterrupted, stopping loads."
+            self.stop.set()
+            with self.__cond:
+                for name, run in self.__loads:
+                    self.__state.setdefault(name, "skipped")
+                while "running" in self.__state.values():
+                    self.__cond.wait(1)
+            print ""
+        return [ n for n, r in self.__loads if self.__state[n] != "done" ]
+
+    def __start(self):
+        """Start loads as they get ready, until all completed."""
+        pending = list(self.__loads)
+        with self.__cond:
+            while pending or "running" in self.__state.values():
+                running = self.__state.values().count("running")
+                for name, run in list(pending):
+                    ready = self.__ready(name)
+                    if ready is None:
+                        print "Skipping load %s: depends on %s." % (name,
+                                            ", ".join(self.__after[name]))
+                        self.__state[name] = "skipped"
+                    elif not ready or (self.max_parallel
+                                       and running >= self.max_parallel):
+                        continue
+                    else:
+                        self.__state[name] = "running"
+                        running += 1
+                        t = Thread(target=self.__run, args=(name, run))
+                        t.daemon = True
+                        t.start()
+                    pending.remove((name, run))
+                # Condition.wait() w/o a timeout would hold off
+                #  KeyboardInterrupt until a load completed
+                self.__cond.wait(1)
+
+    def summary(self):
+        """Return a one-line summary of the state and time of each load."""
+        ret = []
+        for name, run in self.__loads:
+            state = self.__state.get(name, "pending")
+            if name in self.times:
+                state = "%.1f s" % self.times[name] if state == "done" \
+                            else "%s after %.1f s" % (state, self.times[name])
+            ret.append("%s %s" % (name, state))
+        return ", ".join(ret)
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+#
+# Typed JSON serialization of parsed movielens / hetrec documents, compiled
+#  per schema and run on whole batches of documents.
+#
+# This file is licensed to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import re
+
+from functools import partial
+from itertools import islice
+from json.encoder import encode_basestring_ascii
+
+try:
+    import ujson
+    BACKEND = "ujson"
+    # Same output as the json module w/ compact separators
+    dumps = partial(ujson.dumps, ensure_ascii=True,
+                                    escape_forward_slashes=False)
+except ImportError:
+    import json
+    BACKEND = "json"
+    dumps = json.JSONEncoder(separators=(",", ":")).encode
+
+# Number of documents serialized at once by batches() users
+BATCH_ROWS = 1000
+
+# Value types of the movielens / hetrec fields; fields not listed are "text":
+#  int   -- integer
+#  float -- floating point number
+#  ms    -- epoch seconds, serialized as epoch milliseconds
+#  text  -- string
+#  list  -- array of strings; string values are split by the schema's 'sep'
+TYPES = { "UserID": "int", "MovieID": "int", "Rating": "float",
+          "Timestamp": "ms", "Genres": "list" }
+
+# Columns of numbers which are valid JSON as they are, one value per line;
+#  "ms" values are valid JSON w/ "000" appended, unless 0
+INT_COLUMN   = re.compile(r"(?:-?(?:0|[1-9][0-9]*)\n)*\Z")
+FLOAT_COLUMN = re.compile(r"(?:-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?"
+                                                r"(?:[eE][-+]?[0-9]+)?\n)*\Z")
+MS_COLUMN    = re.compile(r"(?:-?[1-9][0-9]*\n)*\Z")
+
+
+def batches(items, n=BATCH_ROWS):
+    """Generator for arrays of up to 'n' consecutive items of an
+        iterable."""
+    it = iter(items)
+    while True:
+        batch = list(islice(it, n))
+        if not batch:
+            return
+        yield batch
+
+
+class schema(object):
+    """Serializer of documents w/ a fixed array of fields.
+
+       The schema is compiled into a single format string, and a converter
+       per field which processes the values of all documents of a batch in
+       one pass: numeric strings are checked w/ a single regular expression
+       match per field and used as they are (or else converted by int() /
+       float()), and the strings of a batch are decoded w/ a single decode()
+       call per field, then quoted by the C encoder of the JSON backend
+       (ujson if installed, the json module otherwise).
+    """
+    def __init__(self, fields, types=TYPES, encoding="utf-8", sep="|",
+                                                            open_dict=False):
+        """Arguments:
+           fields    -- array of field names, in the order of the values of
+                         a document
+
+           Keyword arguments:
+           types     -- dict of the value type per field name, see TYPES;
+                         fields not listed are "text"
+           encoding  -- character encoding of string values
+           sep       -- separator of "list" values given as string
+           open_dict -- leave the JSON dicts open, i.e. end them w/ a ','
+                         instead of the closing '}', so further fields can be
+                         appended
+        """
+        self.fields   = tuple(fields)
+        self.types    = tuple([ types.get(f, "text") for f in fields ])
+        self.encoding = encoding
+        self.sep      = sep
+        self.__fmt    = "{%s%s" % (",".join([ '"%s":%%s' % f
+                                                    for f in self.fields ]),
+                                "," if open_dict else "}")
+        self.__convs  = [ getattr(self, "_schema__" + t) for t in self.types ]
+
+    def __valid(self, regex, col):
+        """Return True if all values of a column match 'regex'."""
+        try:
+            return bool(regex.match("\n".join(col) + "\n"))
+        except TypeError:
+            # Values already converted
+            return False
+
+    def __int(self, col):
+        if self.__valid(INT_COLUMN, col):
+            return col
+        return map(str, map(int, col))
+
+    def __float(self, col):
+        if self.__valid(FLOAT_COLUMN, col):
+            return col
+        ret = map(repr, map(float, col))
+        if "nan" in ret or "inf" in ret or "-inf" in ret:
+            raise ValueError("No JSON number: nan / inf")
+        return ret
+
+    def __ms(self, col):
+        if self.__valid(MS_COLUMN, col):
+            return [ v + "000" for v in col ]
+        return [ str(int(v) * 1000) for v in col ]
+
+    def __decode(self, col):
+        """Decode an array of strings w/ a single decode() call."""
+        if not col:
+            return []
+        return "\n".join(col).decode(self.encoding).split("\n")
+
+    def __text(self, col):
+        return map(encode_basestring_ascii, self.__decode(col))
+
+    def __list(self, col):
+        sep   = self.sep
+        col   = [ v.split(sep) if isinstance(v, basestring) else v
+                                                                for v in col ]
+        flat  = self.__decode([ s for v in col for s in v ])
+        ret   = []
+        start = 0
+        for v in col:
+            ret.append(dumps(flat[start:start + len(v)]))
+            start += len(v)
+        return ret
+
+    def __encode(self, rows):
+        cols = zip(*rows)
+        if len(cols) < len(self.fields):
+            raise IndexError("%s fields expected" % len(self.fields))
+        fmt = self.__fmt
+        return [ fmt % vals for vals in zip(*[ conv(col) for conv, col
+                                                in zip(self.__convs, cols) ]) ]
+
+    def encode(self, rows):
+        """Serialize a batch of documents.
+
+           Arguments:
+           rows -- array of documents, each an array of field values in the
+                    order of the schema's fields; extra values are ignored.
+                    Values are strings as parsed (e.g. "5" for an "int"
+                    field), or already converted.
+
+           Returns:
+           array of JSON dict strings, one per row; None for rows which do
+           not convert, e.g. w/ too few fields or a non-numeric ID
+        """
+        try:
+            return self.__encode(rows)
+        except (ValueError, TypeError, IndexError, UnicodeError):
+            pass
+        ret = []
+        for r in rows:
+            try:
+                ret.extend(self.__encode([ r ]))
+            except (ValueError, TypeError, IndexError, UnicodeError):
+                ret.append(None)
+        return ret
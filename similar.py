@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+#
+# Offline item-item model of the movielens indexing tool: movies liked by
+#  the same users, ranked by the significance of their co-occurrence.
+#
+# This file is licensed to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import numpy
+import scipy.sparse
+
+# Significance scores of a co-occurrence, see scores()
+SCORES = ("llr", "jlh")
+
+# Number of movies whose co-occurrences are computed at once; bounds the
+#  partial co-occurrence matrix to BLOCK_MOVIES x movies
+BLOCK_MOVIES = 1024
+
+
+def xlogx(x):
+    """Return x * log(x) element-wise for an array of counts, 0 for 0."""
+    return x * numpy.log(numpy.maximum(x, 1))
+
+
+def scores(k11, n_i, n_j, n, score="llr"):
+    """Return the significance of the co-occurrences of pairs of movies
+        (i, j).
+
+       "llr" is Dunning's log-likelihood ratio of the 2x2 contingency table
+       of users who liked i and / or j; "jlh" is the JLH score of
+       Elasticsearch's significant_terms aggregation, i.e. how much more
+       often j is liked by users who liked i than by all users. Pairs
+       which co-occur no more often than expected by chance score 0.
+
+       Arguments:
+       k11 -- numpy array of the number of users who liked both i and j
+       n_i -- numpy array of the number of users who liked i
+       n_j -- numpy array of the number of users who liked j
+       n   -- number of users
+
+       Keyword arguments:
+       score -- "llr" or "jlh"
+    """
+    k11 = k11.astype(numpy.float64)
+    n_i = n_i.astype(numpy.float64)
+    n_j = n_j.astype(numpy.float64)
+    positive = k11 * n > n_i * n_j
+    if score == "jlh":
+        fg = k11 / n_i
+        bg = n_j / n
+        return numpy.where(positive, (fg - bg) * fg / bg, 0.0)
+    if score != "llr":
+        raise ValueError("Unknown score %s, use one of %s" % (score,
+                                                        ", ".join(SCORES)))
+    k12 = n_i - k11
+    k21 = n_j - k11
+    k22 = n - n_i - n_j + k11
+    rows = xlogx(n_i) + xlogx(n - n_i)
+    cols = xlogx(n_j) + xlogx(n - n_j)
+    mat  = xlogx(k11) + xlogx(k12) + xlogx(k21) + xlogx(k22)
+    llr  = 2 * (xlogx(n) + mat - rows - cols)
+    return numpy.where(positive, numpy.maximum(llr, 0), 0.0)
+
+
+def top_k(rows, values, k):
+    """Return a boolean mask of the 'k' largest values per row.
+
+       Arguments:
+       rows   -- numpy array of row indices
+       values -- numpy array of values, one per row index
+       k      -- number of values to keep per row
+    """
+    order = numpy.lexsort((-values, rows))
+    srows = rows[order]
+    rank  = numpy.arange(len(srows)) - numpy.searchsorted(srows, srows)
+    keep  = numpy.zeros(len(rows), dtype=bool)
+    keep[order[rank < k]] = True
+    return keep
+
+
+def neighbours(users, movies, ratings, k=20, min_rating=4.0, score="llr",
+                                min_count=2, block=BLOCK_MOVIES):
+    """Compute the top-k most significantly co-occurring movies per movie.
+
+       Movies co-occur when they are liked, i.e. rated 'min_rating' or
+       better, by the same user. The user x movie matrix of likes is kept
+       as a sparse matrix, and the co-occurrence counts (its transpose
+       times itself) are computed for 'block' movies at a time, so memory
+       stays bounded by the number of likes plus one block of co-occurrence
+       counts.
+
+       Arguments:
+       users   -- numpy array of the UserID of each rating
+       movies  -- numpy array of the MovieID of each rating
+       ratings -- numpy array of the ratings
+
+       Keyword arguments:
+       k          -- max number of neighbours per movie
+       min_rating -- min rating of a like
+       score      -- significance score, see scores()
+       min_count  -- min number of users who liked both movies
+       block      -- number of movies whose co-occurrences are computed at
+                      once
+
+       Returns:
+       generator for (MovieID, array of neighbour MovieIDs, array of
+       scores, array of co-occurrence counts) tuples, neighbours by
+       descending score, for movies w/ at least one neighbour, by MovieID
+    """
+    liked = ratings >= min_rating
+    uids, u = numpy.unique(users[liked], return_inverse=True)
+    mids, m = numpy.unique(movies[liked], return_inverse=True)
+    x = scipy.sparse.csr_matrix((numpy.ones(len(u), dtype=numpy.int32),
+                                    (u, m)), shape=(len(uids), len(mids)))
+    # Users who rated a movie twice like it once
+    x.data[:] = 1
+    xt    = x.T.tocsr()
+    likes = numpy.asarray(x.sum(axis=0)).ravel()
+    n     = len(uids)
+    for start in xrange(0, len(mids), block):
+        c = (xt[start:start + block] * x).tocoo()
+        i, j, k11 = c.row + start, c.col, c.data
+        keep = (i != j) & (k11 >= min_count)
+        i, j, k11 = i[keep], j[keep], k11[keep]
+        s = scores(k11, likes[i], likes[j], n, score)
+        keep = (s > 0) & top_k(i, s, k)
+        i, j, k11, s = i[keep], j[keep], k11[keep], s[keep]
+        order = numpy.lexsort((-s, i))
+        i, j, k11, s = i[order], j[order], k11[order], s[order]
+        bounds = numpy.flatnonzero(numpy.diff(i)) + 1
+        for r in numpy.split(numpy.arange(len(i)), bounds):
+            if len(r):
+                yield mids[i[r[0]]], mids[j[r]], s[r], k11[r]
+
+
+def docs(nbrs, titles=None):
+    """Return a generator for (ID, JSON dict string) tuples of the
+        'movie_similar' documents of neighbours() results.
+
+       Arguments:
+       nbrs -- iterable of neighbours() results
+
+       Keyword arguments:
+       titles -- dict of JSON strings of movie titles by MovieID string
+    """
+    titles = titles or {}
+    for idx, ids, sc, cnt in nbrs:
+        yield str(idx), '{"MovieID":%d,"Similar":[%s]}' % (idx, ",".join([
+                    '{"MovieID":%d,"Title":%s,"Score":%.4f,"Count":%d}' % (
+                                    j, titles.get(str(j), "null"), s, c)
+                                        for j, s, c in zip(ids, sc, cnt) ]))
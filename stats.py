@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+#
+# Per-movie and per-user rating statistics, computed w/ NumPy.
+#
+# This file is licensed to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import numpy
+
+from array import array
+
+# Number of rating histogram buckets; ratings are 0.5 - 5 stars in half star
+#  steps (whole stars only in older data sets)
+HIST_BUCKETS = 10
+
+
+def group_stats(keys, ratings, timestamps, prior=None):
+    """Compute rating statistics of all ratings grouped by key.
+
+       Arguments:
+       keys       -- numpy array of group keys (e.g. MovieID), one per rating
+       ratings    -- numpy array of ratings
+       timestamps -- numpy array of rating timestamps, in seconds
+
+       Keyword arguments:
+       prior -- weight of the global mean rating in the Bayesian average, in
+                 number of ratings; defaults to the mean number of ratings
+                 per key
+
+       Returns:
+       dict of numpy arrays, one element per distinct key, in key order:
+        "ids"       -- the distinct keys
+        "count"     -- number of ratings
+        "mean"      -- mean rating
+        "variance"  -- rating variance
+        "bayes"     -- Bayesian average rating, i.e. the mean rating pulled
+                        towards the global mean for keys w/ few ratings
+        "last"      -- timestamp of the latest rating
+        "histogram" -- (keys x HIST_BUCKETS) array of rating counts per
+                        half star
+    """
+    ratings = ratings.astype(numpy.float64)
+    ids, inv = numpy.unique(keys, return_inverse=True)
+    count = numpy.bincount(inv)
+    total = numpy.bincount(inv, weights=ratings)
+    mean  = total / count
+    var   = numpy.bincount(inv, weights=ratings * ratings) / count - mean**2
+    if prior is None:
+        prior = count.mean()
+    bayes = (prior * ratings.mean() + total) / (prior + count)
+
+    # Sort by (key, timestamp); the last rating of each key ends its group
+    order = numpy.lexsort((timestamps, inv))
+    last  = timestamps[order[numpy.cumsum(count) - 1]]
+
+    bucket = numpy.clip(numpy.rint(ratings * 2).astype(numpy.int64) - 1,
+                                                        0, HIST_BUCKETS - 1)
+    hist = numpy.bincount(inv * HIST_BUCKETS + bucket,
+                          minlength=len(ids) * HIST_BUCKETS)
+    return {"ids": ids, "count": count, "mean": mean,
+            "variance": numpy.maximum(var, 0), "bayes": bayes,
+            "last": last, "histogram": hist.reshape(len(ids), HIST_BUCKETS)}
+
+
+def fields(st):
+    """Return a generator for (ID, JSON dict string) tuples of statistics.
+
+       The JSON dict strings hold the "Rating*" and "LastRated" fields of one
+       key each, for embedding into that key's document.
+
+       Arguments:
+       st -- dict of statistics as returned by group_stats()
+    """
+    for i, n, m, v, b, l, h in zip(st["ids"], st["count"], st["mean"],
+                                    st["variance"], st["bayes"], st["last"],
+                                    st["histogram"]):
+        yield str(i), ('{"RatingCount":%d,"RatingMean":%.4f,'
+                       '"RatingVariance":%.4f,"RatingBayesAvg":%.4f,'
+                       '"LastRated":%d000,"RatingHistogram":[%s]}' % (
+                            n, m, v, b, l, ",".join(map(str, h))))
+
+
+class rating_stats(object):
+    """Collector of all ratings, for statistics per movie and per user.
+
+       Ratings are appended to typed arrays (4-8 bytes per value instead of
+       a Python object each) while 'ratings.dat' is parsed, and handed to
+       NumPy w/o copying when statistics are computed. Alternatively, whole
+       columns of ratings can be added, e.g. from a colcache.table.
+    """
+    def __init__(self):
+        self.__users   = array('i')
+        self.__movies  = array('i')
+        self.__ratings = array('f')
+        self.__ts      = array('l')
+        self.__columns = []
+
+    def add(self, user, movie, rating, timestamp):
+        """Add a rating.
+
+           Arguments:
+           user, movie, rating, timestamp -- field values of a 'ratings.dat'
+                                              line, as strings
+        """
+        self.__users.append(int(user))
+        self.__movies.append(int(movie))
+        self.__ratings.append(float(rating))
+        self.__ts.append(int(timestamp))
+
+    def add_columns(self, users, movies, ratings, timestamps):
+        """Add ratings from numpy arrays of equal length.
+
+           Arguments:
+           users, movies, ratings, timestamps -- numpy arrays of the ratings'
+                                                  field values
+        """
+        self.__columns.append((users, movies, ratings, timestamps))
+
+    def __len__(self):
+        return len(self.__ratings) + sum([ len(c[2]) for c in self.__columns ])
+
+    def columns(self):
+        """Return a tuple of numpy arrays (users, movies, ratings,
+            timestamps) of all ratings added."""
+        view = lambda a: numpy.frombuffer(a, dtype=a.typecode) if len(a) \
+                                    else numpy.zeros(0, dtype=a.typecode)
+        cols = self.__columns + [ tuple([ view(a) for a in (self.__users,
+                                self.__movies, self.__ratings, self.__ts) ]) ]
+        return tuple([ numpy.concatenate([ c[i] for c in cols ])
+                                                        for i in range(4) ])
+
+    def __stats(self, key, prior):
+        cols = self.columns()
+        return group_stats(cols[key], cols[2], cols[3], prior)
+
+    def movies(self, prior=None):
+        """Return statistics per MovieID, see group_stats()."""
+        return self.__stats(1, prior)
+
+    def users(self, prior=None):
+        """Return statistics per UserID, see group_stats()."""
+        return self.__stats(0, prior)
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+#
+# Local Elasticsearch stub accepting bulk requests, for benchmarking the
+#  indexing tools w/o a running Elasticsearch cluster.
+#
+# This file is licensed to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import argparse
+import signal
+import random
+import sys
+import time
+import json
+import bulk
+
+from threading import Thread, Lock
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+REJECTED = "EsRejectedExecutionException[rejected execution (queue capacity" \
+           + " 50) on org.elasticsearch.action.support.replication]"
+
+
+class stub_server(ThreadingMixIn, HTTPServer):
+    """Threaded HTTP server answering like an Elasticsearch 1.x node.
+
+       Bulk requests ('/_bulk', '/{index}/_bulk', ...) are parsed and
+       answered w/ per-item results after a configurable latency. Items are
+       rejected w/ status 429 at a configurable rate, and whole requests
+       as well, the same way Elasticsearch rejects bulk requests when its
+       bulk thread pool queue is full. With a 'capacity', all items of the
+       bulk requests beyond that many in progress at once are rejected,
+       like a full bulk queue does, and the latency may grow w/ the body
+       size, so clients adapting to the load can be exercised. Index
+       administration requests
+       (create, mappings, settings, aliases, optimize) are acknowledged,
+       HEAD requests answered w/ 404. Multi-searches are answered w/ empty
+       results after the same latency.
+
+       GET '/_stub/stats' returns the number of requests and documents
+       received so far.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=9200, latency=0.0, jitter=0.0, reject=0.0,
+                    reject_requests=0.0, seed=None, capacity=0,
+                    latency_per_mb=0.0):
+        """Keyword arguments:
+           port            -- TCP port to listen on; 0 picks a free port
+           latency         -- mean delay of a bulk response, in seconds
+           jitter          -- max random deviation from 'latency', in seconds
+           reject          -- fraction of bulk items rejected w/ status 429
+           reject_requests -- fraction of bulk requests rejected as a whole
+           seed            -- random seed for reproducible rejections
+           capacity        -- max number of bulk requests in progress at
+                               once, 0 for no limit
+           latency_per_mb  -- additional delay per MiB of body, in seconds
+        """
+        HTTPServer.__init__(self, ("127.0.0.1", port), stub_handler)
+        self.port            = self.server_address[1]
+        self.latency         = latency
+        self.jitter          = jitter
+        self.reject          = reject
+        self.reject_requests = reject_requests
+        self.random          = random.Random(seed)
+        self.capacity        = capacity
+        self.latency_per_mb  = latency_per_mb
+        self.active          = 0
+        self.lock            = Lock()
+        self.stats           = {"requests": 0, "docs": 0, "rejected": 0,
+                                "bytes": 0}
+
+    def count(self, **kwargs):
+        with self.lock:
+            for k, v in kwargs.items():
+                self.stats[k] += v
+
+    def chance(self, p):
+        with self.lock:
+            return self.random.random() < p
+
+    def start(self):
+        """Serve in a background thread; returns the URL of the server."""
+        t = Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+        return "http://127.0.0.1:%s" % self.port
+
+
+class stub_handler(BaseHTTPRequestHandler):
+    """Request handler of stub_server."""
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def __reply(self, status, data=None):
+        body = json.dumps(data) if data is not None else ""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=UTF-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def __body(self):
+        n = int(self.headers.getheader("Content-Length") or 0)
+        return self.rfile.read(n) if n else ""
+
+    def __bulk(self, body):
+        srv = self.server
+        with srv.lock:
+            srv.active += 1
+            full = srv.capacity and srv.active > srv.capacity
+        try:
+            self.__bulk_items(body, full)
+        finally:
+            with srv.lock:
+                srv.active -= 1
+
+    def __bulk_items(self, body, full):
+        srv   = self.server
+        start = time.time()
+        acts  = bulk.actions(body)
+        srv.count(requests=1, bytes=len(body))
+        with srv.lock:
+            delay = srv.latency + srv.random.uniform(-srv.jitter, srv.jitter)
+        delay += srv.latency_per_mb * len(body) / (1024.0 * 1024.0)
+        if delay > 0 and not full:
+            time.sleep(delay)
+        if srv.chance(srv.reject_requests):
+            srv.count(rejected=len(acts))
+            return self.__reply(429, {"error": REJECTED, "status": 429})
+
+        items    = []
+        rejected = 0
+        for hdr, doc in acts:
+            # post_movie_details.py sends unquoted '_id' keys, which
+            #  Elasticsearch accepts
+            op, meta = json.loads(hdr.replace(',_id:', ',"_id":')).items()[0]
+            item = {"_index": meta.get("_index"), "_type": meta.get("_type"),
+                    "_id": meta.get("_id") or "%x" % random.getrandbits(64),
+                    "_version": 1}
+            if full or srv.chance(srv.reject):
+                item.update(status=429, error=REJECTED)
+                rejected += 1
+            else:
+                item["status"] = 201 if op in ("index", "create") else 200
+            items.append({op: item})
+        srv.count(docs=len(items) - rejected, rejected=rejected)
+        self.__reply(200, {"took": int((time.time() - start) * 1000),
+                           "errors": rejected > 0, "items": items})
+
+    def __msearch(self, body):
+        # One empty result per search, after the bulk latency
+        srv = self.server
+        n   = len([ l for l in body.split("\n") if l.strip() ]) / 2
+        srv.count(requests=1, bytes=len(body))
+        if srv.latency > 0:
+            time.sleep(srv.latency)
+        self.__reply(200, {"responses": [ {"took": int(srv.latency * 1000),
+                            "timed_out": False,
+                            "hits": {"total": 0, "max_score": None,
+                                     "hits": []}} for i in range(n) ]})
+
+    def __handle(self):
+        path = self.path.split("?")[0].rstrip("/")
+        body = self.__body()
+        if path.endswith("/_bulk") or path == "/_bulk":
+            return self.__bulk(body)
+        if path.endswith("/_msearch") or path == "/_msearch":
+            return self.__msearch(body)
+        if path == "/_stub/stats":
+            with self.server.lock:
+                return self.__reply(200, dict(self.server.stats))
+        if self.command == "HEAD" or (self.command == "GET"
+                                                and "/_alias" in path):
+            return self.__reply(404, {"error": "IndexMissingException",
+                                      "status": 404})
+        self.__reply(200, {"acknowledged": True})
+
+    do_GET    = __handle
+    do_PUT    = __handle
+    do_POST   = __handle
+    do_DELETE = __handle
+    do_HEAD   = __handle
+
+
+def cmdl_args():
+    """Parse command line arguments
+
+       Returns
+        argparse instance ready to use
+    """
+    parser = argparse.ArgumentParser(
+                description='Run a local Elasticsearch stub accepting bulk'
+                 + ' requests, e.g. for benchmarks.')
+    parser.add_argument('--port', metavar='port', type=int, dest='port',
+        default=9200, help='Port to listen on (default: 9200).')
+    parser.add_argument('--latency-ms', metavar='ms', type=float,
+        dest='latency', default=0,
+        help='Mean latency of bulk responses in ms (default: 0).')
+    parser.add_argument('--jitter-ms', metavar='ms', type=float,
+        dest='jitter', default=0,
+        help='Max random deviation from the latency in ms (default: 0).')
+    parser.add_argument('--reject', metavar='fraction', type=float,
+        dest='reject', default=0,
+        help='Fraction of documents rejected w/ status 429 (default: 0).')
+    parser.add_argument('--reject-requests', metavar='fraction', type=float,
+        dest='reject_requests', default=0,
+        help='Fraction of bulk requests rejected w/ status 429'
+             + ' (default: 0).')
+    parser.add_argument('--capacity', metavar='requests', type=int,
+        dest='capacity', default=0,
+        help='Reject all documents of bulk requests beyond this many in'
+             + ' progress at once w/ status 429 (default: 0, no limit).')
+    parser.add_argument('--latency-per-mb', metavar='ms', type=float,
+        dest='latency_per_mb', default=0,
+        help='Additional latency of bulk responses per MiB of request body'
+             + ' in ms (default: 0).')
+    parser.add_argument('--seed', metavar='seed', type=int, dest='seed',
+        help='Random seed for reproducible rejections.')
+
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    """ This script runs an HTTP server on localhost which answers bulk
+        requests like Elasticsearch 1.x does, w/o storing anything. Point
+        post_movies.py / post_movie_details.py at it (they connect to
+        localhost:9200) to measure ingestion throughput, or to exercise
+        re-tries w/ --reject.
+    """
+    args = cmdl_args()
+    srv = stub_server(args.port, args.latency / 1000.0, args.jitter / 1000.0,
+                        args.reject, args.reject_requests, args.seed,
+                        args.capacity, args.latency_per_mb / 1000.0)
+    print "Elasticsearch stub listening on port %s." % srv.port
+    sys.stdout.flush()
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    try:
+        srv.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    print json.dumps(srv.stats)
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+#
+# Tests of archive.py: line readers over plain, gzip / bzip2 compressed and
+#  zip archived data files, and newline-aligned byte ranges.
+#
+# This file is licensed to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import os
+import bz2
+import gzip
+import shutil
+import zipfile
+import tempfile
+import unittest
+import archive
+
+LINES = [ "%s::%s::%s.5::%s\n" % (i, i * 7 % 1000, i % 5, 1000000000 + i)
+                                                    for i in range(5000) ]
+DATA = "".join(LINES)
+
+
+class reader_test(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        # Small reads, so lines and skipped offsets span chunks
+        self.chunk_bytes = archive.CHUNK_BYTES
+        archive.CHUNK_BYTES = 1000
+
+    def tearDown(self):
+        archive.CHUNK_BYTES = self.chunk_bytes
+        shutil.rmtree(self.dir)
+
+    def write(self, name, data):
+        fname = os.path.join(self.dir, name)
+        with open(fname, 'wb') as f:
+            f.write(data)
+        return fname
+
+    def gzip(self, data):
+        fname = os.path.join(self.dir, "gz.tmp")
+        with gzip.open(fname, 'wb') as f:
+            f.write(data)
+        with open(fname, 'rb') as f:
+            return f.read()
+
+    def zip(self, name, data, compress_type):
+        fname = os.path.join(self.dir, name)
+        with zipfile.ZipFile(fname, 'w') as zf:
+            zf.writestr("README", "not the data file\n")
+            zf.writestr(zipfile.ZipInfo("ml/ratings.dat"), data,
+                                                    compress_type)
+        return fname + "/ml/ratings.dat"
+
+    def read(self, path, offset=0):
+        with archive.reader(path) as r:
+            if offset:
+                r.seek(offset)
+            return "".join(r), r.total
+
+    def check(self, path):
+        """Check reading 'path', which holds DATA, whole and from a line
+            boundary on."""
+        data, total = self.read(path)
+        self.assertEqual(data, DATA)
+        self.assertEqual(total, len(DATA))
+        offset = len("".join(LINES[:1234]))
+        self.assertEqual(self.read(path, offset)[0], DATA[offset:])
+
+    def test_plain(self):
+        self.check(self.write("ratings.dat", DATA))
+
+    def test_gzip(self):
+        self.check(self.write("ratings.dat.gz", self.gzip(DATA)))
+
+    def test_bzip2(self):
+        self.check(self.write("ratings.dat.bz2", bz2.compress(DATA)))
+
+    def test_concatenated_gzip(self):
+        # e.g. from 'pigz'; the second stream starts mid-line
+        half = len(DATA) / 2
+        self.check(self.write("ratings.dat.gz", self.gzip(DATA[:half])
+                                                + self.gzip(DATA[half:])))
+
+    def test_concatenated_bzip2(self):
+        # e.g. from 'pbzip2'
+        parts = [ DATA[i:i + 7000] for i in range(0, len(DATA), 7000) ]
+        self.check(self.write("ratings.dat.bz2",
+                        "".join([ bz2.compress(p) for p in parts ])))
+
+    def test_zip_stored(self):
+        self.check(self.zip("ml.zip", DATA, zipfile.ZIP_STORED))
+
+    def test_zip_deflated(self):
+        self.check(self.zip("ml.zip", DATA, zipfile.ZIP_DEFLATED))
+
+    def test_partial_last_line(self):
+        data = DATA + "5000::1::4.0::1000005000"
+        for path in (self.write("ratings.dat", data),
+                     self.write("ratings.dat.gz", self.gzip(data)),
+                     self.write("ratings.dat.bz2", bz2.compress(data)),
+                     self.zip("ml.zip", data, zipfile.ZIP_DEFLATED)):
+            with archive.reader(path) as r:
+                lines = list(r)
+            self.assertEqual(len(lines), len(LINES) + 1, path)
+            self.assertEqual(lines[-1], "5000::1::4.0::1000005000", path)
+
+    def test_path(self):
+        zpath = self.zip("ml.zip", DATA, zipfile.ZIP_STORED)
+        self.assertEqual(archive.path(os.path.join(self.dir, "ml.zip"),
+                                      "ratings.dat"), zpath)
+        gz = self.write("ratings.dat.gz", "")
+        self.assertEqual(archive.path(self.dir, "ratings.dat"), gz)
+
+
+class chunk_ranges_test(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.fname = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as f:
+            f.write(DATA)
+
+    def tearDown(self):
+        os.remove(self.fname)
+
+    def test_ranges(self):
+        offsets = set([ len("".join(LINES[:i]))
+                                    for i in range(len(LINES) + 1) ])
+        for start in (0, len(LINES[0])):
+            ranges = archive.chunk_ranges(self.fname, 10000, start)
+            self.assertEqual(ranges[0][0], start)
+            self.assertEqual(ranges[-1][1], len(DATA))
+            for (s, e), (s2, e2) in zip(ranges, ranges[1:]):
+                self.assertEqual(e, s2)
+            for s, e in ranges:
+                self.assertTrue(s in offsets and e in offsets)
+                self.assertTrue(e > s)
+
+    def test_small_file(self):
+        self.assertEqual(archive.chunk_ranges(self.fname, len(DATA) * 2),
+                                                        [(0, len(DATA))])
+        self.assertEqual(archive.chunk_ranges(self.fname, 100, len(DATA)),
+                                                                        [])
+
+
+if __name__ == "__main__":
+    unittest.main()
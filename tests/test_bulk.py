@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+#
+# Tests of bulk.py: the progress watermark of bulk batches which complete
+#  out of order.
+#
+# This file is licensed to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import unittest
+import bulk
+
+from cStringIO import StringIO
+
+
+class saves(object):
+    """checkpoint.checkpoint stand-in recording its saves."""
+    def __init__(self):
+        self.saved = []
+
+    def save(self, offset, docs):
+        self.saved.append((offset, docs))
+
+
+class progress_test(unittest.TestCase):
+
+    def test_in_order(self):
+        ckpt = saves()
+        prog = bulk.progress(out=None, checkpoint=ckpt)
+        prog.done(0, 10, 100, 300)
+        prog.done(10, 20, 200, 300)
+        self.assertEqual(ckpt.saved, [(100, 10), (200, 20)])
+        self.assertEqual(prog.indexed, 20)
+
+    def test_out_of_order(self):
+        ckpt = saves()
+        out = StringIO()
+        prog = bulk.progress(out=out, checkpoint=ckpt)
+        prog.done(10, 20, 200, 400)
+        prog.done(30, 40, 400, 400)
+        # Nothing acknowledged before the watermark yet
+        self.assertEqual(ckpt.saved, [])
+        self.assertTrue(out.getvalue().endswith(" 0 documents)"))
+        prog.done(0, 10, 100, 400)
+        self.assertEqual(ckpt.saved, [(200, 20)])
+        self.assertTrue(out.getvalue().endswith(" 20 documents)"))
+        prog.done(20, 30, 300, 400)
+        self.assertEqual(ckpt.saved, [(200, 20), (400, 40)])
+        self.assertTrue("100 % done" in out.getvalue())
+
+    def test_failed(self):
+        prog = bulk.progress(out=None)
+        prog.done(0, 10, 100, 200, failed=3)
+        prog.done(10, 20, 200, 200, indexed=5, failed=5)
+        self.assertEqual((prog.indexed, prog.failed), (12, 8))
+        self.assertEqual(prog.summary(), "12 documents indexed, 8 failed.")
+
+    def test_resume(self):
+        ckpt = saves()
+        prog = bulk.progress(out=None, start=50, checkpoint=ckpt)
+        prog.done(60, 70, 700, 900)
+        self.assertEqual(ckpt.saved, [])
+        prog.done(50, 60, 600, 900)
+        self.assertEqual(ckpt.saved, [(700, 70)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+#
+# Tests of extsort.py: grouping records by key across spilled and merged
+#  runs.
+#
+# This file is licensed to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import extsort
+
+
+class external_sort_test(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        rnd = random.Random(7)
+        self.records = [ (rnd.randint(1, 300), "v%s" % i)
+                                                    for i in range(5000) ]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def expected(self):
+        ret = {}
+        for key, value in self.records:
+            ret.setdefault(key, []).append(value)
+        return sorted(ret.items())
+
+    def sort(self, max_bytes, fan_in=64):
+        s = extsort.external_sort(max_bytes, self.dir, fan_in)
+        for key, value in self.records:
+            s.add(key, value)
+        return s
+
+    def test_in_memory(self):
+        s = self.sort(1024 * 1024 * 1024)
+        self.assertEqual(s.runs(), 0)
+        self.assertEqual(list(s.groups()), self.expected())
+
+    def test_runs(self):
+        s = self.sort(10000)
+        self.assertTrue(s.runs() > 1)
+        self.assertEqual(list(s.groups()), self.expected())
+
+    def test_multi_pass_merge(self):
+        # More runs than can be merged at once
+        s = self.sort(2000, fan_in=3)
+        self.assertTrue(s.runs() > 9)
+        self.assertEqual(list(s.groups()), self.expected())
+
+    def test_cleanup(self):
+        s = self.sort(10000)
+        groups = s.groups()
+        groups.next()
+        groups.close()
+        self.assertEqual(os.listdir(self.dir), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+#
+# Tests of sample.py: hash-based samples of users and movies are the same in
+#  every file, process, and run.
+#
+# This file is licensed to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import pickle
+import unittest
+import sample
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+RATINGS = ("UserID", "MovieID", "Rating", "Timestamp")
+
+
+class sample_test(unittest.TestCase):
+
+    def test_position(self):
+        # Pinned, so samples of earlier runs stay valid
+        self.assertEqual(sample.position("user", 1), 0.7409952320158482)
+        self.assertEqual(sample.position("movie", 1), 0.10956478584557772)
+
+    def test_fraction(self):
+        s = sample.sample(0.1, RATINGS)
+        kept = len([ u for u in range(1, 20001) if s.keeps("user", u) ])
+        self.assertTrue(1800 < kept < 2200, kept)
+
+    def test_lines(self):
+        s = sample.sample(0.5, RATINGS)
+        for u in range(1, 200):
+            for m in range(1, 50):
+                line = [ str(u), str(m), "4.0", "838985046" ]
+                self.assertEqual(s(line), s.keeps("user", str(u))
+                                                and s.keeps("movie", str(m)))
+
+    def test_files(self):
+        # The same users and movies in files w/ other fields and orders
+        ratings = sample.sample(0.3, RATINGS)
+        movies  = ratings.of(("MovieID", "Title", "Genres"))
+        users   = ratings.of(("Gender", "UserID"))
+        for k in range(1, 500):
+            self.assertEqual(movies([ str(k), "Title", "Drama" ]),
+                             ratings.keeps("movie", str(k)))
+            self.assertEqual(users([ "F", str(k) ]),
+                             ratings.keeps("user", str(k)))
+
+    def test_processes(self):
+        s = sample.sample(0.2, RATINGS)
+        p = pickle.loads(pickle.dumps(s, pickle.HIGHEST_PROTOCOL))
+        lines = [ [ str(k), str(k * 3), "1", "0" ] for k in range(1, 1000) ]
+        self.assertEqual(map(s, lines), map(p, lines))
+
+    def test_nested(self):
+        small = sample.sample(0.1)
+        large = sample.sample(0.2)
+        for k in range(1, 2000):
+            if small.keeps("user", k):
+                self.assertTrue(large.keeps("user", k))
+
+    def test_bad_keys(self):
+        # Kept, for the parser to report
+        s = sample.sample(0.0, RATINGS)
+        self.assertTrue(s([ "UserID", "x", "", "" ]))
+        self.assertFalse(s([ "1", "1", "4.0", "838985046" ]))
+
+    @unittest.skipIf(numpy is None, "NumPy not installed")
+    def test_mask(self):
+        s = sample.sample(0.3)
+        column = numpy.array([ 5, 1, 5, 9, 300, 1 ], dtype=numpy.int32)
+        self.assertEqual(list(s.mask("movie", column)),
+                         [ s.keeps("movie", int(k)) for k in column ])
+
+
+if __name__ == "__main__":
+    unittest.main()
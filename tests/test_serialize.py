@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+#
+# Tests of serialize.py: batch serialization of typed documents, and the
+#  per-row fallback for rows which do not convert.
+#
+# This file is licensed to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import json
+import unittest
+import serialize
+
+RATINGS = serialize.schema(("UserID", "MovieID", "Rating", "Timestamp"))
+MOVIES  = serialize.schema(("MovieID", "Title", "Genres"))
+
+
+class schema_test(unittest.TestCase):
+
+    def test_types(self):
+        docs = RATINGS.encode([ ("1", "122", "5", "838985046"),
+                                ("1", "185", "4.5", "838983525") ])
+        self.assertEqual(docs[0], '{"UserID":1,"MovieID":122,"Rating":5,'
+                                  '"Timestamp":838985046000}')
+        self.assertEqual(json.loads(docs[1]), { "UserID": 1, "MovieID": 185,
+                                "Rating": 4.5, "Timestamp": 838983525000 })
+
+    def test_converted(self):
+        # Values not as parsed, e.g. w/ leading zeros or already numbers
+        docs = RATINGS.encode([ ("007", 122, 5.0, "0"),
+                                ("8", "+3", " 2 ", 838983525) ])
+        self.assertEqual(json.loads(docs[0]), { "UserID": 7, "MovieID": 122,
+                                "Rating": 5.0, "Timestamp": 0 })
+        self.assertEqual(json.loads(docs[1]), { "UserID": 8, "MovieID": 3,
+                                "Rating": 2.0, "Timestamp": 838983525000 })
+
+    def test_text(self):
+        docs = MOVIES.encode([ ("1", "Am\xc3\xa9lie \"2001\"",
+                                                    "Comedy|Romance"),
+                               ("2", "Heat", ["Action"]) ])
+        self.assertEqual(json.loads(docs[0]), { "MovieID": 1,
+                                "Title": u"Am\xe9lie \"2001\"",
+                                "Genres": [ "Comedy", "Romance" ] })
+        self.assertEqual(json.loads(docs[1])["Genres"], [ "Action" ])
+
+    def test_bad_rows(self):
+        rows = [ ("1", "122", "5", "838985046"),
+                 ("x", "122", "5", "838985046"),
+                 ("2", "122"),
+                 ("3", "122", "nan", "838985046"),
+                 ("4", "185", "4.5", "838983525") ]
+        docs = RATINGS.encode(rows)
+        self.assertEqual(len(docs), len(rows))
+        self.assertEqual(docs[1:4], [ None, None, None ])
+        self.assertEqual(docs[0], RATINGS.encode(rows[:1])[0])
+        self.assertEqual(json.loads(docs[4])["UserID"], 4)
+
+    def test_bad_encoding(self):
+        docs = MOVIES.encode([ ("1", "\xff", "Drama"), ("2", "Heat", "") ])
+        self.assertEqual(docs[0], None)
+        self.assertEqual(json.loads(docs[1])["Title"], "Heat")
+
+    def test_open_dict(self):
+        s = serialize.schema(("MovieID",), open_dict=True)
+        self.assertEqual(s.encode([ ("1",) ]), [ '{"MovieID":1,' ])
+
+    def test_batches(self):
+        self.assertEqual([ len(b) for b in serialize.batches(range(25), 10) ],
+                                                                [ 10, 10, 5 ])
+        self.assertEqual(list(serialize.batches([], 10)), [])
+
+
+if __name__ == "__main__":
+    unittest.main()